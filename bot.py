@@ -1,10 +1,24 @@
 import os
+import time
 import logging
+import threading
 import psycopg2
+import psycopg2.pool
+import psycopg2.extensions
+import psycopg2.extras
 import hashlib
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
-from telegram.error import TelegramError
+import hmac
+import bisect
+import functools
+import heapq
+import json
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand, InputMediaPhoto
+from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ChatMemberHandler, MessageReactionHandler, BasePersistence, PersistenceInput, filters, ContextTypes
+from telegram.error import TelegramError, RetryAfter, NetworkError, TimedOut, Forbidden, BadRequest
 from aiohttp import web
 import asyncio
 
@@ -25,167 +39,840 @@ BOT_TOKEN = os.getenv('BOT_TOKEN')
 DATABASE_URL = os.getenv('DATABASE_URL')
 SUPPORT_ADMIN_ID = int(os.getenv('SUPPORT_ADMIN_ID', '0'))
 
-def get_db_connection():
-    return psycopg2.connect(DATABASE_URL)
+# Пул соединений с БД
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', '10'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '10'))
+DB_CONN_MAX_LIFETIME = int(os.getenv('DB_CONN_MAX_LIFETIME', '1800'))
+DB_HEALTHCHECK_IDLE = int(os.getenv('DB_HEALTHCHECK_IDLE', '30'))
+
+# Кэш метаданных каналов
+CHAT_CACHE_TTL = int(os.getenv('CHAT_CACHE_TTL', '3600'))
+CHAT_CACHE_SIZE = int(os.getenv('CHAT_CACHE_SIZE', '5000'))
+CHAT_CACHE_FAILURE_TTL = int(os.getenv('CHAT_CACHE_FAILURE_TTL', '60'))
+CHAT_CACHE_REFRESH_INTERVAL = int(os.getenv('CHAT_CACHE_REFRESH_INTERVAL', str(CHAT_CACHE_TTL // 2)))
+
+# Аренда постов модераторами
+MODERATION_CLAIM_TTL = int(os.getenv('MODERATION_CLAIM_TTL', '300'))
+MODERATION_DECISION_TTL = int(os.getenv('MODERATION_DECISION_TTL', '120'))
+
+# Сколько следующих постов готовить заранее, пока модератор смотрит текущий
+MODERATION_PREFETCH = int(os.getenv('MODERATION_PREFETCH', '5'))
+
+# Пакетная модерация (альбом не может содержать больше 10 фото)
+BULK_PAGE_SIZE = min(int(os.getenv('BULK_PAGE_SIZE', '10')), 10)
+BULK_PUBLISH_SPACING = int(os.getenv('BULK_PUBLISH_SPACING', '3'))
+
+# Слоты публикаций: занятые времена канала перечитываются из БД раз в SLOT_CACHE_TTL секунд
+SLOT_CACHE_TTL = int(os.getenv('SLOT_CACHE_TTL', '600'))
+SLOT_CACHE_SIZE = int(os.getenv('SLOT_CACHE_SIZE', '5000'))
+# Тихие часы умного режима (часы «с-по», локальное время бота)
+QUIET_HOURS_START, QUIET_HOURS_END = (int(hour) for hour in os.getenv('QUIET_HOURS', '1-9').split('-'))
+
+# Гистограмма вовлеченности по часам недели для умного режима
+ENGAGEMENT_CACHE_TTL = int(os.getenv('ENGAGEMENT_CACHE_TTL', '3600'))
+ENGAGEMENT_MIN_POSTS = int(os.getenv('ENGAGEMENT_MIN_POSTS', '20'))
+
+# Кэш прав доступа (админы каналов и баны)
+AUTH_CACHE_TTL = int(os.getenv('AUTH_CACHE_TTL', '300'))
+AUTH_CACHE_SIZE = int(os.getenv('AUTH_CACHE_SIZE', '20000'))
+
+# Кэш настроек каналов
+SETTINGS_CACHE_TTL = int(os.getenv('SETTINGS_CACHE_TTL', '600'))
+SETTINGS_CACHE_SIZE = int(os.getenv('SETTINGS_CACHE_SIZE', '5000'))
+
+# Буфер реакций
+REACTIONS_FLUSH_INTERVAL = float(os.getenv('REACTIONS_FLUSH_INTERVAL', '5'))
+REACTIONS_BATCH_SIZE = int(os.getenv('REACTIONS_BATCH_SIZE', '500'))
+
+# Планировщик отложенных постов
+SCHEDULER_RESYNC_INTERVAL = int(os.getenv('SCHEDULER_RESYNC_INTERVAL', '300'))
+SCHEDULER_RETRY_DELAY = int(os.getenv('SCHEDULER_RETRY_DELAY', '60'))
+# Несколько реплик разбирают просроченные посты пачками, каждую пачку арендуя через SKIP LOCKED
+SCHEDULER_CLAIM_BATCH = int(os.getenv('SCHEDULER_CLAIM_BATCH', '10'))
+SCHEDULER_CLAIM_LEASE = int(os.getenv('SCHEDULER_CLAIM_LEASE', '300'))
+# Кем арендован пост: продлить аренду может только реплика, которая ее взяла
+INSTANCE_ID = uuid.uuid4().hex
+
+# Лидерство для задач, которые должна выполнять одна реплика
+LEADER_RENEW_INTERVAL = int(os.getenv('LEADER_RENEW_INTERVAL', '15'))
+
+# Исходящие сообщения: лимиты Telegram (~30 сообщений/с всего, ~1/с в личку, ~20/мин в группу или канал)
+OUTBOUND_GLOBAL_RATE = float(os.getenv('OUTBOUND_GLOBAL_RATE', '25'))
+OUTBOUND_PRIVATE_RATE = float(os.getenv('OUTBOUND_PRIVATE_RATE', '1'))
+OUTBOUND_GROUP_RATE = float(os.getenv('OUTBOUND_GROUP_RATE', str(20 / 60)))
+OUTBOUND_CONCURRENCY = int(os.getenv('OUTBOUND_CONCURRENCY', '8'))
+OUTBOUND_MAX_RETRIES = int(os.getenv('OUTBOUND_MAX_RETRIES', '5'))
+
+# Очередь уведомлений авторам (notification_outbox)
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', '50'))
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', '5'))
+OUTBOX_LEASE = int(os.getenv('OUTBOX_LEASE', '120'))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '8'))
+
+# Прием апдейтов: при заданном WEBHOOK_URL бот слушает вебхук на том же aiohttp-сервере, иначе long polling
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', '1000'))
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '64'))
+
+# Сохранение context.user_data в БД (состояние диалогов переживает рестарт)
+PERSISTENCE_INTERVAL = float(os.getenv('PERSISTENCE_INTERVAL', '10'))
+PERSISTENCE_FLUSH_DELAY = float(os.getenv('PERSISTENCE_FLUSH_DELAY', '1'))
+PERSISTENCE_MAX_AGE_DAYS = int(os.getenv('PERSISTENCE_MAX_AGE_DAYS', '7'))
+# Перечитывать состояние пользователя перед каждым апдейтом (нужно, если реплик несколько)
+PERSISTENCE_REFRESH = os.getenv('PERSISTENCE_REFRESH', 'false').lower() in ('1', 'true', 'yes')
+
+# Метрики, отдаются на /metrics
+METRICS = {
+    'scheduler_lag_seconds': 0.0,
+    'scheduler_lag_seconds_max': 0.0,
+    'scheduler_published_total': 0,
+    'scheduler_failed_total': 0,
+    'scheduler_queue_size': 0,
+    'reaction_updates_total': 0,
+    'reaction_rows_written_total': 0,
+    'outbound_sent_total': 0,
+    'outbound_failed_total': 0,
+    'outbound_retry_after_total': 0,
+    'outbound_queue_size': 0,
+    'outbox_sent_total': 0,
+    'outbox_failed_total': 0,
+    'outbox_dead_total': 0,
+    'outbox_pending': 0,
+    'outbox_dead': 0,
+    'webhook_updates_total': 0,
+    'webhook_rejected_total': 0,
+    'leader': 0,
+    'persistence_rows_written_total': 0,
+}
+
+class DatabasePool:
+    """Потокобезопасный пул соединений с проверкой здоровья и ограничением времени жизни"""
+
+    def __init__(self, dsn, minconn: int, maxconn: int, timeout: float, max_lifetime: int, healthcheck_idle: int):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.healthcheck_idle = healthcheck_idle
+        self._pool = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._created_at = {}
+        self._released_at = {}
+
+    def _get_pool(self):
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = psycopg2.pool.ThreadedConnectionPool(self.minconn, self.maxconn, self.dsn)
+        return self._pool
+
+    def _discard(self, conn):
+        self._created_at.pop(id(conn), None)
+        self._released_at.pop(id(conn), None)
+        try:
+            self._get_pool().putconn(conn, close=True)
+        except Exception as e:
+            logger.warning(f"Error discarding DB connection: {e}")
+
+    def _is_healthy(self, conn) -> bool:
+        if conn.closed:
+            return False
+        now = time.monotonic()
+        created_at = self._created_at.setdefault(id(conn), now)
+        if self.max_lifetime and now - created_at > self.max_lifetime:
+            return False
+        released_at = self._released_at.get(id(conn))
+        if released_at is not None and now - released_at > self.healthcheck_idle:
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1")
+                conn.rollback()
+            except Exception:
+                return False
+        return True
+
+    def getconn(self):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise psycopg2.pool.PoolError("connection pool exhausted")
+        try:
+            pool = self._get_pool()
+            for _ in range(self.maxconn + 1):
+                conn = pool.getconn()
+                if self._is_healthy(conn):
+                    return conn
+                self._discard(conn)
+            raise psycopg2.pool.PoolError("unable to get a healthy connection")
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn):
+        try:
+            if conn.closed:
+                self._discard(conn)
+                return
+            if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+            self._released_at[id(conn)] = time.monotonic()
+            self._get_pool().putconn(conn)
+        except Exception as e:
+            logger.warning(f"Error returning DB connection to pool: {e}")
+            self._discard(conn)
+        finally:
+            self._slots.release()
+
+    def closeall(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+            self._created_at.clear()
+            self._released_at.clear()
+
+db_pool = DatabasePool(DATABASE_URL, DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_CONN_MAX_LIFETIME, DB_HEALTHCHECK_IDLE)
+
+@contextmanager
+def db_connection():
+    """Соединение из пула: commit при успехе, rollback при ошибке"""
+    conn = db_pool.getconn()
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        db_pool.putconn(conn)
+
+@contextmanager
+def db_cursor():
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            yield cur
+
+# Потоков ровно столько, сколько соединений в пуле: лишние задачи ждут в очереди executor'а, а не пула
+db_executor = ThreadPoolExecutor(max_workers=DB_POOL_MAX, thread_name_prefix='db')
+
+async def run_db(func, *args, **kwargs):
+    """Выполняет синхронную функцию работы с БД в пуле потоков, не блокируя event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, functools.partial(func, *args, **kwargs))
+
+_MISSING = object()
+
+class TTLCache:
+    """Потокобезопасный LRU-кэш с ограничением времени жизни записей"""
+
+    def __init__(self, ttl: float, maxsize: int):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl: float = None):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return entry[0] if entry else default
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+class ChannelSearchIndex:
+    """Индекс названий и username каналов: префиксный, подстрочный и нечеткий (триграммы) поиск"""
+
+    EXACT_SCORE = 100
+    PREFIX_SCORE = 80
+    SUBSTRING_SCORE = 60
+    FUZZY_SCORE = 40
+    FUZZY_THRESHOLD = 0.3
+
+    def __init__(self):
+        self._entries = {}
+        self._prefix_terms = []
+        self._trigrams = {}
+
+    @staticmethod
+    def _make_trigrams(text: str):
+        padded = f"  {text} "
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    @staticmethod
+    def _terms(channel_id: str, title: str, username: str):
+        terms = {channel_id.lower()}
+        if title:
+            terms.add(title)
+            terms.update(title.split())
+        if username:
+            terms.add(username)
+        return terms
+
+    def add(self, channel_id: str, title: str = None, username: str = None):
+        self.remove(channel_id)
+        title_lower = (title or '').lower()
+        username_lower = (username or '').lower()
+        terms = self._terms(channel_id, title_lower, username_lower)
+        trigrams = self._make_trigrams(title_lower) | self._make_trigrams(username_lower) if (title_lower or username_lower) else set()
+        self._entries[channel_id] = {
+            'title': title, 'username': username or '',
+            'title_lower': title_lower, 'username_lower': username_lower,
+            'terms': terms, 'trigrams': trigrams
+        }
+        for term in terms:
+            bisect.insort(self._prefix_terms, (term, channel_id))
+        for trigram in trigrams:
+            self._trigrams.setdefault(trigram, set()).add(channel_id)
+
+    def remove(self, channel_id: str):
+        entry = self._entries.pop(channel_id, None)
+        if not entry:
+            return
+        for term in entry['terms']:
+            idx = bisect.bisect_left(self._prefix_terms, (term, channel_id))
+            if idx < len(self._prefix_terms) and self._prefix_terms[idx] == (term, channel_id):
+                del self._prefix_terms[idx]
+        for trigram in entry['trigrams']:
+            ids = self._trigrams.get(trigram)
+            if ids:
+                ids.discard(channel_id)
+                if not ids:
+                    del self._trigrams[trigram]
+
+    def _prefix_matches(self, query: str):
+        idx = bisect.bisect_left(self._prefix_terms, (query, ''))
+        matches = set()
+        while idx < len(self._prefix_terms) and self._prefix_terms[idx][0].startswith(query):
+            matches.add(self._prefix_terms[idx][1])
+            idx += 1
+        return matches
+
+    def search(self, query: str, limit: int = 10):
+        """Возвращает [(channel_id, title, username)], лучшие совпадения первыми"""
+        query = query.lower().strip()
+        bare_query = query.lstrip('@')
+        if not bare_query:
+            return []
+        scores = {}
+        
+        def score(channel_id, value):
+            if value > scores.get(channel_id, 0):
+                scores[channel_id] = value
+        
+        for channel_id in self._prefix_matches(query) | self._prefix_matches(bare_query):
+            entry = self._entries[channel_id]
+            if bare_query in (entry['title_lower'], entry['username_lower']) or query == channel_id.lower():
+                score(channel_id, self.EXACT_SCORE)
+            else:
+                score(channel_id, self.PREFIX_SCORE)
+        
+        query_trigrams = self._make_trigrams(bare_query)
+        common = {}
+        for trigram in query_trigrams:
+            for channel_id in self._trigrams.get(trigram, ()):
+                common[channel_id] = common.get(channel_id, 0) + 1
+        for channel_id, shared in common.items():
+            entry = self._entries[channel_id]
+            if bare_query in entry['title_lower'] or bare_query in entry['username_lower']:
+                score(channel_id, self.SUBSTRING_SCORE)
+                continue
+            similarity = shared / len(query_trigrams | entry['trigrams'])
+            if similarity >= self.FUZZY_THRESHOLD:
+                score(channel_id, self.FUZZY_SCORE * similarity)
+        
+        # Нечеткие совпадения показываем только если нет точных, префиксных или подстрочных
+        if any(value >= self.SUBSTRING_SCORE for value in scores.values()):
+            scores = {channel_id: value for channel_id, value in scores.items() if value >= self.SUBSTRING_SCORE}
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], self._entries[item[0]]['title_lower'] or item[0]))
+        results = []
+        for channel_id, _ in ranked[:limit]:
+            entry = self._entries[channel_id]
+            results.append((channel_id, entry['title'] or channel_id, entry['username']))
+        return results
+
+# Множества каналов по user_id; сбрасываются при изменении банов и списков админов
+user_bans_cache = TTLCache(AUTH_CACHE_TTL, AUTH_CACHE_SIZE)
+user_admin_channels_cache = TTLCache(AUTH_CACHE_TTL, AUTH_CACHE_SIZE)
+
+def get_user_bans(user_id: int) -> frozenset:
+    bans = user_bans_cache.get(user_id)
+    if bans is None:
+        with db_cursor() as cur:
+            cur.execute("SELECT channel_id FROM banned_users WHERE user_id = %s", (user_id,))
+            bans = frozenset(row[0] for row in cur.fetchall())
+        user_bans_cache.set(user_id, bans)
+    return bans
 
 def is_user_banned(user_id: int, channel_id: str = None) -> bool:
-    conn = get_db_connection()
-    cur = conn.cursor()
+    bans = get_user_bans(user_id)
     if channel_id:
-        cur.execute("SELECT user_id FROM banned_users WHERE user_id = %s AND channel_id = %s", (user_id, channel_id))
-    else:
-        cur.execute("SELECT user_id FROM banned_users WHERE user_id = %s", (user_id,))
-    result = cur.fetchone()
-    cur.close()
-    conn.close()
-    return result is not None
-
-def ban_user(user_id: int, username: str, banned_by: int, channel_id: str):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO banned_users (user_id, channel_id, username, banned_by) VALUES (%s, %s, %s, %s) ON CONFLICT (user_id, channel_id) DO NOTHING",
-        (user_id, channel_id, username, banned_by)
-    )
-    conn.commit()
-    cur.close()
-    conn.close()
+        return channel_id in bans
+    return bool(bans)
 
 def unban_user(user_id: int, channel_id: str = None):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    if channel_id:
-        cur.execute("DELETE FROM banned_users WHERE user_id = %s AND channel_id = %s", (user_id, channel_id))
-    else:
-        cur.execute("DELETE FROM banned_users WHERE user_id = %s", (user_id,))
-    conn.commit()
-    cur.close()
-    conn.close()
+    with db_cursor() as cur:
+        if channel_id:
+            cur.execute("DELETE FROM banned_users WHERE user_id = %s AND channel_id = %s", (user_id, channel_id))
+        else:
+            cur.execute("DELETE FROM banned_users WHERE user_id = %s", (user_id,))
+    user_bans_cache.pop(user_id)
 
 def get_banned_users(channel_id: str = None):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    if channel_id:
-        cur.execute("SELECT user_id, username, banned_at, banned_by FROM banned_users WHERE channel_id = %s ORDER BY banned_at DESC", (channel_id,))
-    else:
-        cur.execute("SELECT user_id, channel_id, username, banned_at, banned_by FROM banned_users ORDER BY banned_at DESC")
-    users = cur.fetchall()
-    cur.close()
-    conn.close()
-    return users
+    with db_cursor() as cur:
+        if channel_id:
+            cur.execute("SELECT user_id, username, banned_at, banned_by FROM banned_users WHERE channel_id = %s ORDER BY banned_at DESC", (channel_id,))
+        else:
+            cur.execute("SELECT user_id, channel_id, username, banned_at, banned_by FROM banned_users ORDER BY banned_at DESC")
+        return cur.fetchall()
 
 def add_channel(channel_id: str, added_by: int):
-    conn = get_db_connection()
-    cur = conn.cursor()
+    with db_cursor() as cur:
+        cur.execute(
+            "INSERT INTO channels (channel_id, added_by) VALUES (%s, %s) ON CONFLICT (channel_id) DO NOTHING",
+            (channel_id, added_by)
+        )
+
+def update_channel_admins(channel_id: str, admins: list):
+    with db_cursor() as cur:
+        cur.execute("DELETE FROM channel_admins WHERE channel_id = %s RETURNING user_id", (channel_id,))
+        affected = {row[0] for row in cur.fetchall()}
+        cur.executemany(
+            "INSERT INTO channel_admins (channel_id, user_id, username) VALUES (%s, %s, %s)",
+            [(channel_id, admin['user_id'], admin['username']) for admin in admins]
+        )
+    # Сбрасываем и бывших, и новых админов канала
+    affected.update(admin['user_id'] for admin in admins)
+    for user_id in affected:
+        user_admin_channels_cache.pop(user_id)
+
+def bump_user_stats(cur, user_id: int, username: str = None, published: int = 0, rejected: int = 0, pending: int = 0, reactions: int = 0):
+    """Инкрементально обновляет счетчики user_stats, возвращает (published, posts_today)"""
+    from datetime import date
     cur.execute(
-        "INSERT INTO channels (channel_id, added_by) VALUES (%s, %s) ON CONFLICT (channel_id) DO NOTHING",
-        (channel_id, added_by)
+        "INSERT INTO user_stats (user_id, username, published, rejected, pending, reactions, posts_today, last_post_date) "
+        "VALUES (%(user_id)s, %(username)s, %(published)s, %(rejected)s, GREATEST(%(pending)s, 0), %(reactions)s, %(published)s, "
+        "CASE WHEN %(published)s > 0 THEN %(today)s END) "
+        "ON CONFLICT (user_id) DO UPDATE SET "
+        "username = COALESCE(EXCLUDED.username, user_stats.username), "
+        "published = user_stats.published + %(published)s, "
+        "rejected = user_stats.rejected + %(rejected)s, "
+        "pending = GREATEST(user_stats.pending + %(pending)s, 0), "
+        "reactions = user_stats.reactions + %(reactions)s, "
+        "posts_today = CASE WHEN %(published)s = 0 THEN user_stats.posts_today "
+        "WHEN user_stats.last_post_date = %(today)s THEN user_stats.posts_today + %(published)s ELSE %(published)s END, "
+        "last_post_date = CASE WHEN %(published)s > 0 THEN %(today)s ELSE user_stats.last_post_date END, "
+        "updated_at = CURRENT_TIMESTAMP "
+        "RETURNING published, posts_today",
+        {'user_id': user_id, 'username': username, 'published': published, 'rejected': rejected,
+         'pending': pending, 'reactions': reactions, 'today': date.today()}
     )
-    conn.commit()
-    cur.close()
-    conn.close()
+    return cur.fetchone()
 
-def update_channel_admins(channel_id: str, admins: list):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM channel_admins WHERE channel_id = %s", (channel_id,))
-    for admin in admins:
+def get_user_stats(user_id: int, cur=None):
+    """Счетчики пользователя: published, rejected, pending, reactions, posts_today"""
+    from datetime import date
+    if cur is None:
+        with db_cursor() as cur:
+            return get_user_stats(user_id, cur)
+    cur.execute("SELECT published, rejected, pending, reactions, posts_today, last_post_date FROM user_stats WHERE user_id = %s", (user_id,))
+    result = cur.fetchone()
+    if not result:
+        return {'published': 0, 'rejected': 0, 'pending': 0, 'reactions': 0, 'posts_today': 0}
+    published, rejected, pending, reactions, posts_today, last_post_date = result
+    # posts_today относится к last_post_date и обнуляется при смене дня
+    if last_post_date != date.today():
+        posts_today = 0
+    return {'published': published, 'rejected': rejected, 'pending': pending, 'reactions': reactions, 'posts_today': posts_today}
+
+# Приоритет записи очереди: купленный «⚡ Приоритет» поднимает пост над обычными
+PRIORITY_ITEM_BOOST = 100
+
+def submission_priority(cur, user_id: int) -> int:
+    if consume_shop_item(cur, user_id, 'priority'):
+        return PRIORITY_ITEM_BOOST
+    return 0
+
+def create_submission(cur, user_id: int, username: str, photo_file_id: str, caption: str = "", photo_unique_id: str = None) -> int:
+    # Медиа и подпись хранятся один раз, очереди каналов ссылаются на submission_id
+    cur.execute(
+        "INSERT INTO submissions (user_id, username, photo_file_id, photo_unique_id, caption) VALUES (%s, %s, %s, %s, %s) RETURNING id",
+        (user_id, username, photo_file_id, photo_unique_id, caption)
+    )
+    return cur.fetchone()[0]
+
+def prune_submissions(cur, submission_ids):
+    # Submission живет, пока на нее ссылается хотя бы одна очередь
+    submission_ids = [submission_id for submission_id in set(submission_ids) if submission_id is not None]
+    if submission_ids:
         cur.execute(
-            "INSERT INTO channel_admins (channel_id, user_id, username) VALUES (%s, %s, %s)",
-            (channel_id, admin['user_id'], admin['username'])
+            "DELETE FROM submissions s WHERE s.id = ANY(%s) "
+            "AND NOT EXISTS (SELECT 1 FROM pending_posts p WHERE p.submission_id = s.id)",
+            (submission_ids,)
         )
-    conn.commit()
-    cur.close()
-    conn.close()
 
-def add_pending_post(channel_id: str, user_id: int, username: str, photo_file_id: str, caption: str = ""):
-    conn = get_db_connection()
-    cur = conn.cursor()
+def add_pending_post(channel_id: str, user_id: int, username: str, photo_file_id: str, caption: str = "", photo_unique_id: str = None):
+    with db_cursor() as cur:
+        submission_id = create_submission(cur, user_id, username, photo_file_id, caption, photo_unique_id)
+        cur.execute(
+            "INSERT INTO pending_posts (channel_id, user_id, submission_id, priority) VALUES (%s, %s, %s, %s)",
+            (channel_id, user_id, submission_id, submission_priority(cur, user_id))
+        )
+        bump_user_stats(cur, user_id, username, pending=1)
+
+def add_pending_post_to_all(user_id: int, username: str, photo_file_id: str, caption: str = "", photo_unique_id: str = None):
+    """Ставит пост в очередь всех каналов, где разрешены глобальные посты и автор не забанен.
+    Возвращает (добавлено, пропущено)"""
+    with db_cursor() as cur:
+        submission_id = create_submission(cur, user_id, username, photo_file_id, caption, photo_unique_id)
+        cur.execute(
+            "WITH inserted AS ("
+            "INSERT INTO pending_posts (channel_id, user_id, submission_id, priority) "
+            "SELECT c.channel_id, %s, %s, 0 FROM channels c "
+            "LEFT JOIN channel_settings s ON s.channel_id = c.channel_id "
+            "WHERE COALESCE(s.allow_global_posts, TRUE) "
+            "AND NOT EXISTS (SELECT 1 FROM banned_users b WHERE b.user_id = %s AND b.channel_id = c.channel_id) "
+            "RETURNING 1"
+            ") SELECT (SELECT COUNT(*) FROM inserted), (SELECT COUNT(*) FROM channels)",
+            (user_id, submission_id, user_id)
+        )
+        added, total = cur.fetchone()
+        if added:
+            bump_user_stats(cur, user_id, username, pending=added)
+            # Приоритет списываем, только если пост реально попал хотя бы в одну очередь
+            priority = submission_priority(cur, user_id)
+            if priority:
+                cur.execute("UPDATE pending_posts SET priority = %s WHERE submission_id = %s", (priority, submission_id))
+        else:
+            prune_submissions(cur, [submission_id])
+    return added, total - added
+
+PENDING_POST_COLUMNS = "p.id, p.user_id, s.username, s.photo_file_id, s.caption, p.created_at"
+PENDING_POST_FROM = "pending_posts p JOIN submissions s ON s.id = p.submission_id"
+# Порядок очереди совпадает с индексом (channel_id, priority DESC, created_at, id)
+PENDING_POST_ORDER = "p.priority DESC, p.created_at ASC, p.id ASC"
+
+# Пост свободен для модератора, если он не в обработке и не арендован другим (или аренда истекла)
+PENDING_POST_AVAILABLE = (
+    "p.channel_id = %s AND (NOT p.processing OR p.claimed_until < NOW()) "
+    "AND (p.claimed_by IS NULL OR p.claimed_by = %s OR p.claimed_until < NOW())"
+)
+
+def release_moderator_claims(cur, channel_id: str, moderator_id: int, keep_post_ids: list = None):
     cur.execute(
-        "INSERT INTO pending_posts (channel_id, user_id, username, photo_file_id, caption) VALUES (%s, %s, %s, %s, %s)",
-        (channel_id, user_id, username, photo_file_id, caption)
+        "UPDATE pending_posts SET claimed_by = NULL, claimed_until = NULL "
+        "WHERE channel_id = %s AND claimed_by = %s AND NOT processing AND NOT (id = ANY(%s))",
+        (channel_id, moderator_id, list(keep_post_ids or []))
     )
-    conn.commit()
-    cur.close()
-    conn.close()
 
-def get_pending_posts(channel_id: str):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT id, user_id, username, photo_file_id, caption, created_at FROM pending_posts WHERE channel_id = %s ORDER BY created_at ASC", (channel_id,))
-    posts = cur.fetchall()
-    cur.close()
-    conn.close()
-    return posts
+def claim_pending_posts(channel_id: str, moderator_id: int, limit: int, after_post_id: int = None, keep_post_ids: list = None):
+    """Арендует для модератора до limit свободных постов очереди, начиная после курсора (с переходом в начало).
+    Посты, арендованные другими модераторами, пропускаются; аренда модератора, кроме keep_post_ids, снимается"""
+    keep_post_ids = list(keep_post_ids or [])
+    with db_cursor() as cur:
+        release_moderator_claims(cur, channel_id, moderator_id, keep_post_ids)
+        post_ids = []
+        if after_post_id:
+            cur.execute(
+                f"SELECT p.id FROM pending_posts p, (SELECT priority, created_at, id FROM pending_posts WHERE id = %s) c "
+                f"WHERE {PENDING_POST_AVAILABLE} AND NOT (p.id = ANY(%s)) "
+                "AND (p.priority < c.priority OR (p.priority = c.priority AND (p.created_at, p.id) > (c.created_at, c.id))) "
+                f"ORDER BY {PENDING_POST_ORDER} LIMIT %s FOR UPDATE OF p SKIP LOCKED",
+                (after_post_id, channel_id, moderator_id, keep_post_ids, limit)
+            )
+            post_ids = [row[0] for row in cur.fetchall()]
+        if len(post_ids) < limit:
+            cur.execute(
+                f"SELECT p.id FROM pending_posts p WHERE {PENDING_POST_AVAILABLE} AND NOT (p.id = ANY(%s)) "
+                f"ORDER BY {PENDING_POST_ORDER} LIMIT %s FOR UPDATE OF p SKIP LOCKED",
+                (channel_id, moderator_id, keep_post_ids + post_ids, limit - len(post_ids))
+            )
+            post_ids += [row[0] for row in cur.fetchall()]
+        if not post_ids:
+            return []
+        cur.execute(
+            "UPDATE pending_posts SET claimed_by = %s, claimed_until = NOW() + %s * INTERVAL '1 second' WHERE id = ANY(%s)",
+            (moderator_id, MODERATION_CLAIM_TTL, post_ids)
+        )
+        cur.execute(f"SELECT {PENDING_POST_COLUMNS} FROM {PENDING_POST_FROM} WHERE p.id = ANY(%s)", (post_ids,))
+        order = {post_id: idx for idx, post_id in enumerate(post_ids)}
+        return sorted(cur.fetchall(), key=lambda post: order[post[0]])
 
-def remove_pending_post(post_id: int):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM pending_posts WHERE id = %s", (post_id,))
-    conn.commit()
-    cur.close()
-    conn.close()
+def apply_bulk_decision(channel_id: str, moderator_id: int, post_ids: list, decision: str, channel_name: str = None) -> dict:
+    """Применяет одно решение (app/rej/ban) к набору постов одной транзакцией.
+    Одобренные посты не публикуются сразу, а ставятся в scheduled_posts в свободные слоты канала;
+    отклоненным и забаненным авторам в той же транзакции ставится уведомление"""
+    action = {'app': 'scheduled', 'rej': 'rejected', 'ban': 'banned'}[decision]
+    # Настройки читаем до транзакции, чтобы не занимать второе соединение из пула
+    settings = get_channel_settings(channel_id) if decision == 'app' else None
+    with slot_allocator.guard(channel_id), db_cursor() as cur:
+        # DELETE забирает только посты, которые еще не обработал другой модератор
+        cur.execute(
+            "DELETE FROM pending_posts p USING submissions s "
+            f"WHERE s.id = p.submission_id AND p.id = ANY(%s) AND {PENDING_POST_AVAILABLE} "
+            "RETURNING p.id, p.user_id, s.username, s.photo_file_id, s.caption, p.created_at, p.submission_id",
+            (list(post_ids), channel_id, moderator_id)
+        )
+        rows = cur.fetchall()
+        prune_submissions(cur, [row[-1] for row in rows])
+        # Публикуем в том порядке, в котором посты стояли на странице
+        order = {post_id: idx for idx, post_id in enumerate(post_ids)}
+        posts = sorted((row[:-1] for row in rows), key=lambda post: order[post[0]])
+        if not posts:
+            return {'posts': [], 'scheduled': []}
+        
+        per_user = {}
+        for _, user_id, username, _, _, _ in posts:
+            per_user[user_id] = per_user.get(user_id, 0) + 1
+        psycopg2.extras.execute_values(
+            cur,
+            "UPDATE user_stats s SET pending = GREATEST(s.pending - v.n, 0), rejected = s.rejected + v.r, updated_at = CURRENT_TIMESTAMP "
+            "FROM (VALUES %s) AS v(user_id, n, r) WHERE s.user_id = v.user_id",
+            [(user_id, n, n if decision == 'rej' else 0) for user_id, n in per_user.items()]
+        )
+        
+        if decision == 'ban':
+            authors = {user_id: username for _, user_id, username, _, _, _ in posts}
+            psycopg2.extras.execute_values(
+                cur,
+                "INSERT INTO banned_users (user_id, channel_id, username, banned_by) VALUES %s ON CONFLICT (user_id, channel_id) DO NOTHING",
+                [(user_id, channel_id, username, moderator_id) for user_id, username in authors.items()]
+            )
+        
+        if decision in ('rej', 'ban'):
+            notice = REJECT_NOTICE if decision == 'rej' else ban_notice(channel_name)
+            enqueue_notifications(cur, [(user_id, notice) for user_id in per_user])
+        
+        scheduled = []
+        if decision == 'app':
+            slots = slot_allocator.reserve(cur, channel_id, settings, len(posts), publish_gap(cur, channel_id, settings))
+            scheduled = psycopg2.extras.execute_values(
+                cur,
+                "INSERT INTO scheduled_posts (channel_id, user_id, username, photo_file_id, caption, scheduled_time) VALUES %s RETURNING id, scheduled_time",
+                [
+                    (channel_id, user_id, username, photo_file_id, caption, slot)
+                    for slot, (_, user_id, username, photo_file_id, caption, _) in zip(slots, posts)
+                ],
+                page_size=len(posts), fetch=True
+            )
+        
+        psycopg2.extras.execute_values(
+            cur,
+            "INSERT INTO audit_log (channel_id, action, user_id, admin_id, post_id, details) VALUES %s",
+            [(channel_id, action, user_id, moderator_id, post_id, 'bulk') for post_id, user_id, _, _, _, _ in posts]
+        )
+    
+    if decision == 'ban':
+        for user_id in per_user:
+            user_bans_cache.pop(user_id)
+    return {'posts': posts, 'scheduled': scheduled}
 
-def get_channel_admins(channel_id: str):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT user_id FROM channel_admins WHERE channel_id = %s", (channel_id,))
-    admins = [row[0] for row in cur.fetchall()]
-    cur.close()
-    conn.close()
-    return admins
+def begin_pending_decision(post_id: int, channel_id: str, moderator_id: int):
+    """Переводит пост в обработку, если он не занят другим модератором.
+    Повторное нажатие или чужое решение получают None"""
+    with db_cursor() as cur:
+        cur.execute(
+            "UPDATE pending_posts SET processing = TRUE, claimed_by = %s, "
+            "claimed_until = NOW() + %s * INTERVAL '1 second' "
+            "WHERE id = %s AND channel_id = %s "
+            "AND (NOT processing OR claimed_until < NOW()) "
+            "AND (claimed_by IS NULL OR claimed_by = %s OR claimed_until < NOW()) "
+            "RETURNING id",
+            (moderator_id, MODERATION_DECISION_TTL, post_id, channel_id, moderator_id)
+        )
+        if not cur.fetchone():
+            return None
+        cur.execute(f"SELECT {PENDING_POST_COLUMNS} FROM {PENDING_POST_FROM} WHERE p.id = %s", (post_id,))
+        return cur.fetchone()
+
+def release_pending_decision(post_id: int):
+    with db_cursor() as cur:
+        cur.execute("UPDATE pending_posts SET processing = FALSE, claimed_by = NULL, claimed_until = NULL WHERE id = %s", (post_id,))
+
+def get_pending_post(post_id: int, channel_id: str):
+    with db_cursor() as cur:
+        cur.execute(
+            f"SELECT {PENDING_POST_COLUMNS} FROM {PENDING_POST_FROM} WHERE p.id = %s AND p.channel_id = %s",
+            (post_id, channel_id)
+        )
+        return cur.fetchone()
+
+def count_pending_posts(channel_ids: list) -> dict:
+    with db_cursor() as cur:
+        cur.execute(
+            "SELECT channel_id, COUNT(*) FROM pending_posts WHERE channel_id = ANY(%s) GROUP BY channel_id",
+            (list(channel_ids),)
+        )
+        return dict(cur.fetchall())
+
+def delete_pending_post(cur, post_id: int, rejected: bool = False):
+    cur.execute("DELETE FROM pending_posts WHERE id = %s RETURNING user_id, submission_id", (post_id,))
+    result = cur.fetchone()
+    if result:
+        bump_user_stats(cur, result[0], pending=-1, rejected=1 if rejected else 0)
+        prune_submissions(cur, [result[1]])
+    return result is not None
+
+def schedule_pending_post(post_id: int, channel_id: str, user_id: int, username: str, photo_file_id: str, caption: str,
+                          admin_id: int):
+    """Переносит одобренный пост из очереди в scheduled_posts в той же транзакции, что и проверка слота.
+    Возвращает (id, слот, smart, publish_now). Если слот уже наступил, запись сразу арендована этой репликой:
+    вызывающий публикует ее сам, а другие реплики видят занятый слот, пока публикация не записана"""
+    from datetime import datetime
+    settings = get_channel_settings(channel_id)
+    smart = bool(settings.get('smart_mode'))
+    with slot_allocator.guard(channel_id), db_cursor() as cur:
+        # Слот учитывает интервал, дневной лимит, уже запланированные посты и (в умном режиме) тихие часы
+        scheduled_time = slot_allocator.reserve(cur, channel_id, settings, 1, publish_gap(cur, channel_id, settings))[0]
+        publish_now = scheduled_time <= datetime.now()
+        cur.execute(
+            "INSERT INTO scheduled_posts (channel_id, user_id, username, photo_file_id, caption, scheduled_time, claimed_until, claimed_by) "
+            "VALUES (%s, %s, %s, %s, %s, %s, CASE WHEN %s THEN NOW() + %s * INTERVAL '1 second' END, CASE WHEN %s THEN %s END) RETURNING id",
+            (channel_id, user_id, username, photo_file_id, caption, scheduled_time,
+             publish_now, SCHEDULER_CLAIM_LEASE, publish_now, INSTANCE_ID)
+        )
+        scheduled_id = cur.fetchone()[0]
+        delete_pending_post(cur, post_id)
+        if not publish_now:
+            cur.execute(
+                "INSERT INTO audit_log (channel_id, action, user_id, admin_id, post_id, details) VALUES (%s, %s, %s, %s, %s, %s)",
+                (channel_id, 'smart_scheduled' if smart else 'scheduled', user_id, admin_id, post_id, f"Scheduled for {scheduled_time}")
+            )
+    return scheduled_id, scheduled_time, smart, publish_now
+
+def forget_published_post(pending_post_id: int = None, scheduled_post_id: int = None):
+    # Пост уже в канале, а бухгалтерию записать не удалось: хотя бы убираем его из очередей
+    with db_cursor() as cur:
+        if pending_post_id is not None:
+            delete_pending_post(cur, pending_post_id)
+        if scheduled_post_id is not None:
+            cur.execute("DELETE FROM scheduled_posts WHERE id = %s", (scheduled_post_id,))
+
+def reject_pending_post(post_id: int, channel_id: str, user_id: int, admin_id: int):
+    with db_cursor() as cur:
+        delete_pending_post(cur, post_id, rejected=True)
+        cur.execute(
+            "INSERT INTO audit_log (channel_id, action, user_id, admin_id, post_id, details) VALUES (%s, 'rejected', %s, %s, %s, '')",
+            (channel_id, user_id, admin_id, post_id)
+        )
+        enqueue_notifications(cur, [(user_id, REJECT_NOTICE)])
+
+def ban_pending_author(post_id: int, channel_id: str, user_id: int, username: str, admin_id: int, channel_name: str):
+    with db_cursor() as cur:
+        cur.execute(
+            "INSERT INTO banned_users (user_id, channel_id, username, banned_by) VALUES (%s, %s, %s, %s) ON CONFLICT (user_id, channel_id) DO NOTHING",
+            (user_id, channel_id, username, admin_id)
+        )
+        delete_pending_post(cur, post_id)
+        cur.execute(
+            "INSERT INTO audit_log (channel_id, action, user_id, admin_id, post_id, details) VALUES (%s, 'banned', %s, %s, %s, %s)",
+            (channel_id, user_id, admin_id, post_id, f"User {username} banned")
+        )
+        enqueue_notifications(cur, [(user_id, ban_notice(channel_name))])
+    user_bans_cache.pop(user_id)
 
 def get_channels():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT channel_id FROM channels")
-    channels = [row[0] for row in cur.fetchall()]
-    cur.close()
-    conn.close()
-    return channels
+    with db_cursor() as cur:
+        cur.execute("SELECT channel_id FROM channels")
+        return [row[0] for row in cur.fetchall()]
+
+def get_channels_info():
+    with db_cursor() as cur:
+        cur.execute("SELECT channel_id, chat_id, title, username, chat_type FROM channels")
+        return cur.fetchall()
+
+def update_channel_info(channel_id: str, chat_id: int, title: str, username: str, chat_type: str):
+    with db_cursor() as cur:
+        cur.execute(
+            "UPDATE channels SET chat_id = %s, title = %s, username = %s, chat_type = %s WHERE channel_id = %s",
+            (chat_id, title, username, chat_type, channel_id)
+        )
+
+def find_channel_id(chat_id: int, username: str = None):
+    with db_cursor() as cur:
+        cur.execute(
+            "SELECT channel_id FROM channels WHERE chat_id = %s OR channel_id = %s OR LOWER(channel_id) = LOWER(%s) LIMIT 1",
+            (chat_id, str(chat_id), f"@{username}" if username else None)
+        )
+        result = cur.fetchone()
+    return result[0] if result else None
 
 def get_channels_with_names():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT channel_id FROM channels")
-    channels = cur.fetchall()
-    cur.close()
-    conn.close()
+    with db_cursor() as cur:
+        cur.execute("SELECT channel_id FROM channels")
+        return cur.fetchall()
+
+def get_user_admin_channels(user_id: int) -> tuple:
+    channels = user_admin_channels_cache.get(user_id)
+    if channels is None:
+        with db_cursor() as cur:
+            cur.execute("SELECT channel_id FROM channel_admins WHERE user_id = %s", (user_id,))
+            channels = tuple(row[0] for row in cur.fetchall())
+        user_admin_channels_cache.set(user_id, channels)
     return channels
 
 def is_channel_admin(user_id: int, channel_id: str = None) -> bool:
-    conn = get_db_connection()
-    cur = conn.cursor()
+    channels = get_user_admin_channels(user_id)
     if channel_id:
-        cur.execute("SELECT user_id FROM channel_admins WHERE user_id = %s AND channel_id = %s", (user_id, channel_id))
-    else:
-        cur.execute("SELECT user_id FROM channel_admins WHERE user_id = %s", (user_id,))
-    result = cur.fetchone()
-    cur.close()
-    conn.close()
-    return result is not None
+        return channel_id in channels
+    return bool(channels)
 
 def get_user_channels(user_id: int):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT channel_id FROM channel_admins WHERE user_id = %s", (user_id,))
-    channels = [row[0] for row in cur.fetchall()]
-    cur.close()
-    conn.close()
-    return channels
+    return list(get_user_admin_channels(user_id))
 
-def get_channel_settings(channel_id: str):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT post_interval_minutes, max_posts_per_day, require_caption, allowed_media_types, spam_filter_enabled, last_post_time, allow_global_posts FROM channel_settings WHERE channel_id = %s", (channel_id,))
-    result = cur.fetchone()
-    cur.close()
-    conn.close()
+CHANNEL_SETTINGS_COLUMNS = (
+    "post_interval_minutes, max_posts_per_day, require_caption, allowed_media_types, spam_filter_enabled, "
+    "last_post_time, allow_global_posts, smart_mode, aggressiveness, auto_moderation"
+)
+
+# Настройки каналов: пишутся в БД и кэш одновременно (write-through)
+channel_settings_cache = TTLCache(SETTINGS_CACHE_TTL, SETTINGS_CACHE_SIZE)
+
+def channel_settings_from_row(result) -> dict:
     if result:
-        return {'interval': result[0], 'max_posts': result[1], 'require_caption': result[2], 'media_types': result[3], 'spam_filter': result[4], 'last_post': result[5], 'allow_global': result[6] if len(result) > 6 else True}
-    return {'interval': 0, 'max_posts': 0, 'require_caption': False, 'media_types': 'photo,video', 'spam_filter': True, 'last_post': None, 'allow_global': True}
+        return {
+            'interval': result[0], 'max_posts': result[1], 'require_caption': result[2], 'media_types': result[3],
+            'spam_filter': result[4], 'last_post': result[5], 'allow_global': result[6],
+            'smart_mode': bool(result[7]), 'aggressiveness': result[8] or 'medium', 'auto_moderation': bool(result[9])
+        }
+    return {
+        'interval': 0, 'max_posts': 0, 'require_caption': False, 'media_types': 'photo,video', 'spam_filter': True,
+        'last_post': None, 'allow_global': True, 'smart_mode': False, 'aggressiveness': 'medium', 'auto_moderation': False
+    }
 
-def update_channel_setting(channel_id: str, setting: str, value):
+def get_channel_settings(channel_id: str):
+    settings = channel_settings_cache.get(channel_id)
+    if settings is None:
+        with db_cursor() as cur:
+            cur.execute(f"SELECT {CHANNEL_SETTINGS_COLUMNS} FROM channel_settings WHERE channel_id = %s", (channel_id,))
+            settings = channel_settings_from_row(cur.fetchone())
+        channel_settings_cache.set(channel_id, settings)
+    return dict(settings)
+
+def write_channel_setting(cur, channel_id: str, setting: str, value) -> dict:
     ALLOWED_SETTINGS = {
         'post_interval_minutes', 'max_posts_per_day', 'require_caption',
         'spam_filter_enabled', 'allow_global_posts', 'smart_mode',
@@ -193,128 +880,509 @@ def update_channel_setting(channel_id: str, setting: str, value):
     }
     if setting not in ALLOWED_SETTINGS:
         raise ValueError(f"Invalid setting: {setting}")
-    conn = get_db_connection()
-    try:
-        cur = conn.cursor()
-        query = f"INSERT INTO channel_settings (channel_id, {setting}) VALUES (%s, %s) ON CONFLICT (channel_id) DO UPDATE SET {setting} = %s"
-        cur.execute(query, (channel_id, value, value))
-        conn.commit()
-    except Exception as e:
-        conn.rollback()
-        raise
-    finally:
-        cur.close()
-        conn.close()
+    query = (
+        f"INSERT INTO channel_settings (channel_id, {setting}) VALUES (%s, %s) ON CONFLICT (channel_id) DO UPDATE SET {setting} = %s "
+        f"RETURNING {CHANNEL_SETTINGS_COLUMNS}"
+    )
+    cur.execute(query, (channel_id, value, value))
+    return channel_settings_from_row(cur.fetchone())
 
-def add_scheduled_post(channel_id: str, user_id: int, username: str, photo_file_id: str, caption: str, scheduled_time):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("INSERT INTO scheduled_posts (channel_id, user_id, username, photo_file_id, caption, scheduled_time) VALUES (%s, %s, %s, %s, %s, %s)", (channel_id, user_id, username, photo_file_id, caption, scheduled_time))
-    conn.commit()
-    cur.close()
-    conn.close()
+def update_channel_setting(channel_id: str, setting: str, value):
+    with db_cursor() as cur:
+        settings = write_channel_setting(cur, channel_id, setting, value)
+    # Кэш обновляем только после коммита
+    channel_settings_cache.set(channel_id, settings)
 
 def get_scheduled_posts(channel_id: str = None):
     from datetime import datetime
-    conn = get_db_connection()
-    cur = conn.cursor()
-    if channel_id:
-        cur.execute("SELECT id, channel_id, user_id, username, photo_file_id, caption, scheduled_time FROM scheduled_posts WHERE channel_id = %s ORDER BY scheduled_time ASC", (channel_id,))
-    else:
-        now = datetime.now()
-        cur.execute("SELECT id, channel_id, user_id, username, photo_file_id, caption, scheduled_time FROM scheduled_posts WHERE scheduled_time <= %s ORDER BY scheduled_time ASC", (now,))
-    posts = cur.fetchall()
-    cur.close()
-    conn.close()
-    return posts
+    with db_cursor() as cur:
+        if channel_id:
+            cur.execute("SELECT id, channel_id, user_id, username, photo_file_id, caption, scheduled_time FROM scheduled_posts WHERE channel_id = %s ORDER BY scheduled_time ASC", (channel_id,))
+        else:
+            now = datetime.now()
+            cur.execute("SELECT id, channel_id, user_id, username, photo_file_id, caption, scheduled_time FROM scheduled_posts WHERE scheduled_time <= %s ORDER BY scheduled_time ASC", (now,))
+        return cur.fetchall()
 
-def remove_scheduled_post(post_id: int):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM scheduled_posts WHERE id = %s", (post_id,))
-    conn.commit()
-    cur.close()
-    conn.close()
+def get_scheduled_post_times():
+    with db_cursor() as cur:
+        cur.execute("SELECT id, scheduled_time FROM scheduled_posts WHERE scheduled_time IS NOT NULL")
+        return cur.fetchall()
 
-def log_action(channel_id: str, action: str, user_id: int, admin_id: int, post_id: int = None, details: str = ""):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("INSERT INTO audit_log (channel_id, action, user_id, admin_id, post_id, details) VALUES (%s, %s, %s, %s, %s, %s)", (channel_id, action, user_id, admin_id, post_id, details))
-    conn.commit()
-    cur.close()
-    conn.close()
+def claim_scheduled_posts(post_ids: list, now) -> tuple:
+    """Арендует наступившие посты из списка. Возвращает (арендованные, занятые): для постов, которые держит
+    другая реплика или которые перенесли, - когда проверить их снова (конец чужой аренды или новое время)"""
+    from datetime import timedelta
+    with db_cursor() as cur:
+        cur.execute(
+            "UPDATE scheduled_posts SET claimed_until = NOW() + %s * INTERVAL '1 second', claimed_by = %s WHERE id IN ("
+            "SELECT id FROM scheduled_posts WHERE id = ANY(%s) AND scheduled_time <= %s "
+            "AND (claimed_until IS NULL OR claimed_until < NOW()) FOR UPDATE SKIP LOCKED"
+            ") RETURNING id, channel_id, user_id, username, photo_file_id, caption, scheduled_time",
+            (SCHEDULER_CLAIM_LEASE, INSTANCE_ID, list(post_ids), now)
+        )
+        claimed = sorted(cur.fetchall(), key=lambda post: (post[6], post[0]))
+        cur.execute(
+            "SELECT id, scheduled_time, claimed_until FROM scheduled_posts WHERE id = ANY(%s) AND NOT id = ANY(%s)",
+            (list(post_ids), [post[0] for post in claimed])
+        )
+        busy = []
+        for post_id, scheduled_time, claimed_until in cur.fetchall():
+            retry_at = max(scheduled_time, claimed_until or scheduled_time)
+            # Строка заблокирована параллельной арендой - заглянем позже, а не сразу
+            busy.append((post_id, retry_at if retry_at > now else now + timedelta(seconds=SCHEDULER_RETRY_DELAY)))
+        return claimed, busy
 
-def add_published_post(channel_id: str, user_id: int, username: str, message_id: int):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO published_posts (channel_id, user_id, username, message_id) VALUES (%s, %s, %s, %s)",
-        (channel_id, user_id, username, message_id)
+def renew_scheduled_claim(post_id: int) -> bool:
+    # Продлеваем только свою аренду: если пост успела забрать другая реплика, публиковать его нельзя
+    with db_cursor() as cur:
+        cur.execute(
+            "UPDATE scheduled_posts SET claimed_until = NOW() + %s * INTERVAL '1 second' WHERE id = %s AND claimed_by = %s RETURNING id",
+            (SCHEDULER_CLAIM_LEASE, post_id, INSTANCE_ID)
+        )
+        return cur.fetchone() is not None
+
+def get_channel_pacing(channel_id: str):
+    # Интервал и время последнего поста прямо из БД: кэш настроек не видит публикаций других реплик
+    with db_cursor() as cur:
+        cur.execute("SELECT post_interval_minutes, last_post_time FROM channel_settings WHERE channel_id = %s", (channel_id,))
+        return cur.fetchone() or (0, None)
+
+def reschedule_post(post_id: int, scheduled_time):
+    with db_cursor() as cur:
+        # Чужую аренду не снимаем: пост уже публикует другая реплика
+        cur.execute(
+            "UPDATE scheduled_posts SET scheduled_time = %s, claimed_until = NULL, claimed_by = NULL "
+            "WHERE id = %s AND (claimed_by IS NULL OR claimed_by = %s)",
+            (scheduled_time, post_id, INSTANCE_ID)
+        )
+
+def in_quiet_hours(moment) -> bool:
+    if QUIET_HOURS_START <= QUIET_HOURS_END:
+        return QUIET_HOURS_START <= moment.hour < QUIET_HOURS_END
+    return moment.hour >= QUIET_HOURS_START or moment.hour < QUIET_HOURS_END
+
+class SlotAllocator:
+    """Раскладывает публикации канала по свободным слотам.
+    Держит отсортированный список занятых времен (запланированные и сегодняшние опубликованные посты)
+    и ищет ближайший слот с учетом интервала, дневного лимита и тихих часов бинарным поиском.
+    В умном режиме слоты берутся только в часы недели с высокой вовлеченностью"""
+
+    def __init__(self, ttl: float, maxsize: int):
+        self._slots = TTLCache(ttl, maxsize)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _load(cur, channel_id: str) -> list:
+        cur.execute(
+            "SELECT scheduled_time FROM scheduled_posts WHERE channel_id = %s AND scheduled_time IS NOT NULL "
+            "UNION ALL SELECT published_at FROM published_posts WHERE channel_id = %s AND published_at >= CURRENT_DATE "
+            "UNION ALL SELECT last_post_time FROM channel_settings WHERE channel_id = %s AND last_post_time < CURRENT_DATE",
+            (channel_id, channel_id, channel_id)
+        )
+        return sorted(row[0] for row in cur.fetchall())
+
+    @staticmethod
+    def _good_hours(scores: list, aggressiveness: str):
+        # Часы недели с вовлеченностью не ниже порога; тихие часы исключены заранее
+        from datetime import datetime, timedelta
+        monday = datetime(2024, 1, 1)
+        allowed = [not in_quiet_hours(monday + timedelta(hours=bucket)) for bucket in range(HOURS_PER_WEEK)]
+        candidates = [score for score, ok in zip(scores, allowed) if ok]
+        if not candidates:
+            return None
+        threshold = min(sum(scores) / len(scores) * ENGAGEMENT_THRESHOLDS.get(aggressiveness, 1.0), max(candidates))
+        return [ok and score >= threshold for score, ok in zip(scores, allowed)]
+
+    @staticmethod
+    def _next_free(times: list, moment, gap, quota: int, quiet: bool, good_hours: list = None):
+        from datetime import timedelta
+        while True:
+            if good_hours and not good_hours[hour_of_week(moment)]:
+                hour = moment.replace(minute=0, second=0, microsecond=0)
+                moment = next(
+                    hour + timedelta(hours=step) for step in range(1, HOURS_PER_WEEK + 1)
+                    if good_hours[hour_of_week(hour + timedelta(hours=step))]
+                )
+                continue
+            if quiet and in_quiet_hours(moment):
+                resume = moment.replace(hour=QUIET_HOURS_END, minute=0, second=0, microsecond=0)
+                moment = resume if resume > moment else resume + timedelta(days=1)
+                continue
+            if quota > 0:
+                day = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+                if bisect.bisect_left(times, day + timedelta(days=1)) - bisect.bisect_left(times, day) >= quota:
+                    moment = day + timedelta(days=1)
+                    continue
+            # Ближайшее занятое время после moment - gap не должно попадать в окно интервала
+            idx = bisect.bisect_right(times, moment - gap)
+            if idx < len(times) and times[idx] < moment + gap:
+                moment = times[idx] + gap
+                continue
+            return moment
+
+    def reserve(self, cur, channel_id: str, settings: dict, count: int = 1, gap_minutes: int = 0) -> list:
+        from datetime import timedelta
+        gap = timedelta(seconds=max(gap_minutes * 60, BULK_PUBLISH_SPACING))
+        quiet = bool(settings.get('smart_mode'))
+        good_hours = None
+        if quiet:
+            scores = get_engagement_scores(cur, channel_id)
+            if scores:
+                good_hours = self._good_hours(scores, settings.get('aggressiveness', 'medium'))
+        # Слоты из кэша могли устареть, если пост запланировала другая реплика. Блокировка канала держится
+        # до конца транзакции вызывающего, поэтому проверка и INSERT в scheduled_posts не разъезжаются
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", ('slots:' + str(channel_id),))
+        for attempt in range(2):
+            slots, known = self._allocate(cur, channel_id, settings, count, gap, quiet, good_hours)
+            if attempt or not self._stale(cur, channel_id, slots, known, gap):
+                return slots
+            logger.info(f"[SLOTS] Cached slots of {channel_id} are stale, reloading")
+            self.invalidate(channel_id)
+
+    def _allocate(self, cur, channel_id: str, settings: dict, count: int, gap, quiet: bool, good_hours: list):
+        from datetime import datetime
+        # Запрос к БД идет без блокировки; под ней только поиск по списку.
+        # Если другой поток успел загрузить канал раньше, берем его список, а свой выбрасываем
+        loaded = None
+        while True:
+            if loaded is None and self._slots.get(channel_id) is None:
+                loaded = self._load(cur, channel_id)
+            with self._lock:
+                times = self._slots.get(channel_id)
+                if times is None:
+                    if loaded is None:
+                        # Запись успела истечь между проверками: перечитываем вне блокировки
+                        continue
+                    times = loaded
+                    self._slots.set(channel_id, times)
+                known = set(times)
+                slots = []
+                moment = datetime.now()
+                for _ in range(count):
+                    moment = self._next_free(times, moment, gap, settings['max_posts'], quiet, good_hours)
+                    bisect.insort(times, moment)
+                    slots.append(moment)
+                return slots, known
+
+    @staticmethod
+    def _stale(cur, channel_id: str, slots: list, known: set, gap) -> bool:
+        # Все посты в БД вокруг выданных слотов (включая их сутки - для дневного лимита) должны быть в кэше
+        from datetime import timedelta
+        first, last = min(slots), max(slots)
+        start = min(first - gap, first.replace(hour=0, minute=0, second=0, microsecond=0))
+        end = max(last + gap, last.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1))
+        cur.execute(
+            "SELECT scheduled_time FROM scheduled_posts WHERE channel_id = %s AND scheduled_time >= %s AND scheduled_time < %s "
+            "UNION ALL SELECT published_at FROM published_posts WHERE channel_id = %s AND published_at >= %s AND published_at < %s",
+            (channel_id, start, end, channel_id, start, end)
+        )
+        return any(row[0] not in known for row in cur.fetchall())
+
+    def invalidate(self, channel_id: str):
+        # После неудачной публикации или переноса проще перечитать слоты из БД
+        self._slots.pop(channel_id)
+
+    @contextmanager
+    def guard(self, channel_id: str):
+        # Слоты попадают в кэш до коммита: если транзакция вызывающего откатилась, они никому не принадлежат
+        try:
+            yield
+        except Exception:
+            self.invalidate(channel_id)
+            raise
+
+slot_allocator = SlotAllocator(SLOT_CACHE_TTL, SLOT_CACHE_SIZE)
+
+def publish_gap(cur, channel_id: str, settings: dict) -> int:
+    # Минимальный промежуток между постами в минутах: интервал канала, в умном режиме не меньше расчетного
+    gap = settings['interval']
+    if settings.get('smart_mode'):
+        gap = max(gap, calculate_smart_interval(channel_id, cur.connection, settings.get('aggressiveness', 'medium')))
+    return gap
+
+def schedule_skip_post(channel_id: str, user_id: int, username: str, photo_file_id: str, caption: str):
+    """«🎫 Пропуск»: списание покупки, слот и запись в scheduled_posts одной транзакцией,
+    чтобы сбой на любом шаге не сжег покупку. Возвращает (id, время) или None, если пропуска нет"""
+    settings = get_channel_settings(channel_id)
+    with slot_allocator.guard(channel_id), db_cursor() as cur:
+        if not consume_shop_item(cur, user_id, 'skip'):
+            return None
+        publish_at = slot_allocator.reserve(cur, channel_id, settings, 1, publish_gap(cur, channel_id, settings))[0]
+        cur.execute(
+            "INSERT INTO scheduled_posts (channel_id, user_id, username, photo_file_id, caption, scheduled_time) VALUES (%s, %s, %s, %s, %s, %s) RETURNING id",
+            (channel_id, user_id, username, photo_file_id, caption, publish_at)
+        )
+        scheduled_id = cur.fetchone()[0]
+        cur.execute(
+            "INSERT INTO audit_log (channel_id, action, user_id, admin_id, post_id, details) VALUES (%s, %s, %s, %s, %s, %s)",
+            (channel_id, 'skip_moderation', user_id, 0, scheduled_id, f"Scheduled for {publish_at}")
+        )
+    return scheduled_id, publish_at
+
+def load_user_states(max_age_days: int) -> list:
+    with db_cursor() as cur:
+        # Брошенные на полпути диалоги старше max_age_days не восстанавливаем
+        cur.execute("DELETE FROM user_state WHERE updated_at < NOW() - %s * INTERVAL '1 day'", (max_age_days,))
+        cur.execute("SELECT user_id, version, data::text FROM user_state")
+        return cur.fetchall()
+
+def get_user_state(user_id: int, known_version: int):
+    with db_cursor() as cur:
+        cur.execute("SELECT version, data::text FROM user_state WHERE user_id = %s AND version > %s", (user_id, known_version))
+        return cur.fetchone()
+
+def save_user_states(rows: list, deleted: list) -> dict:
+    # rows - список (user_id, json); возвращает новые версии записанных строк
+    versions = {}
+    with db_cursor() as cur:
+        if rows:
+            for user_id, version in psycopg2.extras.execute_values(
+                cur,
+                "INSERT INTO user_state (user_id, data) VALUES %s "
+                "ON CONFLICT (user_id) DO UPDATE SET data = EXCLUDED.data, "
+                "version = user_state.version + 1, updated_at = CURRENT_TIMESTAMP "
+                "RETURNING user_id, version",
+                rows, template="(%s, %s::jsonb)", page_size=len(rows), fetch=True
+            ):
+                versions[user_id] = version
+        if deleted:
+            cur.execute("DELETE FROM user_state WHERE user_id = ANY(%s)", (deleted,))
+    return versions
+
+REJECT_NOTICE = "😔 Ваш контент не прошел модерацию."
+
+def ban_notice(channel_name: str) -> str:
+    return f"🚫 Вы заблокированы в канале '{channel_name}' и больше не можете отправлять туда контент."
+
+def enqueue_notifications(cur, rows: list):
+    # rows - список (user_id, text); доставку делает NotificationOutbox после коммита
+    if not rows:
+        return
+    psycopg2.extras.execute_values(
+        cur, "INSERT INTO notification_outbox (user_id, text) VALUES %s", rows, page_size=len(rows)
     )
-    conn.commit()
-    cur.close()
-    conn.close()
 
-def update_post_reactions(channel_id: str, message_id: int, reactions: int):
-    conn = get_db_connection()
-    cur = conn.cursor()
+def count_notifications():
+    with db_cursor() as cur:
+        cur.execute("SELECT COUNT(*) FILTER (WHERE status = 'pending'), COUNT(*) FILTER (WHERE status = 'dead') FROM notification_outbox")
+        return cur.fetchone()
+
+def claim_notifications(limit: int) -> list:
+    # Сдвигаем next_attempt_at на время аренды: если процесс упадет до отметки, запись вернется в работу
+    with db_cursor() as cur:
+        cur.execute(
+            "UPDATE notification_outbox SET next_attempt_at = NOW() + %s * INTERVAL '1 second' WHERE id IN ("
+            "SELECT id FROM notification_outbox WHERE status = 'pending' AND next_attempt_at <= NOW() "
+            "ORDER BY next_attempt_at, id LIMIT %s FOR UPDATE SKIP LOCKED"
+            ") RETURNING id, user_id, text",
+            (OUTBOX_LEASE, limit)
+        )
+        return sorted(cur.fetchall())
+
+def complete_notifications(sent_ids: list, failures: list) -> int:
+    """Удаляет доставленные записи, неудачным назначает повтор с экспоненциальной задержкой.
+    failures - список (id, error, permanent). Возвращает число записей, ушедших в dead"""
+    with db_cursor() as cur:
+        if sent_ids:
+            cur.execute("DELETE FROM notification_outbox WHERE id = ANY(%s)", (sent_ids,))
+        if not failures:
+            return 0
+        dead = psycopg2.extras.execute_values(
+            cur,
+            "UPDATE notification_outbox o SET attempts = o.attempts + 1, last_error = v.error, "
+            f"status = CASE WHEN v.permanent OR o.attempts + 1 >= {OUTBOX_MAX_ATTEMPTS} THEN 'dead' ELSE 'pending' END, "
+            "next_attempt_at = NOW() + LEAST(30 * POWER(2, o.attempts), 3600) * INTERVAL '1 second' "
+            "FROM (VALUES %s) AS v(id, error, permanent) WHERE o.id = v.id RETURNING o.status",
+            failures, page_size=len(failures), fetch=True
+        )
+        return sum(1 for (status,) in dead if status == 'dead')
+
+def set_post_reactions(cur, reactions: int, message_id: int, channel_id: str = None) -> int:
+    # Переносим разницу реакций в user_stats, чтобы не пересчитывать SUM по всем постам
     cur.execute(
-        "UPDATE published_posts SET reactions = %s WHERE channel_id = %s AND message_id = %s",
-        (reactions, channel_id, message_id)
+        "UPDATE published_posts p SET reactions = %s FROM ("
+        "SELECT id, reactions FROM published_posts WHERE message_id = %s AND (%s IS NULL OR channel_id = %s) FOR UPDATE"
+        ") old WHERE p.id = old.id RETURNING p.channel_id, p.user_id, p.reactions - COALESCE(old.reactions, 0), p.published_at",
+        (reactions, message_id, channel_id, channel_id)
     )
-    conn.commit()
-    cur.close()
-    conn.close()
+    rows = cur.fetchall()
+    for post_channel_id, user_id, delta, _ in rows:
+        if delta:
+            bump_user_stats(cur, user_id, reactions=delta)
+            bump_leaderboard(cur, post_channel_id, user_id, reactions=delta)
+    bump_engagement_rows(cur, [(post_channel_id, published_at, 0, delta) for post_channel_id, _, delta, published_at in rows])
+    return len(rows)
 
-def get_global_leaderboard(limit: int = 10):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT user_id, username, COUNT(*) as posts, COALESCE(SUM(reactions), 0) as total_reactions "
-        "FROM published_posts GROUP BY user_id, username ORDER BY total_reactions DESC, posts DESC LIMIT %s",
-        (limit,)
+def update_post_reactions(updates: list) -> int:
+    """Пакетно выставляет реакции: updates - список (channel_id, message_id, reactions)"""
+    if not updates:
+        return 0
+    with db_cursor() as cur:
+        rows = psycopg2.extras.execute_values(
+            cur,
+            "SELECT p.id, p.channel_id, p.user_id, COALESCE(p.reactions, 0), v.reactions, p.published_at "
+            "FROM published_posts p JOIN (VALUES %s) AS v(channel_id, message_id, reactions) "
+            "ON p.channel_id = v.channel_id AND p.message_id = v.message_id FOR UPDATE OF p",
+            updates, page_size=len(updates), fetch=True
+        )
+        changed = [(post_id, new) for post_id, _, _, old, new, _ in rows if new != old]
+        if not changed:
+            return 0
+        psycopg2.extras.execute_values(
+            cur,
+            "UPDATE published_posts p SET reactions = v.reactions FROM (VALUES %s) AS v(id, reactions) WHERE p.id = v.id",
+            changed, page_size=len(changed)
+        )
+        
+        # Сводим дельты по авторам, чтобы обновить счетчики одним запросом на таблицу
+        user_deltas = {}
+        scope_deltas = {}
+        engagement_rows = []
+        for _, channel_id, user_id, old, new, published_at in rows:
+            if new == old:
+                continue
+            user_deltas[user_id] = user_deltas.get(user_id, 0) + new - old
+            scope_deltas[(channel_id, user_id)] = scope_deltas.get((channel_id, user_id), 0) + new - old
+            engagement_rows.append((channel_id, published_at, 0, new - old))
+        psycopg2.extras.execute_values(
+            cur,
+            "UPDATE user_stats s SET reactions = s.reactions + v.delta, updated_at = CURRENT_TIMESTAMP "
+            "FROM (VALUES %s) AS v(user_id, delta) WHERE s.user_id = v.user_id",
+            list(user_deltas.items())
+        )
+        leaderboard_rows = []
+        for user_id, delta in user_deltas.items():
+            leaderboard_rows.append((GLOBAL_SCOPE, user_id, None, 0, delta))
+        for (channel_id, user_id), delta in scope_deltas.items():
+            leaderboard_rows.append((channel_id, user_id, None, 0, delta))
+        bump_leaderboard_rows(cur, leaderboard_rows)
+        bump_engagement_rows(cur, engagement_rows)
+    return len(changed)
+
+# Пустой scope - глобальная таблица лидеров, иначе ID канала
+GLOBAL_SCOPE = ''
+
+def bump_leaderboard_rows(cur, rows: list):
+    # rows - список (scope, user_id, username, posts, reactions) с приращениями
+    if not rows:
+        return
+    psycopg2.extras.execute_values(
+        cur,
+        "INSERT INTO leaderboard_scores (scope, user_id, username, posts, reactions) VALUES %s "
+        "ON CONFLICT (scope, user_id) DO UPDATE SET "
+        "username = COALESCE(EXCLUDED.username, leaderboard_scores.username), "
+        "posts = leaderboard_scores.posts + EXCLUDED.posts, "
+        "reactions = leaderboard_scores.reactions + EXCLUDED.reactions",
+        rows, page_size=len(rows)
     )
-    result = cur.fetchall()
-    cur.close()
-    conn.close()
-    return result
 
-def get_channel_leaderboard(channel_id: str, limit: int = 10):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT user_id, username, COUNT(*) as posts, COALESCE(SUM(reactions), 0) as total_reactions "
-        "FROM published_posts WHERE channel_id = %s GROUP BY user_id, username ORDER BY total_reactions DESC, posts DESC LIMIT %s",
-        (channel_id, limit)
+def bump_leaderboard(cur, channel_id: str, user_id: int, username: str = None, posts: int = 0, reactions: int = 0):
+    bump_leaderboard_rows(cur, [(GLOBAL_SCOPE, user_id, username, posts, reactions), (channel_id, user_id, username, posts, reactions)])
+
+# 168 корзин: день недели (пн = 0) * 24 + час публикации
+HOURS_PER_WEEK = 168
+# Вес априорного среднего: корзины с парой постов не перетягивают расписание
+ENGAGEMENT_PRIOR_POSTS = 3
+# Порог «хорошего» часа относительно среднего по каналу
+ENGAGEMENT_THRESHOLDS = {'conservative': 1.2, 'medium': 1.0, 'aggressive': 0.7}
+
+engagement_cache = TTLCache(ENGAGEMENT_CACHE_TTL, SETTINGS_CACHE_SIZE)
+
+def hour_of_week(moment) -> int:
+    return moment.weekday() * 24 + moment.hour
+
+def bump_engagement_rows(cur, rows: list):
+    # rows - список (channel_id, published_at, posts, reactions) с приращениями
+    deltas = {}
+    for channel_id, published_at, posts, reactions in rows:
+        if published_at is None or not (posts or reactions):
+            continue
+        channel_posts, channel_reactions = deltas.setdefault(channel_id, ([0] * HOURS_PER_WEEK, [0] * HOURS_PER_WEEK))
+        bucket = hour_of_week(published_at)
+        channel_posts[bucket] += posts
+        channel_reactions[bucket] += reactions
+    if not deltas:
+        return
+    psycopg2.extras.execute_values(
+        cur,
+        "INSERT INTO channel_engagement AS e (channel_id, posts, reactions) VALUES %s "
+        "ON CONFLICT (channel_id) DO UPDATE SET "
+        "posts = ARRAY(SELECT a + b FROM unnest(e.posts, EXCLUDED.posts) WITH ORDINALITY AS t(a, b, i) ORDER BY i), "
+        "reactions = ARRAY(SELECT a + b FROM unnest(e.reactions, EXCLUDED.reactions) WITH ORDINALITY AS t(a, b, i) ORDER BY i), "
+        "updated_at = CURRENT_TIMESTAMP",
+        [(channel_id, posts, reactions) for channel_id, (posts, reactions) in deltas.items()],
+        page_size=len(deltas)
     )
-    result = cur.fetchall()
-    cur.close()
-    conn.close()
-    return result
 
-def add_coins(user_id: int, username: str, amount: int, reason: str):
-    conn = get_db_connection()
-    cur = conn.cursor()
+def get_engagement_scores(cur, channel_id: str):
+    """Средние реакции на пост по часам недели (со сглаживанием к среднему канала).
+    None, пока у канала слишком мало публикаций"""
+    scores = engagement_cache.get(channel_id)
+    if scores is None:
+        cur.execute("SELECT posts, reactions FROM channel_engagement WHERE channel_id = %s", (channel_id,))
+        row = cur.fetchone()
+        scores = []
+        if row and sum(row[0]) >= ENGAGEMENT_MIN_POSTS:
+            posts, reactions = row
+            mean = sum(reactions) / sum(posts)
+            scores = [
+                (bucket_reactions + mean * ENGAGEMENT_PRIOR_POSTS) / (bucket_posts + ENGAGEMENT_PRIOR_POSTS)
+                for bucket_posts, bucket_reactions in zip(posts, reactions)
+            ]
+        engagement_cache.set(channel_id, scores)
+    return scores or None
+
+def get_leaderboard(scope: str, limit: int = 10):
+    with db_cursor() as cur:
+        cur.execute(
+            "SELECT user_id, username, posts, reactions FROM leaderboard_scores WHERE scope = %s "
+            "ORDER BY reactions DESC, posts DESC, user_id ASC LIMIT %s",
+            (scope, limit)
+        )
+        return cur.fetchall()
+
+def get_global_leaderboard(limit: int = 10):
+    return get_leaderboard(GLOBAL_SCOPE, limit)
+
+def get_channel_leaderboard(channel_id: str, limit: int = 10):
+    return get_leaderboard(channel_id, limit)
+
+def get_leaderboard_position(user_id: int, scope: str = GLOBAL_SCOPE):
+    """Место пользователя в таблице лидеров (None, если у него нет публикаций)"""
+    with db_cursor() as cur:
+        cur.execute("SELECT posts, reactions FROM leaderboard_scores WHERE scope = %s AND user_id = %s", (scope, user_id))
+        result = cur.fetchone()
+        if not result:
+            return None
+        posts, reactions = result
+        # Диапазонный проход по индексу (scope, reactions DESC, posts DESC, user_id) до позиции пользователя
+        cur.execute(
+            "SELECT COUNT(*) FROM leaderboard_scores WHERE scope = %s AND ("
+            "reactions > %s OR (reactions = %s AND posts > %s) OR (reactions = %s AND posts = %s AND user_id < %s))",
+            (scope, reactions, reactions, posts, reactions, posts, user_id)
+        )
+        return cur.fetchone()[0] + 1
+
+def credit_coins(cur, user_id: int, username: str, awards: list):
+    # Одно обновление баланса и одна вставка в историю на все начисления
+    if not awards:
+        return
+    total = sum(amount for amount, _ in awards)
     cur.execute(
         "INSERT INTO user_coins (user_id, username, balance, total_earned) VALUES (%s, %s, %s, %s) "
         "ON CONFLICT (user_id) DO UPDATE SET balance = user_coins.balance + %s, total_earned = user_coins.total_earned + %s, username = %s, updated_at = CURRENT_TIMESTAMP",
-        (user_id, username, amount, amount, amount, amount, username)
+        (user_id, username, total, total, total, total, username)
     )
-    cur.execute(
-        "INSERT INTO coin_transactions (user_id, amount, reason) VALUES (%s, %s, %s)",
-        (user_id, amount, reason)
+    psycopg2.extras.execute_values(
+        cur,
+        "INSERT INTO coin_transactions (user_id, amount, reason) VALUES %s",
+        [(user_id, amount, reason) for amount, reason in awards]
     )
-    conn.commit()
-    cur.close()
-    conn.close()
 
 def get_user_balance(user_id: int):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT balance, total_earned FROM user_coins WHERE user_id = %s", (user_id,))
-    result = cur.fetchone()
-    cur.close()
-    conn.close()
+    with db_cursor() as cur:
+        cur.execute("SELECT balance, total_earned FROM user_coins WHERE user_id = %s", (user_id,))
+        result = cur.fetchone()
     return result if result else (0, 0)
 
 def get_user_rank(posts_count: int):
@@ -329,56 +1397,47 @@ def get_user_rank(posts_count: int):
     else:
         return "🥚 Новичок"
 
-def check_and_award_achievements(user_id: int, username: str, posts_count: int):
-    achievements = []
-    if posts_count == 1:
-        add_coins(user_id, username, 20, "🔥 Достижение: Первая кровь")
-        achievements.append("🔥 Первая кровь (+20 монет)")
-    elif posts_count == 10:
-        add_coins(user_id, username, 50, "💯 Достижение: Десятка")
-        achievements.append("💯 Десятка (+50 монет)")
-    elif posts_count == 50:
-        add_coins(user_id, username, 200, "🎊 Достижение: Полтинник")
-        achievements.append("🎊 Полтинник (+200 монет)")
-    elif posts_count == 100:
-        add_coins(user_id, username, 500, "👑 Достижение: Легенда")
-        achievements.append("👑 Легенда (+500 монет)")
-    return achievements
+ACHIEVEMENTS = {
+    1: (20, "🔥 Достижение: Первая кровь", "🔥 Первая кровь (+20 монет)"),
+    10: (50, "💯 Достижение: Десятка", "💯 Десятка (+50 монет)"),
+    50: (200, "🎊 Достижение: Полтинник", "🎊 Полтинник (+200 монет)"),
+    100: (500, "👑 Достижение: Легенда", "👑 Легенда (+500 монет)"),
+}
+
+def achievement_awards(posts_count: int):
+    # Возвращает начисления и подписи достижений, не трогая БД
+    if posts_count not in ACHIEVEMENTS:
+        return [], []
+    amount, reason, label = ACHIEVEMENTS[posts_count]
+    return [(amount, reason)], [label]
 
 def spend_coins(user_id: int, amount: int, reason: str) -> bool:
-    conn = get_db_connection()
     try:
-        cur = conn.cursor()
-        cur.execute(
-            "UPDATE user_coins SET balance = balance - %s "
-            "WHERE user_id = %s AND balance >= %s RETURNING balance",
-            (amount, user_id, amount)
-        )
-        result = cur.fetchone()
-        if not result:
-            conn.rollback()
-            return False
-        cur.execute(
-            "INSERT INTO coin_transactions (user_id, amount, reason) VALUES (%s, %s, %s)",
-            (user_id, -amount, reason)
-        )
-        conn.commit()
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "UPDATE user_coins SET balance = balance - %s "
+                    "WHERE user_id = %s AND balance >= %s RETURNING balance",
+                    (amount, user_id, amount)
+                )
+                if not cur.fetchone():
+                    conn.rollback()
+                    return False
+                cur.execute(
+                    "INSERT INTO coin_transactions (user_id, amount, reason) VALUES (%s, %s, %s)",
+                    (user_id, -amount, reason)
+                )
         return True
     except Exception as e:
-        conn.rollback()
         logger.error(f"Error spending coins: {e}")
         return False
-    finally:
-        cur.close()
-        conn.close()
 
-def update_streak(user_id: int, username: str):
+def apply_streak(cur, user_id: int, username: str) -> list:
     from datetime import date, timedelta
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT current_streak, longest_streak, last_post_date FROM user_streaks WHERE user_id = %s", (user_id,))
+    cur.execute("SELECT current_streak, longest_streak, last_post_date FROM user_streaks WHERE user_id = %s FOR UPDATE", (user_id,))
     result = cur.fetchone()
     today = date.today()
+    awards = []
     
     if not result:
         cur.execute("INSERT INTO user_streaks (user_id, username, current_streak, longest_streak, last_post_date) VALUES (%s, %s, 1, 1, %s)", (user_id, username, today))
@@ -391,125 +1450,199 @@ def update_streak(user_id: int, username: str):
             longest = max(longest, current)
             cur.execute("UPDATE user_streaks SET current_streak = %s, longest_streak = %s, last_post_date = %s WHERE user_id = %s", (current, longest, today, user_id))
             if current == 7:
-                add_coins(user_id, username, 50, "🔥 Стрик 7 дней")
+                awards.append((50, "🔥 Стрик 7 дней"))
             elif current == 30:
-                add_coins(user_id, username, 300, "🔥 Стрик 30 дней")
+                awards.append((300, "🔥 Стрик 30 дней"))
         else:
             cur.execute("UPDATE user_streaks SET current_streak = 1, last_post_date = %s WHERE user_id = %s", (today, user_id))
-    conn.commit()
-    cur.close()
-    conn.close()
+    return awards
 
 def get_streak(user_id: int):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT current_streak, longest_streak FROM user_streaks WHERE user_id = %s", (user_id,))
-    result = cur.fetchone()
-    cur.close()
-    conn.close()
+    with db_cursor() as cur:
+        cur.execute("SELECT current_streak, longest_streak FROM user_streaks WHERE user_id = %s", (user_id,))
+        result = cur.fetchone()
     return result if result else (0, 0)
 
-def check_daily_quests(user_id: int, username: str):
+DAILY_QUESTS = [
+    ('post_1', 10, "✅ Задание: 1 мем"),
+    ('post_3', 30, "✅ Задание: 3 мема"),
+    ('post_5', 50, "✅ Задание: 5 мемов"),
+    ('streak_3', 100, "✅ Задание: Стрик 3 дня"),
+    ('open_lootbox', 20, "✅ Задание: Открыть лутбокс"),
+]
+
+def apply_daily_quests(cur, user_id: int, posts_today: int = None) -> list:
     from datetime import date
-    conn = get_db_connection()
-    cur = conn.cursor()
     today = date.today()
     
     cur.execute("SELECT quest_type, completed FROM daily_quests WHERE user_id = %s AND quest_date = %s", (user_id, today))
     quests = {row[0]: row[1] for row in cur.fetchall()}
     
     if not quests:
-        cur.execute("INSERT INTO daily_quests (user_id, quest_date, quest_type, reward) VALUES (%s, %s, 'post_1', 10)", (user_id, today))
-        cur.execute("INSERT INTO daily_quests (user_id, quest_date, quest_type, reward) VALUES (%s, %s, 'post_3', 30)", (user_id, today))
-        cur.execute("INSERT INTO daily_quests (user_id, quest_date, quest_type, reward) VALUES (%s, %s, 'post_5', 50)", (user_id, today))
-        cur.execute("INSERT INTO daily_quests (user_id, quest_date, quest_type, reward) VALUES (%s, %s, 'streak_3', 100)", (user_id, today))
-        cur.execute("INSERT INTO daily_quests (user_id, quest_date, quest_type, reward) VALUES (%s, %s, 'open_lootbox', 20)", (user_id, today))
-        quests = {'post_1': False, 'post_3': False, 'post_5': False, 'streak_3': False, 'open_lootbox': False}
-    
-    cur.execute("SELECT COUNT(*) FROM published_posts WHERE user_id = %s AND DATE(published_at) = %s", (user_id, today))
-    posts_today = cur.fetchone()[0]
-    
-    if posts_today >= 1 and not quests.get('post_1'):
-        cur.execute("UPDATE daily_quests SET completed = TRUE, completed_at = CURRENT_TIMESTAMP WHERE user_id = %s AND quest_date = %s AND quest_type = 'post_1'", (user_id, today))
-        add_coins(user_id, username, 10, "✅ Задание: 1 мем")
-    
-    if posts_today >= 3 and not quests.get('post_3'):
-        cur.execute("UPDATE daily_quests SET completed = TRUE, completed_at = CURRENT_TIMESTAMP WHERE user_id = %s AND quest_date = %s AND quest_type = 'post_3'", (user_id, today))
-        add_coins(user_id, username, 30, "✅ Задание: 3 мема")
-    
-    if posts_today >= 5 and not quests.get('post_5'):
-        cur.execute("UPDATE daily_quests SET completed = TRUE, completed_at = CURRENT_TIMESTAMP WHERE user_id = %s AND quest_date = %s AND quest_type = 'post_5'", (user_id, today))
-        add_coins(user_id, username, 50, "✅ Задание: 5 мемов")
+        psycopg2.extras.execute_values(
+            cur,
+            "INSERT INTO daily_quests (user_id, quest_date, quest_type, reward) VALUES %s",
+            [(user_id, today, quest_type, reward) for quest_type, reward, _ in DAILY_QUESTS]
+        )
+        quests = {quest_type: False for quest_type, _, _ in DAILY_QUESTS}
     
+    if posts_today is None:
+        posts_today = get_user_stats(user_id, cur)['posts_today']
     cur.execute("SELECT current_streak FROM user_streaks WHERE user_id = %s", (user_id,))
     streak_result = cur.fetchone()
-    if streak_result and streak_result[0] >= 3 and not quests.get('streak_3'):
-        cur.execute("UPDATE daily_quests SET completed = TRUE, completed_at = CURRENT_TIMESTAMP WHERE user_id = %s AND quest_date = %s AND quest_type = 'streak_3'", (user_id, today))
-        add_coins(user_id, username, 100, "✅ Задание: Стрик 3 дня")
+    streak = streak_result[0] if streak_result else 0
     
-    conn.commit()
-    cur.close()
-    conn.close()
+    progress = {'post_1': posts_today >= 1, 'post_3': posts_today >= 3, 'post_5': posts_today >= 5, 'streak_3': streak >= 3}
+    done = [(quest_type, reward, reason) for quest_type, reward, reason in DAILY_QUESTS
+            if progress.get(quest_type) and not quests.get(quest_type)]
+    if done:
+        cur.execute(
+            "UPDATE daily_quests SET completed = TRUE, completed_at = CURRENT_TIMESTAMP WHERE user_id = %s AND quest_date = %s AND quest_type = ANY(%s)",
+            (user_id, today, [quest_type for quest_type, _, _ in done])
+        )
+    return [(reward, reason) for _, reward, reason in done]
+
+def check_daily_quests(user_id: int, username: str):
+    with db_cursor() as cur:
+        credit_coins(cur, user_id, username, apply_daily_quests(cur, user_id))
+
+def record_publication(channel_id: str, user_id: int, username: str, message_id: int, admin_id: int,
+                       pending_post_id: int = None, scheduled_post_id: int = None,
+                       action: str = 'published', details: str = "", channel_title: str = None) -> dict:
+    """Вся бухгалтерия после публикации одной транзакцией: пост, монеты, стрик, задания, достижения,
+    лог и уведомление автору"""
+    from datetime import datetime
+    with db_cursor() as cur:
+        cur.execute(
+            "INSERT INTO published_posts (channel_id, user_id, username, message_id) VALUES (%s, %s, %s, %s) RETURNING published_at",
+            (channel_id, user_id, username, message_id)
+        )
+        bump_engagement_rows(cur, [(channel_id, cur.fetchone()[0], 1, 0)])
+        if pending_post_id is not None:
+            delete_pending_post(cur, pending_post_id)
+        posts_count, posts_today = bump_user_stats(cur, user_id, username, published=1)
+        bump_leaderboard(cur, channel_id, user_id, username, posts=1)
+        
+        awards = [(10, "Мем опубликован")]
+        awards += apply_streak(cur, user_id, username)
+        awards += apply_daily_quests(cur, user_id, posts_today)
+        
+        achievement_coins, achievements = achievement_awards(posts_count)
+        awards += achievement_coins
+        credit_coins(cur, user_id, username, awards)
+        
+        settings = write_channel_setting(cur, channel_id, 'last_post_time', datetime.now())
+        if scheduled_post_id is not None:
+            cur.execute("DELETE FROM scheduled_posts WHERE id = %s", (scheduled_post_id,))
+        cur.execute(
+            "INSERT INTO audit_log (channel_id, action, user_id, admin_id, post_id, details) VALUES (%s, %s, %s, %s, %s, %s)",
+            (channel_id, action, user_id, admin_id, pending_post_id if pending_post_id is not None else scheduled_post_id, details)
+        )
+        rank = get_user_rank(posts_count)
+        notif = f"🎉 Ваш контент опубликован{f' в {channel_title}' if channel_title else ''}!\n💰 +10 мемкоинов\n{rank} | Мемов: {posts_count}"
+        if achievements:
+            notif += "\n\n🏆 " + "\n🏆 ".join(achievements)
+        enqueue_notifications(cur, [(user_id, notif)])
+    channel_settings_cache.set(channel_id, settings)
+    return {'posts_count': posts_count, 'rank': rank, 'achievements': achievements}
 
 def get_daily_quests(user_id: int):
     from datetime import date
-    conn = get_db_connection()
-    cur = conn.cursor()
-    today = date.today()
-    cur.execute("SELECT quest_type, completed, reward FROM daily_quests WHERE user_id = %s AND quest_date = %s", (user_id, today))
-    quests = cur.fetchall()
-    cur.close()
-    conn.close()
-    return quests
+    with db_cursor() as cur:
+        today = date.today()
+        cur.execute("SELECT quest_type, completed, reward FROM daily_quests WHERE user_id = %s AND quest_date = %s", (user_id, today))
+        return cur.fetchall()
 
 def buy_shop_item(user_id: int, username: str, item_type: str, cost: int, duration_hours: int = 0):
     from datetime import datetime, timedelta
     if not spend_coins(user_id, cost, f"🛒 Покупка: {item_type}"):
         return False
-    conn = get_db_connection()
-    cur = conn.cursor()
-    expires = datetime.now() + timedelta(hours=duration_hours) if duration_hours > 0 else None
-    cur.execute("INSERT INTO shop_purchases (user_id, username, item_type, cost, expires_at) VALUES (%s, %s, %s, %s, %s)", (user_id, username, item_type, cost, expires))
-    conn.commit()
-    cur.close()
-    conn.close()
+    with db_cursor() as cur:
+        expires = datetime.now() + timedelta(hours=duration_hours) if duration_hours > 0 else None
+        cur.execute("INSERT INTO shop_purchases (user_id, username, item_type, cost, expires_at) VALUES (%s, %s, %s, %s, %s)", (user_id, username, item_type, cost, expires))
     return True
 
-def has_active_item(user_id: int, item_type: str):
-    from datetime import datetime
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT id FROM shop_purchases WHERE user_id = %s AND item_type = %s AND used = FALSE AND (expires_at IS NULL OR expires_at > %s)", (user_id, item_type, datetime.now()))
-    result = cur.fetchone()
-    cur.close()
-    conn.close()
-    return result is not None
+def consume_shop_item(cur, user_id: int, item_type: str) -> bool:
+    # Списываем одну действующую покупку; SKIP LOCKED не дает двум отправкам потратить ее дважды
+    cur.execute(
+        "UPDATE shop_purchases SET used = TRUE WHERE id = ("
+        "SELECT id FROM shop_purchases WHERE user_id = %s AND item_type = %s AND used = FALSE "
+        "AND (expires_at IS NULL OR expires_at > NOW()) ORDER BY id LIMIT 1 FOR UPDATE SKIP LOCKED"
+        ") RETURNING id",
+        (user_id, item_type)
+    )
+    return cur.fetchone() is not None
 
-def use_shop_item(user_id: int, item_type: str):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("UPDATE shop_purchases SET used = TRUE WHERE user_id = %s AND item_type = %s AND used = FALSE LIMIT 1", (user_id, item_type))
-    conn.commit()
-    cur.close()
-    conn.close()
+def get_audit_log(channel_id: str, limit: int = 50):
+    with db_cursor() as cur:
+        cur.execute("SELECT action, user_id, admin_id, details, created_at FROM audit_log WHERE channel_id = %s ORDER BY created_at DESC LIMIT %s", (channel_id, limit))
+        return cur.fetchall()
+
+def is_channel_creator(user_id: int, channel_id: str) -> bool:
+    with db_cursor() as cur:
+        cur.execute("SELECT added_by FROM channels WHERE channel_id = %s", (channel_id,))
+        result = cur.fetchone()
+    return result and result[0] == user_id
+
+def get_global_stats():
+    with db_cursor() as cur:
+        cur.execute("SELECT COUNT(*) FROM channels")
+        total_channels = cur.fetchone()[0]
+        
+        cur.execute("SELECT COUNT(DISTINCT user_id) FROM channel_admins")
+        total_admins = cur.fetchone()[0]
+        
+        cur.execute("SELECT COUNT(*) FROM pending_posts")
+        total_pending = cur.fetchone()[0]
+        
+        cur.execute("SELECT COUNT(*) FROM banned_users")
+        total_banned = cur.fetchone()[0]
+        
+        cur.execute("SELECT COUNT(*) FROM audit_log WHERE action = 'published'")
+        total_published = cur.fetchone()[0]
+        
+        cur.execute("SELECT COUNT(*) FROM audit_log WHERE action = 'rejected'")
+        total_rejected = cur.fetchone()[0]
+    return total_channels, total_admins, total_pending, total_banned, total_published, total_rejected
+
+def get_channels_stats(channel_ids: list):
+    with db_cursor() as cur:
+        placeholders = ','.join(['%s'] * len(channel_ids))
+        cur.execute(f"SELECT COUNT(*) FROM pending_posts WHERE channel_id IN ({placeholders})", channel_ids)
+        pending_count = cur.fetchone()[0]
+        
+        cur.execute(f"SELECT COUNT(*) FROM banned_users WHERE channel_id IN ({placeholders})", channel_ids)
+        banned_count = cur.fetchone()[0]
+        
+        cur.execute(f"SELECT COUNT(*) FROM audit_log WHERE channel_id IN ({placeholders}) AND action = 'published'", channel_ids)
+        published_count = cur.fetchone()[0]
+    return pending_count, banned_count, published_count
+
+def get_user_post_stats(user_id: int):
+    stats = get_user_stats(user_id)
+    return stats['published'], stats['rejected'], stats['pending'], stats['reactions']
 
-def get_audit_log(channel_id: str, limit: int = 50):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT action, user_id, admin_id, details, created_at FROM audit_log WHERE channel_id = %s ORDER BY created_at DESC LIMIT %s", (channel_id, limit))
-    logs = cur.fetchall()
-    cur.close()
-    conn.close()
-    return logs
+def get_coin_transactions(user_id: int, limit: int = 10):
+    with db_cursor() as cur:
+        cur.execute("SELECT amount, reason, created_at FROM coin_transactions WHERE user_id = %s ORDER BY created_at DESC LIMIT %s", (user_id, limit))
+        return cur.fetchall()
 
-def is_channel_creator(user_id: int, channel_id: str) -> bool:
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT added_by FROM channels WHERE channel_id = %s", (channel_id,))
-    result = cur.fetchone()
-    cur.close()
-    conn.close()
-    return result and result[0] == user_id
+def get_week_winner():
+    from datetime import date, timedelta
+    today = date.today()
+    week_start = today - timedelta(days=today.weekday())
+    with db_cursor() as cur:
+        cur.execute(
+            "SELECT user_id, username, COUNT(*) as posts, COALESCE(SUM(reactions), 0) as reactions "
+            "FROM published_posts WHERE DATE(published_at) >= %s "
+            "GROUP BY user_id, username ORDER BY reactions DESC LIMIT 1",
+            (week_start,)
+        )
+        return cur.fetchone()
+
+def set_post_reactions_by_message_id(message_id: int, reactions: int) -> int:
+    with db_cursor() as cur:
+        return set_post_reactions(cur, reactions, message_id)
 
 def validate_channel_id(channel_id: str) -> bool:
     if not channel_id:
@@ -532,16 +1665,546 @@ def check_spam(text: str) -> bool:
     text_lower = text.lower()
     return any(keyword in text_lower for keyword in spam_keywords)
 
+# Кэш метаданных каналов: избавляет от get_chat на каждый показ названия канала
+channel_info_cache = TTLCache(CHAT_CACHE_TTL, CHAT_CACHE_SIZE)
+channel_ids_by_chat = {}
+channel_search_index = ChannelSearchIndex()
+
+async def remember_channel_info(channel_id: str, chat):
+    info = {'chat_id': chat.id, 'title': chat.title, 'username': chat.username, 'type': chat.type}
+    previous = channel_info_cache.get(channel_id)
+    channel_info_cache.set(channel_id, info)
+    channel_ids_by_chat[chat.id] = channel_id
+    if previous != info:
+        channel_search_index.add(channel_id, info['title'], info['username'])
+        try:
+            await run_db(update_channel_info, channel_id, info['chat_id'], info['title'], info['username'], info['type'])
+        except Exception as e:
+            logger.error(f"Error saving channel info for {channel_id}: {e}")
+    return info
+
+async def get_channel_info(bot, channel_id: str):
+    info = channel_info_cache.get(channel_id, _MISSING)
+    if info is not _MISSING:
+        return info
+    try:
+        chat = await bot.get_chat(channel_id)
+    except TelegramError as e:
+        logger.warning(f"Не удалось получить информацию о канале {channel_id}: {e}")
+        channel_info_cache.set(channel_id, None, CHAT_CACHE_FAILURE_TTL)
+        return None
+    return await remember_channel_info(channel_id, chat)
+
+async def get_channel_title(bot, channel_id: str, default: str = None):
+    info = await get_channel_info(bot, channel_id)
+    if info and info['title']:
+        return info['title']
+    return default if default is not None else channel_id
+
+async def warm_channel_info_cache():
+    for channel_id, chat_id, title, username, chat_type in await run_db(get_channels_info):
+        channel_search_index.add(channel_id, title, username)
+        if title:
+            channel_info_cache.set(channel_id, {'chat_id': chat_id, 'title': title, 'username': username, 'type': chat_type})
+            if chat_id:
+                channel_ids_by_chat[chat_id] = channel_id
+
+async def refresh_channel_info_cache(context: ContextTypes.DEFAULT_TYPE):
+    """Фоново обновляет метаданные всех подключенных каналов.
+    В Telegram ходит только лидер, остальные реплики подтягивают уже сохраненные данные из БД"""
+    if not job_leader.is_leader:
+        await warm_channel_info_cache()
+        return
+    for channel_id in await run_db(get_channels):
+        try:
+            chat = await context.bot.get_chat(channel_id)
+        except TelegramError as e:
+            logger.warning(f"Не удалось обновить информацию о канале {channel_id}: {e}")
+            continue
+        await remember_channel_info(channel_id, chat)
+
+async def handle_chat_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Бота добавили/удалили из канала или канал переименовали
+    chat = update.effective_chat
+    if not chat or chat.type not in ['channel', 'supergroup']:
+        return
+    channel_id = channel_ids_by_chat.get(chat.id)
+    if channel_id is None:
+        channel_id = await run_db(find_channel_id, chat.id, chat.username)
+    if channel_id is None:
+        return
+    await remember_channel_info(channel_id, chat)
+
+class ReactionBuffer:
+    """Схлопывает обновления реакций по (channel_id, message_id) и пишет их в БД пачками"""
+
+    def __init__(self, flush_interval: float, max_batch: int):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._pending = {}
+        self._timer = None
+        self._lock = asyncio.Lock()
+        self._tasks = set()
+
+    def add(self, channel_id: str, message_id: int, reactions: int):
+        # Последнее значение побеждает: это абсолютный счетчик, а не дельта
+        self._pending[(channel_id, message_id)] = reactions
+        if len(self._pending) >= self.max_batch:
+            self._spawn_flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.flush_interval, self._spawn_flush)
+
+    def _spawn_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        task = asyncio.create_task(self.flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        # Сбросы идут по очереди, чтобы более старая пачка не перезаписала новую
+        async with self._lock:
+            try:
+                written = await run_db(update_post_reactions, [(ch, msg, count) for (ch, msg), count in batch.items()])
+                METRICS['reaction_rows_written_total'] += written
+            except Exception as e:
+                logger.error(f"Error flushing {len(batch)} reaction updates: {e}")
+                for key, count in batch.items():
+                    self._pending.setdefault(key, count)
+                if self._timer is None:
+                    self._timer = asyncio.get_running_loop().call_later(self.flush_interval, self._spawn_flush)
+
+    async def stop(self):
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self.flush()
+
+reaction_buffer = ReactionBuffer(REACTIONS_FLUSH_INTERVAL, REACTIONS_BATCH_SIZE)
+
+class TokenBucket:
+    """Ведро токенов: wait() говорит, через сколько секунд появится токен, take() его забирает"""
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def wait(self) -> float:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        return 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+
+    def take(self):
+        self._tokens -= 1
+
+# Полосы исходящей очереди: меньшее значение уходит раньше
+LANE_PUBLISH = 0
+LANE_REPLY = 1
+LANE_NOTIFY = 2
+
+class OutboundDispatcher:
+    """Единая очередь исходящих сообщений: общее и per-chat ведра токенов, приоритетные полосы,
+    повтор после RetryAfter и ограниченное число одновременных запросов к Bot API"""
+
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+        self._queue = asyncio.PriorityQueue()
+        self._seq = 0
+        self._global = TokenBucket(OUTBOUND_GLOBAL_RATE, OUTBOUND_GLOBAL_RATE)
+        self._chats = TTLCache(60, 50000)
+        self._paused_until = 0.0
+        # Отложенные повторы ждут в таймерах event loop, а не в воркерах
+        self._deferred = {}
+        self._workers = []
+        self._bot = None
+
+    def __len__(self):
+        return self._queue.qsize() + len(self._deferred)
+
+    def start(self, bot):
+        self._bot = bot
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def stop(self, timeout: float = 10):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        try:
+            while True:
+                await asyncio.wait_for(self._queue.join(), timeout=max(deadline - loop.time(), 0))
+                if not self._deferred:
+                    break
+                if loop.time() >= deadline:
+                    raise asyncio.TimeoutError
+                await asyncio.sleep(0.1)
+        except asyncio.TimeoutError:
+            logger.warning(f"[OUTBOUND] {len(self)} messages dropped on shutdown")
+        for handle, job in self._deferred.values():
+            handle.cancel()
+            job['future'].cancel()
+        self._deferred.clear()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def send(self, lane: int, method: str, chat_id, **kwargs):
+        """Отправляет через очередь и возвращает ответ Bot API (или пробрасывает ошибку)"""
+        future = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        job = {'method': method, 'chat_id': chat_id, 'kwargs': kwargs, 'future': future, 'attempts': 0}
+        self._queue.put_nowait((lane, self._seq, job))
+        return await future
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # Личные чаты имеют положительный ID, группы и каналы - отрицательный или @username
+            private = isinstance(chat_id, int) and chat_id > 0
+            bucket = TokenBucket(OUTBOUND_PRIVATE_RATE if private else OUTBOUND_GROUP_RATE)
+        # Продлеваем срок при каждом обращении: ведро активного чата не должно смениться полным
+        self._chats.set(chat_id, bucket)
+        return bucket
+
+    async def _worker(self):
+        while True:
+            lane, seq, job = await self._queue.get()
+            try:
+                await self._deliver(lane, seq, job)
+            except Exception as e:
+                logger.error(f"[OUTBOUND] Unexpected error: {e}")
+                if not job['future'].done():
+                    job['future'].set_exception(e)
+            finally:
+                self._queue.task_done()
+                METRICS['outbound_queue_size'] = len(self)
+
+    async def _deliver(self, lane: int, seq: int, job: dict):
+        pause = self._paused_until - time.monotonic()
+        if pause > 0:
+            # Во время флуд-паузы воркер не спит, а откладывает сообщение и берет следующее
+            self._defer(lane, seq, job, pause)
+            return
+        # Ждать токена воркер тоже не должен: иначе всплеск в один чат занимает все воркеры.
+        # Токены берем только когда сообщение действительно уходит
+        chat_bucket = self._chat_bucket(job['chat_id'])
+        wait = max(chat_bucket.wait(), self._global.wait())
+        if wait > 0:
+            self._defer(lane, seq, job, wait)
+            return
+        chat_bucket.take()
+        self._global.take()
+        
+        try:
+            result = await getattr(self._bot, job['method'])(chat_id=job['chat_id'], **job['kwargs'])
+        except RetryAfter as e:
+            METRICS['outbound_retry_after_total'] += 1
+            retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+            # Флуд-контроль: притормаживаем все отправки, сообщение возвращаем в очередь
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            logger.warning(f"[OUTBOUND] RetryAfter {retry_after}s for chat {job['chat_id']}")
+            if self._retry(lane, seq, job, retry_after):
+                return
+            error = e
+        except TimedOut as e:
+            # Сообщение могло уйти, повтор создал бы дубль
+            error = e
+        except (BadRequest, Forbidden) as e:
+            # Повтор не поможет: бот заблокирован или запрос некорректен
+            error = e
+        except NetworkError as e:
+            if self._retry(lane, seq, job, min(2 ** job['attempts'], 60)):
+                return
+            error = e
+        except Exception as e:
+            error = e
+        else:
+            METRICS['outbound_sent_total'] += 1
+            if not job['future'].done():
+                job['future'].set_result(result)
+            return
+        
+        METRICS['outbound_failed_total'] += 1
+        if not job['future'].done():
+            job['future'].set_exception(error)
+
+    def _retry(self, lane: int, seq: int, job: dict, delay: float) -> bool:
+        job['attempts'] += 1
+        if job['attempts'] > OUTBOUND_MAX_RETRIES:
+            return False
+        self._defer(lane, seq, job, delay)
+        return True
+
+    def _defer(self, lane: int, seq: int, job: dict, delay: float):
+        # Тот же seq сохраняет порядок сообщения внутри полосы
+        def requeue():
+            self._deferred.pop(seq, None)
+            self._queue.put_nowait((lane, seq, job))
+        handle = asyncio.get_running_loop().call_later(max(delay, 0), requeue)
+        self._deferred[seq] = (handle, job)
+
+outbound = OutboundDispatcher(OUTBOUND_CONCURRENCY)
+
+class NotificationOutbox:
+    """Фоновая доставка уведомлений из notification_outbox пачками: с повторами и dead-letter.
+    Записи пишутся в тех же транзакциях, что и решения модератора, поэтому переживают рестарт"""
+
+    def __init__(self):
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def wake(self):
+        self._wakeup.set()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                self._wakeup.clear()
+                batch = await run_db(claim_notifications, OUTBOX_BATCH_SIZE)
+                if batch:
+                    await self._deliver(batch)
+                    # Полная пачка - вероятно, есть еще, не ждем
+                    if len(batch) == OUTBOX_BATCH_SIZE:
+                        continue
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=OUTBOX_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"[OUTBOX] Error in outbox loop: {e}")
+                await asyncio.sleep(OUTBOX_POLL_INTERVAL)
+
+    async def _deliver(self, batch: list):
+        results = await asyncio.gather(
+            *(outbound.send(LANE_NOTIFY, 'send_message', user_id, text=text) for _, user_id, text in batch),
+            return_exceptions=True
+        )
+        sent, failed = [], []
+        for (notification_id, user_id, _), result in zip(batch, results):
+            if not isinstance(result, Exception):
+                sent.append(notification_id)
+                continue
+            # Автор заблокировал бота или чата нет - повтор не поможет
+            permanent = isinstance(result, (Forbidden, BadRequest))
+            failed.append((notification_id, str(result)[:500], permanent))
+            if not permanent:
+                logger.warning(f"[OUTBOX] Notification {notification_id} to {user_id} failed: {result}")
+        dead = await run_db(complete_notifications, sent, failed)
+        METRICS['outbox_sent_total'] += len(sent)
+        METRICS['outbox_failed_total'] += len(failed)
+        METRICS['outbox_dead_total'] += dead
+
+notification_outbox = NotificationOutbox()
+
+def _encode_state(value):
+    # Множества (например, выбранные посты пакетной модерации) JSON не умеет
+    if isinstance(value, (set, frozenset)):
+        # Сортируем, чтобы одинаковые множества давали одинаковый JSON и не считались изменением
+        return {'__set__': sorted(value)}
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+def _decode_state(obj: dict):
+    if obj.keys() == {'__set__'}:
+        return set(obj['__set__'])
+    return obj
+
+def dump_state(data: dict) -> str:
+    return json.dumps(data, default=_encode_state, sort_keys=True, ensure_ascii=False)
+
+def load_state(raw: str) -> dict:
+    return json.loads(raw, object_hook=_decode_state)
+
+EMPTY_STATE = dump_state({})
+
+class PostgresPersistence(BasePersistence):
+    """Хранит context.user_data в таблице user_state (JSON).
+    Приложение раз в update_interval отдает данные затронутых пользователей; в БД из них уходят только
+    реально изменившиеся, и не сразу, а пачкой через flush_delay секунд"""
+
+    def __init__(self, update_interval: float, flush_delay: float, refresh: bool):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.flush_delay = flush_delay
+        self.refresh = refresh
+        # Последнее сохраненное состояние и версия строки по каждому пользователю
+        self._snapshots = {}
+        self._versions = {}
+        # user_id -> JSON для записи или None для удаления
+        self._dirty = {}
+        self._timer = None
+        # Пауза перед повтором после неудачной записи; растет вдвое до update_interval
+        self._backoff = 0.0
+        self._lock = asyncio.Lock()
+        self._tasks = set()
+
+    async def get_user_data(self) -> dict:
+        user_data = {}
+        for user_id, version, raw in await run_db(load_user_states, PERSISTENCE_MAX_AGE_DAYS):
+            data = load_state(raw)
+            user_data[user_id] = data
+            self._snapshots[user_id] = dump_state(data)
+            self._versions[user_id] = version
+        logger.info(f"[PERSISTENCE] Loaded state of {len(user_data)} users")
+        return user_data
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        try:
+            raw = dump_state(data)
+        except TypeError as e:
+            logger.warning(f"[PERSISTENCE] State of user {user_id} is not serializable: {e}")
+            return
+        if raw == self._snapshots.get(user_id, EMPTY_STATE):
+            # Изменение откатилось до сохраненного состояния - писать нечего
+            self._dirty.pop(user_id, None)
+            return
+        self._snapshots[user_id] = raw
+        self._dirty[user_id] = raw
+        self._schedule_flush()
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        # Подтягиваем состояние, записанное другой репликой; свои незаписанные изменения не затираем
+        if not self.refresh or user_id in self._dirty:
+            return
+        row = await run_db(get_user_state, user_id, self._versions.get(user_id, 0))
+        if row is None:
+            return
+        version, raw = row
+        data = load_state(raw)
+        user_data.clear()
+        user_data.update(data)
+        self._snapshots[user_id] = dump_state(data)
+        self._versions[user_id] = version
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._snapshots.pop(user_id, None)
+        self._versions.pop(user_id, None)
+        self._dirty[user_id] = None
+        self._schedule_flush()
+
+    def _schedule_flush(self, delay: float = None):
+        if self._timer is None:
+            delay = self.flush_delay if delay is None else delay
+            self._timer = asyncio.get_running_loop().call_later(delay, self._spawn_flush)
+
+    def _spawn_flush(self):
+        self._timer = None
+        task = asyncio.create_task(self._flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._dirty:
+            return
+        batch, self._dirty = self._dirty, {}
+        async with self._lock:
+            try:
+                versions = await run_db(
+                    save_user_states,
+                    [(user_id, raw) for user_id, raw in batch.items() if raw is not None],
+                    [user_id for user_id, raw in batch.items() if raw is None]
+                )
+                self._versions.update(versions)
+                self._backoff = 0.0
+                METRICS['persistence_rows_written_total'] += len(batch)
+            except Exception as e:
+                self._backoff = min(max(self._backoff * 2, self.flush_delay, 1.0), self.update_interval)
+                logger.error(f"[PERSISTENCE] Error saving state of {len(batch)} users, retry in {self._backoff:.0f}s: {e}")
+                for user_id, raw in batch.items():
+                    self._dirty.setdefault(user_id, raw)
+                self._schedule_flush(self._backoff)
+
+    async def flush(self) -> None:
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self._flush()
+
+    # Данные чатов, бота, callback_data и ConversationHandler бот не использует
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        pass
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+async def handle_reaction_count(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Анонимные счетчики реакций на посты в каналах
+    reaction_count = update.message_reaction_count
+    if not reaction_count:
+        return
+    chat = reaction_count.chat
+    channel_id = channel_ids_by_chat.get(chat.id)
+    if channel_id is None:
+        channel_id = await run_db(find_channel_id, chat.id, chat.username)
+        if channel_id is None:
+            return
+        channel_ids_by_chat[chat.id] = channel_id
+    METRICS['reaction_updates_total'] += 1
+    total = sum(reaction.total_count for reaction in reaction_count.reactions)
+    reaction_buffer.add(channel_id, reaction_count.message_id, total)
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
-    if is_user_banned(user_id):
+    if await run_db(is_user_banned, user_id):
         await update.message.reply_text("❌ Вы заблокированы и не можете отправлять контент.")
         return
     
     help_text = "👋 Привет! Я платформа для модерации контента в Telegram каналах.\n\n"
     
-    if is_channel_admin(user_id):
+    if await run_db(is_channel_admin, user_id):
         help_text += "🛡️ Вы администратор канала!\n\n"
         help_text += "Команды админа:\n"
         help_text += "/addchannel - добавить новый канал\n"
@@ -555,23 +2218,20 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def moderate(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    user_channels = get_user_channels(user_id)
+    user_channels = await run_db(get_user_channels, user_id)
     
     if not user_channels:
         await update.message.reply_text("❌ Вы не являетесь администратором ни одного канала.")
         return
     
+    # Считаем количество постов в очереди одним запросом для всех каналов
+    pending_counts = await run_db(count_pending_posts, user_channels)
+    
     # Показываем кнопки с каналами для модерации
     keyboard = []
     for ch_id in user_channels:
-        try:
-            chat = await context.bot.get_chat(ch_id)
-            channel_name = chat.title
-        except:
-            channel_name = ch_id
-        
-        # Считаем количество постов в очереди
-        pending_count = len(get_pending_posts(ch_id))
+        channel_name = await get_channel_title(context.bot, ch_id)
+        pending_count = pending_counts.get(ch_id, 0)
         
         short_channel_id = hashlib.sha256(ch_id.encode()).hexdigest()[:8]
         keyboard.append([InlineKeyboardButton(
@@ -589,21 +2249,11 @@ async def moderate(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=reply_markup
     )
 
-async def show_next_post(query, context: ContextTypes.DEFAULT_TYPE, channel_id: str):
-    pending_posts = get_pending_posts(channel_id)
-    
-    if not pending_posts:
-        await query.edit_message_text("✅ Все посты в этом канале обработаны!")
-        return
-    
-    # Берем первый пост из очереди
-    post_id, user_id, username, photo_file_id, caption, created_at = pending_posts[0]
-    
-    try:
-        chat = await context.bot.get_chat(channel_id)
-        channel_name = chat.title
-    except:
-        channel_name = channel_id
+# Сессии модерации: подготовленные заранее посты по (модератор, канал); живут не дольше аренды
+moderation_sessions = TTLCache(MODERATION_CLAIM_TTL, 1000)
+
+def render_moderation_post(post, channel_id: str, channel_name: str) -> dict:
+    post_id, user_id, username, photo_file_id, caption, created_at = post
     
     short_channel_id = hashlib.sha256(channel_id.encode()).hexdigest()[:8]
     keyboard = [
@@ -613,22 +2263,194 @@ async def show_next_post(query, context: ContextTypes.DEFAULT_TYPE, channel_id:
         ],
         [
             InlineKeyboardButton("🚫 Забанить автора", callback_data=f"ban_{post_id}_{short_channel_id}"),
-            InlineKeyboardButton("⏭️ Следующий", callback_data=f"next_{short_channel_id}")
-        ]
+            InlineKeyboardButton("⏭️ Следующий", callback_data=f"next_{post_id}_{short_channel_id}")
+        ],
+        [InlineKeyboardButton("📦 Пакетный режим", callback_data=f"blk_open_{short_channel_id}")]
     ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
     
-    caption_text = f"📩 Пост от @{username} (ID: {user_id})\n📢 Канал: {channel_name}\n📅 {created_at}\n\nОсталось в очереди: {len(pending_posts)}"
-    if caption:
-        caption_text += f"\n\n💬 Подпись: {caption}"
+    return {
+        'post_id': post_id,
+        'photo_file_id': photo_file_id,
+        'header': f"📩 Пост от @{username} (ID: {user_id})\n📢 Канал: {channel_name}\n📅 {created_at}",
+        'post_caption': caption,
+        'reply_markup': InlineKeyboardMarkup(keyboard),
+        'claimed_at': time.monotonic()
+    }
+
+def moderation_caption(entry: dict, pending_count: int) -> str:
+    # Счетчик очереди подставляем при показе: за время подготовки другие модераторы могли разобрать очередь
+    caption_text = f"{entry['header']}\n\nОсталось в очереди: {pending_count}"
+    if entry['post_caption']:
+        caption_text += f"\n\n💬 Подпись: {entry['post_caption']}"
+    return caption_text
+
+async def prefetch_moderation_posts(bot, channel_id: str, moderator_id: int, session: dict, limit: int, after_post_id: int = None):
+    # Курсор - последний подготовленный пост; текущий и подготовленные остаются за модератором
+    keep = [entry['post_id'] for entry in session['queue']]
+    if session['current']:
+        keep.append(session['current'])
+    if session['queue']:
+        after_post_id = session['queue'][-1]['post_id']
+    
+    posts = await run_db(claim_pending_posts, channel_id, moderator_id, limit, after_post_id, keep)
+    if not posts:
+        return
+    channel_name = await get_channel_title(bot, channel_id)
+    
+    known = {entry['post_id'] for entry in session['queue']}
+    for post in posts:
+        if post[0] in known or post[0] == session['current']:
+            continue
+        session['queue'].append(render_moderation_post(post, channel_id, channel_name))
+
+async def refill_moderation_session(bot, channel_id: str, moderator_id: int, session: dict):
+    try:
+        await prefetch_moderation_posts(bot, channel_id, moderator_id, session, MODERATION_PREFETCH - len(session['queue']))
+    except Exception as e:
+        logger.error(f"Error prefetching moderation posts for {channel_id}: {e}")
+    finally:
+        session['refill'] = None
+
+async def show_next_post(query, context: ContextTypes.DEFAULT_TYPE, channel_id: str, after_post_id: int = None):
+    moderator_id = query.from_user.id
+    key = (moderator_id, channel_id)
+    session = moderation_sessions.get(key)
+    if session is None:
+        session = {'queue': deque(), 'current': None, 'refill': None}
+    
+    # Подготовленные посты, аренда которых скоро истечет, выбрасываем
+    while session['queue'] and time.monotonic() - session['queue'][0]['claimed_at'] > MODERATION_CLAIM_TTL * 0.8:
+        session['queue'].popleft()
+    
+    if not session['queue']:
+        if session['refill']:
+            await session['refill']
+        if not session['queue']:
+            # Нечего показать сразу: арендуем текущий и следующие посты синхронно
+            session['current'] = None
+            await prefetch_moderation_posts(context.bot, channel_id, moderator_id, session, MODERATION_PREFETCH + 1, after_post_id)
+    
+    if not session['queue']:
+        moderation_sessions.pop(key)
+        await query.edit_message_text("✅ Все посты в этом канале обработаны!")
+        return
+    
+    entry = session['queue'].popleft()
+    session['current'] = entry['post_id']
+    moderation_sessions.set(key, session)
+    pending_count = (await run_db(count_pending_posts, [channel_id])).get(channel_id, 0)
+    caption_text = moderation_caption(entry, max(pending_count, 1))
     
     try:
         await query.edit_message_media(
-            media={"type": "photo", "media": photo_file_id, "caption": caption_text},
-            reply_markup=reply_markup
+            media=InputMediaPhoto(media=entry['photo_file_id'], caption=caption_text),
+            reply_markup=entry['reply_markup']
         )
     except:
-        await query.edit_message_text(caption_text, reply_markup=reply_markup)
+        await query.edit_message_text(caption_text, reply_markup=entry['reply_markup'])
+    
+    # Пока модератор смотрит пост, в фоне готовим следующие
+    if len(session['queue']) < MODERATION_PREFETCH and session['refill'] is None:
+        session['refill'] = asyncio.create_task(refill_moderation_session(context.bot, channel_id, moderator_id, session))
+
+def bulk_page_keyboard(page: dict, short_channel_id: str):
+    keyboard = []
+    row = []
+    for idx in range(1, len(page['posts']) + 1):
+        mark = "☑" if idx in page['selected'] else "☐"
+        row.append(InlineKeyboardButton(f"{mark} {idx}", callback_data=f"blk_t_{idx}_{short_channel_id}"))
+        if len(row) == 5:
+            keyboard.append(row)
+            row = []
+    if row:
+        keyboard.append(row)
+    keyboard.append([InlineKeyboardButton("☑ Выбрать все / снять", callback_data=f"blk_a_{short_channel_id}")])
+    keyboard.append([
+        InlineKeyboardButton("✅ Опубликовать", callback_data=f"blk_app_{short_channel_id}"),
+        InlineKeyboardButton("❌ Отклонить", callback_data=f"blk_rej_{short_channel_id}")
+    ])
+    keyboard.append([
+        InlineKeyboardButton("🚫 Забанить авторов", callback_data=f"blk_ban_{short_channel_id}"),
+        InlineKeyboardButton("⏭️ Следующие", callback_data=f"blk_nxt_{short_channel_id}")
+    ])
+    keyboard.append([InlineKeyboardButton("↩️ По одному", callback_data=f"mod_{short_channel_id}")])
+    return InlineKeyboardMarkup(keyboard)
+
+def bulk_page_text(page: dict, channel_name: str, pending_count: int, note: str = ""):
+    text = f"📦 Пакетная модерация: {channel_name}\n"
+    text += f"На странице: {len(page['posts'])} | Выбрано: {len(page['selected'])} | В очереди: {pending_count}\n\n"
+    text += "\n".join(f"{idx}. @{username} (ID: {user_id})" for idx, (_, user_id, username) in enumerate(page['posts'], 1))
+    if note:
+        text = f"{note}\n\n{text}"
+    return text
+
+async def drop_bulk_album(context: ContextTypes.DEFAULT_TYPE, chat_id: int, page: dict):
+    if not page.get('album'):
+        return
+    try:
+        await context.bot.delete_messages(chat_id=chat_id, message_ids=page['album'])
+    except TelegramError as e:
+        logger.warning(f"Не удалось удалить альбом пакетной модерации: {e}")
+    page['album'] = []
+
+async def submit_post(channel_id: str, user_id: int, username: str, photo_file_id: str, caption: str, photo_unique_id: str = None) -> bool:
+    """Ставит пост в очередь канала. С купленным «🎫 Пропуск» пост минует очередь и уходит
+    планировщику на ближайший свободный слот канала. Возвращает True для пропуска"""
+    skipped = await run_db(schedule_skip_post, channel_id, user_id, username, photo_file_id, caption)
+    if skipped:
+        post_scheduler.add(*skipped)
+        return True
+    await run_db(add_pending_post, channel_id, user_id, username, photo_file_id, caption, photo_unique_id)
+    return False
+
+async def show_bulk_page(query, context: ContextTypes.DEFAULT_TYPE, channel_id: str, note: str = ""):
+    short_channel_id = hashlib.sha256(channel_id.encode()).hexdigest()[:8]
+    chat_id = query.message.chat_id
+    posts = await run_db(claim_pending_posts, channel_id, query.from_user.id, BULK_PAGE_SIZE)
+    
+    if not posts:
+        context.user_data.get('bulk', {}).pop(short_channel_id, None)
+        text = "✅ Все посты в этом канале обработаны!"
+        if note:
+            text = f"{note}\n\n{text}"
+        try:
+            await query.edit_message_text(text)
+        except TelegramError:
+            await context.bot.send_message(chat_id=chat_id, text=text)
+        return
+    
+    # Одно сообщение-альбом вместо edit_message_media на каждый пост
+    media = []
+    for idx, (post_id, user_id, username, photo_file_id, caption, created_at) in enumerate(posts, 1):
+        album_caption = f"{idx}. @{username}"
+        if caption:
+            album_caption += f"\n💬 {caption[:200]}"
+        media.append(InputMediaPhoto(media=photo_file_id, caption=album_caption))
+    if len(media) > 1:
+        album = await context.bot.send_media_group(chat_id=chat_id, media=media)
+    else:
+        album = [await context.bot.send_photo(chat_id=chat_id, photo=media[0].media, caption=media[0].caption)]
+    
+    page = {
+        'channel_id': channel_id,
+        'posts': [(post_id, user_id, username) for post_id, user_id, username, _, _, _ in posts],
+        'selected': set(),
+        'album': [msg.message_id for msg in album]
+    }
+    context.user_data.setdefault('bulk', {})[short_channel_id] = page
+    
+    channel_name = await get_channel_title(context.bot, channel_id)
+    pending_count = (await run_db(count_pending_posts, [channel_id])).get(channel_id, 0)
+    # Панель управления отправляем под альбомом, старую убираем
+    try:
+        await query.message.delete()
+    except TelegramError:
+        pass
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text=bulk_page_text(page, channel_name, pending_count, note),
+        reply_markup=bulk_page_keyboard(page, short_channel_id)
+    )
 
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.effective_user or not update.message:
@@ -640,7 +2462,7 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message.photo:
         return
     
-    channels = get_channels_with_names()
+    channels = await run_db(get_channels_with_names)
     
     if not channels:
         await update.message.reply_text(
@@ -658,18 +2480,15 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         file_size = file.file_size
         
         # Проверяем автомодерацию для каждого канала
-        conn = get_db_connection()
         photo_hash = str(hash(photo.file_id))[:32]  # Упрощенный хеш
         
         # Проверяем базовый спам
         if check_spam(caption):
             await update.message.reply_text("⚠️ Обнаружен подозрительный контент. Пожалуйста, не отправляйте рекламу.")
-            conn.close()
             return
         
         # Автомодерация (если включена хотя бы в одном канале)
-        auto_mod_result = auto_moderate_content(photo_hash, file_size, sanitize_caption(caption), user_id, conn)
-        conn.close()
+        auto_mod_result = auto_moderate_content(photo_hash, file_size, sanitize_caption(caption), user_id)
         
         if not auto_mod_result['approved']:
             warning_text = "⚠️ Автомодерация обнаружила проблемы:\n\n"
@@ -686,6 +2505,7 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Error in auto-moderation: {e}")
     
     context.user_data['photo_file_id'] = photo.file_id
+    context.user_data['photo_unique_id'] = photo.file_unique_id
     context.user_data['photo_caption'] = caption
     context.user_data['waiting_for_channel'] = True
     
@@ -716,10 +2536,10 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             channel_id = channel_mapping.get(short_channel_id)
             
             if setting_type == "interval":
-                update_channel_setting(channel_id, 'post_interval_minutes', value)
+                await run_db(update_channel_setting, channel_id, 'post_interval_minutes', value)
                 text = f"✅ Интервал установлен: {value} мин"
             elif setting_type == "limit":
-                update_channel_setting(channel_id, 'max_posts_per_day', value)
+                await run_db(update_channel_setting, channel_id, 'max_posts_per_day', value)
                 text = f"✅ Лимит установлен: {value} постов/день"
             
             context.user_data['awaiting_input'] = None
@@ -741,26 +2561,8 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Пожалуйста, введите название канала.")
         return
     
-    channels = get_channels_with_names()
-    matched_channels = []
-    
-    # Ищем подходящие каналы
-    for channel in channels:
-        channel_id = channel[0]
-        try:
-            chat = await context.bot.get_chat(channel_id)
-            channel_name = chat.title.lower()
-            channel_username = getattr(chat, 'username', '') or ''
-            
-            # Поиск по названию или username
-            if (search_query in channel_name or 
-                search_query.replace('@', '') in channel_username.lower() or
-                channel_username.lower() == search_query.replace('@', '')):
-                matched_channels.append((channel_id, chat.title, channel_username))
-        except:
-            # Если не можем получить инфо о канале, проверяем по ID
-            if search_query == channel_id.lower():
-                matched_channels.append((channel_id, channel_id, ''))
+    # Ищем подходящие каналы в локальном индексе
+    matched_channels = channel_search_index.search(search_query)
     
     if not matched_channels:
         await update.message.reply_text(
@@ -776,23 +2578,26 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Найден только один канал - добавляем в очередь сразу
         channel_id, channel_name, channel_username = matched_channels[0]
         
-        if is_user_banned(user_id, channel_id):
+        if await run_db(is_user_banned, user_id, channel_id):
             await update.message.reply_text(f"❌ Вы заблокированы в канале '{channel_name}'.")
             context.user_data['waiting_for_channel'] = False
             return
         
-        add_pending_post(channel_id, user_id, username, photo_file_id, caption)
+        skipped = await submit_post(channel_id, user_id, username, photo_file_id, caption, context.user_data.get('photo_unique_id'))
         
         context.user_data['waiting_for_channel'] = False
         
-        await update.message.reply_text(
-            f"✅ Ваш контент добавлен в очередь модерации канала '{channel_name}'!"
-        )
+        if skipped:
+            await update.message.reply_text(f"🎫 Пропуск модерации использован: пост будет опубликован в канале '{channel_name}'!")
+        else:
+            await update.message.reply_text(
+                f"✅ Ваш контент добавлен в очередь модерации канала '{channel_name}'!"
+            )
     else:
         # Найдено несколько каналов - показываем кнопки
         keyboard = []
         for channel_id, channel_name, channel_username in matched_channels:
-            short_channel_id = str(hash(channel_id))[-8:]
+            short_channel_id = hashlib.sha256(channel_id.encode()).hexdigest()[:8]
             display_name = f"{channel_name}"
             if channel_username:
                 display_name += f" (@{channel_username})"
@@ -860,24 +2665,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         caption = context.user_data.get('photo_caption', '')
         username = query.from_user.username or query.from_user.first_name
         
-        channels = get_channels_with_names()
-        added_count = 0
-        skipped_count = 0
-        
-        for channel in channels:
-            channel_id = channel[0]
-            settings = get_channel_settings(channel_id)
-            
-            if not settings.get('allow_global', True):
-                skipped_count += 1
-                continue
-            
-            if is_user_banned(user_id, channel_id):
-                skipped_count += 1
-                continue
-            
-            add_pending_post(channel_id, user_id, username, photo_file_id, caption)
-            added_count += 1
+        added_count, skipped_count = await run_db(add_pending_post_to_all, user_id, username, photo_file_id, caption, context.user_data.get('photo_unique_id'))
         
         context.user_data['waiting_for_channel'] = False
         
@@ -904,13 +2692,9 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.edit_message_text("❌ Ошибка: канал не найден.")
             return
         
-        try:
-            chat = await context.bot.get_chat(channel_id)
-            channel_name = chat.title
-        except:
-            channel_name = channel_id
+        channel_name = await get_channel_title(context.bot, channel_id)
         
-        if is_user_banned(user_id, channel_id):
+        if await run_db(is_user_banned, user_id, channel_id):
             await query.edit_message_text(f"❌ Вы заблокированы в канале '{channel_name}'.")
             context.user_data['waiting_for_channel'] = False
             return
@@ -920,14 +2704,17 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         caption = context.user_data.get('photo_caption', '')
         username = query.from_user.username or query.from_user.first_name
         
-        add_pending_post(channel_id, user_id, username, photo_file_id, caption)
+        skipped = await submit_post(channel_id, user_id, username, photo_file_id, caption, context.user_data.get('photo_unique_id'))
         
         # Очищаем состояние
         context.user_data['waiting_for_channel'] = False
         
-        await query.edit_message_text(
-            f"✅ Ваш контент добавлен в очередь модерации канала '{channel_name}'!"
-        )
+        if skipped:
+            await query.edit_message_text(f"🎫 Пропуск модерации использован: пост будет опубликован в канале '{channel_name}'!")
+        else:
+            await query.edit_message_text(
+                f"✅ Ваш контент добавлен в очередь модерации канала '{channel_name}'!"
+            )
     
     elif action == "mod":
         # Админ выбрал канал для модерации
@@ -940,23 +2727,107 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.edit_message_text("❌ Ошибка: канал не найден.")
             return
         
-        if not is_channel_admin(query.from_user.id, channel_id):
+        if not await run_db(is_channel_admin, query.from_user.id, channel_id):
             await query.edit_message_text("❌ Вы не администратор этого канала!")
             return
         
+        # Выход из пакетного режима: альбом страницы больше не нужен
+        page = context.user_data.get('bulk', {}).pop(short_channel_id, None)
+        if page:
+            await drop_bulk_album(context, query.message.chat_id, page)
+        
+        # Новая сессия модерации начинается с головы очереди
+        moderation_sessions.pop((query.from_user.id, channel_id))
+        
         # Показываем первый пост из очереди
         await show_next_post(query, context, channel_id)
     
+    elif action == "blk":
+        # Пакетная модерация: blk_<действие>[_<номер>]_<канал>
+        bulk_action = data_parts[1]
+        short_channel_id = data_parts[-1]
+        
+        channel_mapping = context.user_data.get('channel_mapping', {})
+        channel_id = channel_mapping.get(short_channel_id)
+        
+        if not channel_id:
+            await query.edit_message_text("❌ Ошибка: канал не найден.")
+            return
+        
+        if not await run_db(is_channel_admin, query.from_user.id, channel_id):
+            await query.edit_message_text("❌ Вы не администратор этого канала!")
+            return
+        
+        if bulk_action == "open":
+            # Пакетный режим снимает аренду постов, подготовленных для одиночного режима
+            moderation_sessions.pop((query.from_user.id, channel_id))
+            await show_bulk_page(query, context, channel_id)
+            return
+        
+        page = context.user_data.get('bulk', {}).get(short_channel_id)
+        if not page:
+            await query.edit_message_text("❌ Страница устарела. Откройте пакетный режим заново через /moderate.")
+            return
+        
+        if bulk_action == "t":
+            idx = int(data_parts[2])
+            page['selected'] ^= {idx}
+            await query.edit_message_reply_markup(reply_markup=bulk_page_keyboard(page, short_channel_id))
+            return
+        
+        if bulk_action == "a":
+            all_indexes = set(range(1, len(page['posts']) + 1))
+            page['selected'] = set() if page['selected'] == all_indexes else all_indexes
+            await query.edit_message_reply_markup(reply_markup=bulk_page_keyboard(page, short_channel_id))
+            return
+        
+        if bulk_action == "nxt":
+            await drop_bulk_album(context, query.message.chat_id, page)
+            await show_bulk_page(query, context, channel_id)
+            return
+        
+        if bulk_action in ["app", "rej", "ban"]:
+            if not page['selected']:
+                channel_name = await get_channel_title(context.bot, channel_id)
+                pending_count = (await run_db(count_pending_posts, [channel_id])).get(channel_id, 0)
+                await query.edit_message_text(
+                    bulk_page_text(page, channel_name, pending_count, "⚠️ Сначала выберите посты."),
+                    reply_markup=bulk_page_keyboard(page, short_channel_id)
+                )
+                return
+            
+            post_ids = [page['posts'][idx - 1][0] for idx in sorted(page['selected'])]
+            channel_name = await get_channel_title(context.bot, channel_id, "этом канале")
+            result = await run_db(apply_bulk_decision, channel_id, query.from_user.id, post_ids, bulk_action, channel_name)
+            notification_outbox.wake()
+            for scheduled_id, scheduled_time in result['scheduled']:
+                post_scheduler.add(scheduled_id, scheduled_time)
+            
+            processed = result['posts']
+            skipped = len(post_ids) - len(processed)
+            if bulk_action == "app":
+                note = f"✅ Поставлено в очередь публикации: {len(processed)}"
+            elif bulk_action == "rej":
+                note = f"❌ Отклонено: {len(processed)}"
+            else:
+                note = f"🚫 Забанено авторов: {len({post[1] for post in processed})}, удалено постов: {len(processed)}"
+            if skipped:
+                note += f"\n⏳ Уже обработаны другим модератором: {skipped}"
+            
+            await drop_bulk_album(context, query.message.chat_id, page)
+            await show_bulk_page(query, context, channel_id, note)
+            return
+    
     elif action == "set":
         short_channel_id = data_parts[1]
         channel_mapping = context.user_data.get('channel_mapping', {})
         channel_id = channel_mapping.get(short_channel_id)
         
-        if not channel_id or not is_channel_creator(query.from_user.id, channel_id):
+        if not channel_id or not await run_db(is_channel_creator, query.from_user.id, channel_id):
             await query.edit_message_text("❌ Только создатель канала может изменять настройки!")
             return
         
-        settings = get_channel_settings(channel_id)
+        settings = await run_db(get_channel_settings, channel_id)
         smart_mode = "🤖 AI" if settings.get('smart_mode', False) else "📅 Простой"
         automod = "✅ ON" if settings.get('auto_moderation', False) else "❌ OFF"
         
@@ -1004,31 +2875,31 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup = InlineKeyboardMarkup(keyboard)
             await query.edit_message_text("📊 Выберите лимит постов в день:", reply_markup=reply_markup)
         elif setting_type == "caption":
-            settings = get_channel_settings(channel_id)
+            settings = await run_db(get_channel_settings, channel_id)
             new_value = not settings['require_caption']
-            update_channel_setting(channel_id, 'require_caption', new_value)
+            await run_db(update_channel_setting, channel_id, 'require_caption', new_value)
             await query.answer(f"✅ Подпись {'required' if new_value else 'optional'}")
             keyboard = [[InlineKeyboardButton("⬅️ Назад", callback_data=f"set_{short_channel_id}")]]
             reply_markup = InlineKeyboardMarkup(keyboard)
             await query.edit_message_text(f"✅ Подпись теперь {'required' if new_value else 'optional'}", reply_markup=reply_markup)
         elif setting_type == "spam":
-            settings = get_channel_settings(channel_id)
+            settings = await run_db(get_channel_settings, channel_id)
             new_value = not settings['spam_filter']
-            update_channel_setting(channel_id, 'spam_filter_enabled', new_value)
+            await run_db(update_channel_setting, channel_id, 'spam_filter_enabled', new_value)
             await query.answer(f"✅ Спам-фильтр {'ON' if new_value else 'OFF'}")
             keyboard = [[InlineKeyboardButton("⬅️ Назад", callback_data=f"set_{short_channel_id}")]]
             reply_markup = InlineKeyboardMarkup(keyboard)
             await query.edit_message_text(f"✅ Спам-фильтр теперь {'ON' if new_value else 'OFF'}", reply_markup=reply_markup)
         elif setting_type == "global":
-            settings = get_channel_settings(channel_id)
+            settings = await run_db(get_channel_settings, channel_id)
             new_value = not settings.get('allow_global', True)
-            update_channel_setting(channel_id, 'allow_global_posts', new_value)
+            await run_db(update_channel_setting, channel_id, 'allow_global_posts', new_value)
             await query.answer(f"✅ Общие мемы {'ON' if new_value else 'OFF'}")
             keyboard = [[InlineKeyboardButton("⬅️ Назад", callback_data=f"set_{short_channel_id}")]]
             reply_markup = InlineKeyboardMarkup(keyboard)
             await query.edit_message_text(f"✅ Общие мемы теперь {'ON' if new_value else 'OFF'}\n\n{'Канал будет получать мемы, отправленные во все каналы' if new_value else 'Канал не будет получать мемы, отправленные во все каналы'}", reply_markup=reply_markup)
         elif setting_type == "smartmode":
-            settings = get_channel_settings(channel_id)
+            settings = await run_db(get_channel_settings, channel_id)
             current_mode = settings.get('smart_mode', False)
             keyboard = [
                 [InlineKeyboardButton("📅 Простой режим", callback_data=f"sms_simple_{short_channel_id}")],
@@ -1051,9 +2922,9 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 reply_markup=reply_markup
             )
         elif setting_type == "automod":
-            settings = get_channel_settings(channel_id)
+            settings = await run_db(get_channel_settings, channel_id)
             new_value = not settings.get('auto_moderation', False)
-            update_channel_setting(channel_id, 'auto_moderation', new_value)
+            await run_db(update_channel_setting, channel_id, 'auto_moderation', new_value)
             await query.answer(f"✅ Автомодерация {'ON' if new_value else 'OFF'}")
             keyboard = [[InlineKeyboardButton("⬅️ Назад", callback_data=f"set_{short_channel_id}")]]
             reply_markup = InlineKeyboardMarkup(keyboard)
@@ -1064,12 +2935,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 reply_markup=reply_markup
             )
         elif setting_type == "analytics":
-            conn = get_db_connection()
-            growth = get_growth_stats(channel_id, conn)
-            approval = get_approval_rate(channel_id, conn)
-            top_authors = get_top_authors(channel_id, conn, 3)
-            analytics_data = get_channel_analytics(channel_id, conn)
-            conn.close()
+            growth, approval, top_authors, analytics_data = await run_db(get_channel_analytics_report, channel_id)
             
             response = f"📊 Аналитика канала:\n\n"
             response += f"📈 Рост за неделю:\n"
@@ -1094,10 +2960,10 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         channel_id = channel_mapping.get(short_channel_id)
         
         if setting_type == "interval":
-            update_channel_setting(channel_id, 'post_interval_minutes', value)
+            await run_db(update_channel_setting, channel_id, 'post_interval_minutes', value)
             text = f"✅ Интервал установлен: {value} мин"
         elif setting_type == "limit":
-            update_channel_setting(channel_id, 'max_posts_per_day', value)
+            await run_db(update_channel_setting, channel_id, 'max_posts_per_day', value)
             text = f"✅ Лимит установлен: {value} постов/день"
         
         await query.answer("✅ Сохранено!")
@@ -1125,11 +2991,11 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         channel_mapping = context.user_data.get('channel_mapping', {})
         channel_id = channel_mapping.get(short_channel_id)
         
-        if not channel_id or not is_channel_admin(query.from_user.id, channel_id):
+        if not channel_id or not await run_db(is_channel_admin, query.from_user.id, channel_id):
             await query.edit_message_text("❌ Вы не администратор этого канала!")
             return
         
-        banned = get_banned_users(channel_id)
+        banned = await run_db(get_banned_users, channel_id)
         if not banned:
             await query.edit_message_text("✅ В этом канале нет заблокированных пользователей")
             return
@@ -1152,15 +3018,15 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         channel_mapping = context.user_data.get('channel_mapping', {})
         channel_id = channel_mapping.get(short_channel_id)
         
-        if not channel_id or not is_channel_admin(query.from_user.id, channel_id):
+        if not channel_id or not await run_db(is_channel_admin, query.from_user.id, channel_id):
             await query.answer("❌ Нет прав!")
             return
         
-        unban_user(banned_user_id, channel_id)
+        await run_db(unban_user, banned_user_id, channel_id)
         await query.answer("✅ Пользователь разблокирован!")
         
         # Обновляем список
-        banned = get_banned_users(channel_id)
+        banned = await run_db(get_banned_users, channel_id)
         if not banned:
             await query.edit_message_text("✅ Все пользователи разблокированы!")
             return
@@ -1180,7 +3046,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         channel_mapping = context.user_data.get('channel_mapping', {})
         channel_id = channel_mapping.get(short_channel_id)
         
-        logs = get_audit_log(channel_id, 20)
+        logs = await run_db(get_audit_log, channel_id, 20)
         response = "📊 История действий:\n\n"
         for log in logs:
             action_name, user_id, admin_id, details, created_at = log
@@ -1196,12 +3062,12 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         channel_id = channel_mapping.get(short_channel_id)
         
         if mode == "simple":
-            update_channel_setting(channel_id, 'smart_mode', False)
+            await run_db(update_channel_setting, channel_id, 'smart_mode', False)
             await query.answer("✅ Простой режим")
             await query.edit_message_text("✅ Установлен простой режим планирования")
         else:
-            update_channel_setting(channel_id, 'smart_mode', True)
-            update_channel_setting(channel_id, 'aggressiveness', mode)
+            await run_db(update_channel_setting, channel_id, 'smart_mode', True)
+            await run_db(update_channel_setting, channel_id, 'aggressiveness', mode)
             await query.answer(f"✅ AI-режим ({mode})")
             await query.edit_message_text(f"✅ Установлен AI-режим ({mode})\n\nПубликации будут планироваться автоматически")
     
@@ -1214,13 +3080,9 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.edit_message_text("❌ Ошибка: канал не найден.")
             return
         
-        try:
-            chat = await context.bot.get_chat(channel_id)
-            channel_name = chat.title
-        except:
-            channel_name = channel_id
+        channel_name = await get_channel_title(context.bot, channel_id)
         
-        leaders = get_channel_leaderboard(channel_id, 10)
+        leaders = await run_db(get_channel_leaderboard, channel_id, 10)
         
         if not leaders:
             await query.edit_message_text(f"🏆 Таблица лидеров канала '{channel_name}' пуста.")
@@ -1245,7 +3107,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         costs = {'priority': 1000, 'skip': 2000, 'pin': 3000}
         cost = costs.get(item_type, 0)
         
-        if buy_shop_item(user_id, username, item_type, cost, 24):
+        if await run_db(buy_shop_item, user_id, username, item_type, cost, 24):
             await query.answer("✅ Куплено!")
             await query.edit_message_text(f"✅ Вы купили {item_type} за {cost} монет!")
         else:
@@ -1254,7 +3116,9 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif action in ["app", "rej", "ban", "next"]:
         # Админ модерирует пост
         if action == "next":
-            short_channel_id = data_parts[1]
+            # Старые кнопки: next_<канал>, новые: next_<курсор>_<канал>
+            after_post_id = int(data_parts[1]) if len(data_parts) > 2 else None
+            short_channel_id = data_parts[-1]
         else:
             post_id = int(data_parts[1])
             short_channel_id = data_parts[2]
@@ -1266,7 +3130,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.edit_message_text("❌ Ошибка: канал не найден.")
             return
         
-        if not is_channel_admin(query.from_user.id, channel_id):
+        if not await run_db(is_channel_admin, query.from_user.id, channel_id):
             await query.edit_message_caption(
                 caption=query.message.caption + "\n\n⚠️ Вы не администратор этого канала!"
             )
@@ -1274,134 +3138,86 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         if action == "next":
             # Просто показываем следующий пост
-            await show_next_post(query, context, channel_id)
+            await show_next_post(query, context, channel_id, after_post_id)
             return
         
-        # Получаем данные поста
-        pending_posts = get_pending_posts(channel_id)
-        current_post = None
-        for post in pending_posts:
-            if post[0] == post_id:
-                current_post = post
-                break
+        # Забираем пост в обработку: второй модератор или повторное нажатие его не получат
+        current_post = await run_db(begin_pending_decision, post_id, channel_id, query.from_user.id)
         
         if not current_post:
-            await query.edit_message_caption(
-                caption=query.message.caption + "\n\n❌ Пост не найден в очереди!"
-            )
-            return
-        
-        post_id, user_id, username, photo_file_id, caption, created_at = current_post
-        
-        if action == "app":
-            try:
-                settings = get_channel_settings(channel_id)
-                from datetime import datetime, timedelta
-                
-                if settings['interval'] > 0 and settings['last_post']:
-                    next_post_time = settings['last_post'] + timedelta(minutes=settings['interval'])
-                    if datetime.now() < next_post_time:
-                        add_scheduled_post(channel_id, user_id, username, photo_file_id, caption, next_post_time)
-                        remove_pending_post(post_id)
-                        log_action(channel_id, 'scheduled', user_id, query.from_user.id, post_id, f"Scheduled for {next_post_time}")
-                        await query.answer(f"⏱ Пост запланирован на {next_post_time.strftime('%H:%M')}")
-                        await show_next_post(query, context, channel_id)
-                        return
-                
-                # ФАЗА 4: Умное планирование
-                settings = get_channel_settings(channel_id)
-                from datetime import datetime, timedelta
-                
-                if settings.get('smart_mode', False):
-                    conn = get_db_connection()
-                    next_time = calculate_smart_schedule(channel_id, conn, settings.get('aggressiveness', 'medium'))
-                    conn.close()
-                    
-                    if next_time > datetime.now():
-                        add_scheduled_post(channel_id, user_id, username, photo_file_id, caption, next_time)
-                        remove_pending_post(post_id)
-                        log_action(channel_id, 'smart_scheduled', user_id, query.from_user.id, post_id, f"Scheduled for {next_time}")
-                        await query.answer(f"🤖 Умное планирование: {next_time.strftime('%H:%M %d.%m')}")
-                        await show_next_post(query, context, channel_id)
-                        return
-                
-                msg = await context.bot.send_photo(
-                    chat_id=channel_id,
-                    photo=photo_file_id,
-                    caption=caption if caption else None
+            if await run_db(get_pending_post, post_id, channel_id):
+                await query.edit_message_caption(
+                    caption=query.message.caption + "\n\n⏳ Этот пост уже обрабатывает другой модератор."
+                )
+            else:
+                await query.edit_message_caption(
+                    caption=query.message.caption + "\n\n❌ Пост не найден в очереди!"
+                )
+            return
+        
+        post_id, user_id, username, photo_file_id, caption, created_at = current_post
+        
+        if action == "app":
+            from datetime import datetime, timedelta
+            try:
+                scheduled_id, publish_at, smart, publish_now = await run_db(
+                    schedule_pending_post, post_id, channel_id, user_id, username, photo_file_id, caption, query.from_user.id
                 )
-                
-                add_published_post(channel_id, user_id, username, msg.message_id)
-                add_coins(user_id, username, 10, "Мем опубликован")
-                update_streak(user_id, username)
-                check_daily_quests(user_id, username)
-                
-                conn = get_db_connection()
-                cur = conn.cursor()
-                cur.execute("SELECT COUNT(*) FROM published_posts WHERE user_id = %s", (user_id,))
-                posts_count = cur.fetchone()[0]
-                cur.close()
-                conn.close()
-                
-                achievements = check_and_award_achievements(user_id, username, posts_count)
-                rank = get_user_rank(posts_count)
-                
-                update_channel_setting(channel_id, 'last_post_time', datetime.now())
-                remove_pending_post(post_id)
-                log_action(channel_id, 'published', user_id, query.from_user.id, post_id)
-                
-                try:
-                    chat = await context.bot.get_chat(channel_id)
-                    channel_name = chat.title
-                except:
-                    channel_name = "канале"
-                
-                notif = f"🎉 Ваш контент опубликован в {channel_name}!\n💰 +10 мемкоинов\n{rank} | Мемов: {posts_count}"
-                if achievements:
-                    notif += "\n\n🏆 " + "\n🏆 ".join(achievements)
-                
-                await context.bot.send_message(chat_id=user_id, text=notif)
-                
-                await show_next_post(query, context, channel_id)
-                
             except Exception as e:
                 logger.error(f"Ошибка публикации в {channel_id}: {str(e)}")
+                await run_db(release_pending_decision, post_id)
                 await query.edit_message_caption(
                     caption=query.message.caption + "\n\n❌ ОШИБКА ПУБЛИКАЦИИ"
                 )
-        
-        elif action == "rej":
-            remove_pending_post(post_id)
-            log_action(channel_id, 'rejected', user_id, query.from_user.id, post_id)
+                return
+            
+            if not publish_now:
+                post_scheduler.add(scheduled_id, publish_at)
+                if smart:
+                    await query.answer(f"🤖 Умное планирование: {publish_at.strftime('%H:%M %d.%m')}")
+                else:
+                    await query.answer(f"⏱ Пост запланирован на {publish_at.strftime('%H:%M %d.%m')}")
+                await show_next_post(query, context, channel_id)
+                return
             
             try:
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text="😔 Ваш контент не прошел модерацию."
+                msg = await send_scheduled_photo(scheduled_id, channel_id, photo_file_id, caption)
+            except Exception as e:
+                # Пост уже одобрен и лежит в scheduled_posts: повтор отдаем планировщику
+                logger.error(f"Ошибка публикации в {channel_id}: {str(e)}")
+                slot_allocator.invalidate(channel_id)
+                retry_at = datetime.now() + timedelta(seconds=SCHEDULER_RETRY_DELAY)
+                try:
+                    await run_db(reschedule_post, scheduled_id, retry_at)
+                except Exception as db_error:
+                    logger.error(f"Error rescheduling post {scheduled_id}: {db_error}")
+                post_scheduler.add(scheduled_id, retry_at)
+                await query.edit_message_caption(
+                    caption=query.message.caption + "\n\n❌ ОШИБКА ПУБЛИКАЦИИ: повторит планировщик"
                 )
-            except:
-                pass
+                return
+            
+            if msg is not None:
+                # Пост уже в канале: в очередь его больше не возвращаем
+                channel_name = await get_channel_title(context.bot, channel_id, "канале")
+                await record_publication_safely(
+                    channel_id, user_id, username, msg.message_id, query.from_user.id,
+                    pending_post_id=post_id, scheduled_post_id=scheduled_id, channel_title=channel_name
+                )
+                notification_outbox.wake()
             
             await show_next_post(query, context, channel_id)
         
-        elif action == "ban":
-            ban_user(user_id, username, query.from_user.id, channel_id)
-            remove_pending_post(post_id)
-            log_action(channel_id, 'banned', user_id, query.from_user.id, post_id, f"User {username} banned")
-            
-            try:
-                chat = await context.bot.get_chat(channel_id)
-                channel_name = chat.title
-            except:
-                channel_name = "этом канале"
+        elif action == "rej":
+            await run_db(reject_pending_post, post_id, channel_id, user_id, query.from_user.id)
+            notification_outbox.wake()
             
-            try:
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text=f"🚫 Вы заблокированы в канале '{channel_name}' и больше не можете отправлять туда контент."
-                )
-            except:
-                pass
+            await show_next_post(query, context, channel_id)
+        
+        elif action == "ban":
+            channel_name = await get_channel_title(context.bot, channel_id, "этом канале")
+            await run_db(ban_pending_author, post_id, channel_id, user_id, username, query.from_user.id, channel_name)
+            notification_outbox.wake()
             
             await show_next_post(query, context, channel_id)
 
@@ -1449,8 +3265,9 @@ async def addchannel(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     'username': admin.user.username or admin.user.first_name or f"user_{admin.user.id}"
                 })
         
-        add_channel(channel_id, user_id)
-        update_channel_admins(channel_id, admin_list)
+        await run_db(add_channel, channel_id, user_id)
+        await run_db(update_channel_admins, channel_id, admin_list)
+        await remember_channel_info(channel_id, chat)
         
         admin_names = ", ".join([f"@{a['username']}" for a in admin_list])
         
@@ -1465,24 +3282,22 @@ async def addchannel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Ошибка при добавлении канала.")
 
 async def channels(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_channel_admin(update.effective_user.id):
+    if not await run_db(is_channel_admin, update.effective_user.id):
         await update.message.reply_text("❌ Эта команда доступна только администраторам каналов.")
         return
     
-    user_channels = get_user_channels(update.effective_user.id)
+    user_channels = await run_db(get_user_channels, update.effective_user.id)
     
     if not user_channels:
         await update.message.reply_text("📋 Вы не являетесь администратором ни одного канала.")
         return
     
+    pending_counts = await run_db(count_pending_posts, user_channels)
     response = "📋 Ваши каналы:\n\n"
     for ch_id in user_channels:
-        try:
-            chat = await context.bot.get_chat(ch_id)
-            pending_count = len(get_pending_posts(ch_id))
-            response += f"• {chat.title} ({pending_count} в очереди)\n"
-        except:
-            response += f"• {ch_id}\n"
+        channel_name = await get_channel_title(context.bot, ch_id)
+        pending_count = pending_counts.get(ch_id, 0)
+        response += f"• {channel_name} ({pending_count} в очереди)\n"
     
     await update.message.reply_text(response)
 
@@ -1509,10 +3324,7 @@ async def support(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     
     try:
-        await context.bot.send_message(
-            chat_id=SUPPORT_ADMIN_ID,
-            text=support_text
-        )
+        await outbound.send(LANE_REPLY, 'send_message', SUPPORT_ADMIN_ID, text=support_text)
         await update.message.reply_text(
             "✅ Ваше обращение отправлено в техподдержку!\n"
             "Мы ответим вам в ближайшее время."
@@ -1557,10 +3369,7 @@ async def reply_support(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"{reply_message}"
         )
         
-        await context.bot.send_message(
-            chat_id=user_id,
-            text=reply_text
-        )
+        await outbound.send(LANE_REPLY, 'send_message', user_id, text=reply_text)
         
         await update.message.reply_text(
             f"✅ Ответ отправлен пользователю {user_id}"
@@ -1575,11 +3384,11 @@ async def reply_support(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
-    if not is_channel_admin(user_id):
+    if not await run_db(is_channel_admin, user_id):
         await update.message.reply_text("❌ Эта команда доступна только администраторам.")
         return
     
-    user_channels = get_user_channels(user_id)
+    user_channels = await run_db(get_user_channels, user_id)
     
     if not user_channels:
         await update.message.reply_text("❌ Вы не являетесь администратором ни одного канала.")
@@ -1588,11 +3397,7 @@ async def settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(context.args) == 0:
         keyboard = []
         for ch_id in user_channels:
-            try:
-                chat = await context.bot.get_chat(ch_id)
-                channel_name = chat.title
-            except:
-                channel_name = ch_id
+            channel_name = await get_channel_title(context.bot, ch_id)
             short_channel_id = hashlib.sha256(ch_id.encode()).hexdigest()[:8]
             keyboard.append([InlineKeyboardButton(f"⚙️ {channel_name}", callback_data=f"set_{short_channel_id}")])
         
@@ -1608,11 +3413,11 @@ async def settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def queue(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
-    if not is_channel_admin(user_id):
+    if not await run_db(is_channel_admin, user_id):
         await update.message.reply_text("❌ Эта команда доступна только администраторам.")
         return
     
-    user_channels = get_user_channels(user_id)
+    user_channels = await run_db(get_user_channels, user_id)
     
     if not user_channels:
         await update.message.reply_text("❌ Вы не являетесь администратором ни одного канала.")
@@ -1622,14 +3427,11 @@ async def queue(update: Update, context: ContextTypes.DEFAULT_TYPE):
     has_posts = False
     
     for ch_id in user_channels:
-        scheduled = get_scheduled_posts(ch_id)
+        scheduled = await run_db(get_scheduled_posts, ch_id)
         if scheduled:
             has_posts = True
-            try:
-                chat = await context.bot.get_chat(ch_id)
-                response += f"📢 {chat.title}:\n"
-            except:
-                response += f"📢 {ch_id}:\n"
+            channel_name = await get_channel_title(context.bot, ch_id)
+            response += f"📢 {channel_name}:\n"
             
             for post in scheduled:
                 post_id, _, _, username, _, _, scheduled_time = post
@@ -1643,11 +3445,11 @@ async def queue(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def audit(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
-    if not is_channel_admin(user_id):
+    if not await run_db(is_channel_admin, user_id):
         await update.message.reply_text("❌ Эта команда доступна только администраторам.")
         return
     
-    user_channels = get_user_channels(user_id)
+    user_channels = await run_db(get_user_channels, user_id)
     
     if not user_channels:
         await update.message.reply_text("❌ Вы не являетесь администратором ни одного канала.")
@@ -1655,11 +3457,7 @@ async def audit(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     keyboard = []
     for ch_id in user_channels:
-        try:
-            chat = await context.bot.get_chat(ch_id)
-            channel_name = chat.title
-        except:
-            channel_name = ch_id
+        channel_name = await get_channel_title(context.bot, ch_id)
         short_channel_id = hashlib.sha256(ch_id.encode()).hexdigest()[:8]
         keyboard.append([InlineKeyboardButton(f"📊 {channel_name}", callback_data=f"aud_{short_channel_id}")])
     
@@ -1669,7 +3467,7 @@ async def audit(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def unban(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    user_channels = get_user_channels(user_id)
+    user_channels = await run_db(get_user_channels, user_id)
     
     if not user_channels:
         await update.message.reply_text("❌ Эта команда доступна только администраторам.")
@@ -1678,11 +3476,7 @@ async def unban(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Показываем список каналов для выбора
     keyboard = []
     for ch_id in user_channels:
-        try:
-            chat = await context.bot.get_chat(ch_id)
-            channel_name = chat.title
-        except:
-            channel_name = ch_id
+        channel_name = await get_channel_title(context.bot, ch_id)
         
         short_channel_id = hashlib.sha256(ch_id.encode()).hexdigest()[:8]
         keyboard.append([InlineKeyboardButton(
@@ -1700,29 +3494,7 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Глобальная статистика для админа
     if user_id == SUPPORT_ADMIN_ID:
         try:
-            conn = get_db_connection()
-            cur = conn.cursor()
-            
-            cur.execute("SELECT COUNT(*) FROM channels")
-            total_channels = cur.fetchone()[0]
-            
-            cur.execute("SELECT COUNT(DISTINCT user_id) FROM channel_admins")
-            total_admins = cur.fetchone()[0]
-            
-            cur.execute("SELECT COUNT(*) FROM pending_posts")
-            total_pending = cur.fetchone()[0]
-            
-            cur.execute("SELECT COUNT(*) FROM banned_users")
-            total_banned = cur.fetchone()[0]
-            
-            cur.execute("SELECT COUNT(*) FROM audit_log WHERE action = 'published'")
-            total_published = cur.fetchone()[0]
-            
-            cur.execute("SELECT COUNT(*) FROM audit_log WHERE action = 'rejected'")
-            total_rejected = cur.fetchone()[0]
-            
-            cur.close()
-            conn.close()
+            total_channels, total_admins, total_pending, total_banned, total_published, total_rejected = await run_db(get_global_stats)
             
             await update.message.reply_text(
                 f"📊 Глобальная статистика бота:\n\n"
@@ -1739,28 +3511,14 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
             logger.error(f"Error in global stats: {e}")
     
     # Статистика для обычного админа
-    user_channels = get_user_channels(user_id)
+    user_channels = await run_db(get_user_channels, user_id)
     
     if not user_channels:
         await update.message.reply_text("❌ Вы не являетесь администратором ни одного канала.")
         return
     
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        placeholders = ','.join(['%s'] * len(user_channels))
-        cur.execute(f"SELECT COUNT(*) FROM pending_posts WHERE channel_id IN ({placeholders})", user_channels)
-        pending_count = cur.fetchone()[0]
-        
-        cur.execute(f"SELECT COUNT(*) FROM banned_users WHERE channel_id IN ({placeholders})", user_channels)
-        banned_count = cur.fetchone()[0]
-        
-        cur.execute(f"SELECT COUNT(*) FROM audit_log WHERE channel_id IN ({placeholders}) AND action = 'published'", user_channels)
-        published_count = cur.fetchone()[0]
-        
-        cur.close()
-        conn.close()
+        pending_count, banned_count, published_count = await run_db(get_channels_stats, user_channels)
         
         await update.message.reply_text(
             f"📊 Статистика ваших каналов:\n\n"
@@ -1775,7 +3533,7 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        leaders = get_global_leaderboard(10)
+        leaders = await run_db(get_global_leaderboard, 10)
         
         if not leaders:
             await update.message.reply_text("🏆 Таблица лидеров пуста. Пока никто не опубликовал мемы!")
@@ -1797,7 +3555,7 @@ async def leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def topchannel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    user_channels = get_user_channels(user_id)
+    user_channels = await run_db(get_user_channels, user_id)
     
     if not user_channels:
         await update.message.reply_text("❌ Вы не являетесь администратором ни одного канала.")
@@ -1805,11 +3563,7 @@ async def topchannel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     keyboard = []
     for ch_id in user_channels:
-        try:
-            chat = await context.bot.get_chat(ch_id)
-            channel_name = chat.title
-        except:
-            channel_name = ch_id
+        channel_name = await get_channel_title(context.bot, ch_id)
         
         short_channel_id = hashlib.sha256(ch_id.encode()).hexdigest()[:8]
         keyboard.append([InlineKeyboardButton(
@@ -1826,36 +3580,15 @@ async def mystats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     username = update.effective_user.username or update.effective_user.first_name
     
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        cur.execute("SELECT COUNT(*) FROM published_posts WHERE user_id = %s", (user_id,))
-        published = cur.fetchone()[0]
-        
-        cur.execute("SELECT COUNT(*) FROM audit_log WHERE user_id = %s AND action = 'rejected'", (user_id,))
-        rejected = cur.fetchone()[0]
-        
-        cur.execute("SELECT COUNT(*) FROM pending_posts WHERE user_id = %s", (user_id,))
-        pending = cur.fetchone()[0]
+        published, rejected, pending, total_reactions = await run_db(get_user_post_stats, user_id)
         
-        cur.execute("SELECT COALESCE(SUM(reactions), 0) FROM published_posts WHERE user_id = %s", (user_id,))
-        total_reactions = cur.fetchone()[0]
-        
-        balance, total_earned = get_user_balance(user_id)
-        current_streak, longest_streak = get_streak(user_id)
+        balance, total_earned = await run_db(get_user_balance, user_id)
+        current_streak, longest_streak = await run_db(get_streak, user_id)
         
         total_sent = published + rejected + pending
         approval_rate = (published / total_sent * 100) if total_sent > 0 else 0
         
-        leaders = get_global_leaderboard(100)
-        position = None
-        for idx, (uid, uname, posts, reactions) in enumerate(leaders, 1):
-            if uid == user_id:
-                position = idx
-                break
-        
-        cur.close()
-        conn.close()
+        position = await run_db(get_leaderboard_position, user_id)
         
         rank = get_user_rank(published)
         
@@ -1873,7 +3606,7 @@ async def mystats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if position:
             response += f"🏆 Позиция: #{position}"
         else:
-            response += "🏆 Позиция: не в топ-100"
+            response += "🏆 Позиция: нет публикаций"
         
         await update.message.reply_text(response)
     except Exception as e:
@@ -1885,14 +3618,9 @@ async def balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     username = update.effective_user.username or update.effective_user.first_name
     
     try:
-        balance, total_earned = get_user_balance(user_id)
+        balance, total_earned = await run_db(get_user_balance, user_id)
         
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT amount, reason, created_at FROM coin_transactions WHERE user_id = %s ORDER BY created_at DESC LIMIT 10", (user_id,))
-        transactions = cur.fetchall()
-        cur.close()
-        conn.close()
+        transactions = await run_db(get_coin_transactions, user_id, 10)
         
         response = f"💰 Баланс @{username}\n\n"
         response += f"💵 Текущий баланс: {balance} монет\n"
@@ -1915,8 +3643,8 @@ async def quests(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     username = update.effective_user.username or update.effective_user.first_name
     
-    check_daily_quests(user_id, username)
-    quests = get_daily_quests(user_id)
+    await run_db(check_daily_quests, user_id, username)
+    quests = await run_db(get_daily_quests, user_id)
     
     response = "📋 Ежедневные задания:\n\n"
     
@@ -1940,7 +3668,7 @@ async def quests(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def shop(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    balance, _ = get_user_balance(user_id)
+    balance, _ = await run_db(get_user_balance, user_id)
     
     keyboard = [
         [InlineKeyboardButton("⚡ Приоритет (1000 монет)", callback_data="buy_priority")],
@@ -1959,22 +3687,7 @@ async def shop(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 async def weekwinner(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    from datetime import date, timedelta
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    today = date.today()
-    week_start = today - timedelta(days=today.weekday())
-    
-    cur.execute(
-        "SELECT user_id, username, COUNT(*) as posts, COALESCE(SUM(reactions), 0) as reactions "
-        "FROM published_posts WHERE DATE(published_at) >= %s "
-        "GROUP BY user_id, username ORDER BY reactions DESC LIMIT 1",
-        (week_start,)
-    )
-    winner = cur.fetchone()
-    cur.close()
-    conn.close()
+    winner = await run_db(get_week_winner)
     
     if not winner:
         await update.message.reply_text("⭐ Мем недели еще не определен!")
@@ -2033,16 +3746,7 @@ async def manual_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
         message_id = int(context.args[0])
         reactions = int(context.args[1])
         
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(
-            "UPDATE published_posts SET reactions = %s WHERE message_id = %s",
-            (reactions, message_id)
-        )
-        rows = cur.rowcount
-        conn.commit()
-        cur.close()
-        conn.close()
+        rows = await run_db(set_post_reactions_by_message_id, message_id, reactions)
         
         if rows > 0:
             await update.message.reply_text(f"✅ Обновлено! Пост {message_id}: {reactions} реакций")
@@ -2055,7 +3759,7 @@ async def manual_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(f"❌ Ошибка: {e}")
 
 # ФАЗА 4: Функции автоматизации
-def auto_moderate_content(photo_hash: str, file_size: int, caption: str, user_id: int, conn):
+def auto_moderate_content(photo_hash: str, file_size: int, caption: str, user_id: int):
     result = {'approved': True, 'confidence': 100, 'issues': [], 'warnings': []}
     spam_keywords = ['реклама', 'заработок', 'казино', 'ставки', 'кредит', 'займ']
     caption_lower = sanitize_caption(caption).lower()
@@ -2071,22 +3775,15 @@ def get_channel_analytics(channel_id: str, conn):
     cur.close()
     return {'queue_size': queue_size}
 
-def calculate_smart_schedule(channel_id: str, conn, aggressiveness: str = 'medium'):
-    from datetime import datetime, timedelta
+def calculate_smart_interval(channel_id: str, conn, aggressiveness: str = 'medium') -> int:
     analytics = get_channel_analytics(channel_id, conn)
-    now = datetime.now()
     base_intervals = {'conservative': 180, 'medium': 90, 'aggressive': 45}
     base_interval = base_intervals.get(aggressiveness, 90)
     if analytics['queue_size'] > 10:
         base_interval = max(30, base_interval - 20)
     elif analytics['queue_size'] < 3:
         base_interval += 30
-    next_time = now + timedelta(minutes=base_interval)
-    if 1 <= next_time.hour < 7:
-        next_time = next_time.replace(hour=9, minute=0)
-        if next_time < now:
-            next_time += timedelta(days=1)
-    return next_time
+    return base_interval
 
 def get_approval_rate(channel_id: str, conn):
     cur = conn.cursor()
@@ -2116,70 +3813,76 @@ def get_growth_stats(channel_id: str, conn):
     posts_growth = ((posts_week - posts_prev_week) / posts_prev_week * 100) if posts_prev_week > 0 else 0
     return {'posts_week': posts_week, 'posts_prev_week': posts_prev_week, 'posts_growth': posts_growth}
 
-async def lootbox(update: Update, context: ContextTypes.DEFAULT_TYPE):
+def open_lootbox(user_id: int, username: str):
     import random
+    from datetime import date
+    # Выдача коробок, открытие и начисления - одна транзакция на одном соединении
+    with db_cursor() as cur:
+        posts = get_user_stats(user_id, cur)['published']
+        cur.execute("SELECT COUNT(*) FROM lootboxes WHERE user_id = %s AND opened = FALSE", (user_id,))
+        available = cur.fetchone()[0]
+        earned = posts // 10
+        cur.execute("SELECT COUNT(*) FROM lootboxes WHERE user_id = %s", (user_id,))
+        total = cur.fetchone()[0]
+        if earned > total:
+            for _ in range(earned - total):
+                cur.execute("INSERT INTO lootboxes (user_id, username, box_type) VALUES (%s, %s, 'standard')", (user_id, username))
+            available = earned - total
+        if available == 0:
+            return posts, available, None
+        cur.execute("SELECT id FROM lootboxes WHERE user_id = %s AND opened = FALSE LIMIT 1", (user_id,))
+        box_id = cur.fetchone()[0]
+        roll = random.random()
+        reward = 500 if roll < 0.01 else 200 if roll < 0.10 else random.randint(20, 100)
+        cur.execute("INSERT INTO lootbox_rewards (lootbox_id, reward_type, reward_value) VALUES (%s, 'coins', %s)", (box_id, reward))
+        cur.execute("UPDATE lootboxes SET opened = TRUE WHERE id = %s", (box_id,))
+        awards = [(reward, "🎁 Лутбокс")]
+        
+        today = date.today()
+        cur.execute("SELECT completed FROM daily_quests WHERE user_id = %s AND quest_date = %s AND quest_type = 'open_lootbox'", (user_id, today))
+        quest_result = cur.fetchone()
+        if quest_result and not quest_result[0]:
+            cur.execute("UPDATE daily_quests SET completed = TRUE, completed_at = CURRENT_TIMESTAMP WHERE user_id = %s AND quest_date = %s AND quest_type = 'open_lootbox'", (user_id, today))
+            awards.append((20, "✅ Задание: Открыть лутбокс"))
+        credit_coins(cur, user_id, username, awards)
+    return posts, available, reward
+
+def get_channel_analytics_report(channel_id: str):
+    with db_connection() as conn:
+        growth = get_growth_stats(channel_id, conn)
+        approval = get_approval_rate(channel_id, conn)
+        top_authors = get_top_authors(channel_id, conn, 3)
+        analytics_data = get_channel_analytics(channel_id, conn)
+    return growth, approval, top_authors, analytics_data
+
+async def lootbox(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     username = update.effective_user.username or update.effective_user.first_name
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT COUNT(*) FROM published_posts WHERE user_id = %s", (user_id,))
-    posts = cur.fetchone()[0]
-    cur.execute("SELECT COUNT(*) FROM lootboxes WHERE user_id = %s AND opened = FALSE", (user_id,))
-    available = cur.fetchone()[0]
-    earned = posts // 10
-    cur.execute("SELECT COUNT(*) FROM lootboxes WHERE user_id = %s", (user_id,))
-    total = cur.fetchone()[0]
-    if earned > total:
-        for _ in range(earned - total):
-            cur.execute("INSERT INTO lootboxes (user_id, username, box_type) VALUES (%s, %s, 'standard')", (user_id, username))
-        conn.commit()
-        available = earned - total
-    if available == 0:
+    posts, available, reward = await run_db(open_lootbox, user_id, username)
+    if reward is None:
         await update.message.reply_text(f"📦 Нет лутбоксов!\n\nОпубликуйте {10 - (posts % 10)} мемов для следующего.")
-        cur.close()
-        conn.close()
         return
-    cur.execute("SELECT id FROM lootboxes WHERE user_id = %s AND opened = FALSE LIMIT 1", (user_id,))
-    box_id = cur.fetchone()[0]
-    roll = random.random()
-    reward = 500 if roll < 0.01 else 200 if roll < 0.10 else random.randint(20, 100)
-    cur.execute("INSERT INTO lootbox_rewards (lootbox_id, reward_type, reward_value) VALUES (%s, 'coins', %s)", (box_id, reward))
-    cur.execute("UPDATE lootboxes SET opened = TRUE WHERE id = %s", (box_id,))
-    conn.commit()
-    add_coins(user_id, username, reward, "🎁 Лутбокс")
-    
-    from datetime import date
-    today = date.today()
-    cur.execute("SELECT completed FROM daily_quests WHERE user_id = %s AND quest_date = %s AND quest_type = 'open_lootbox'", (user_id, today))
-    quest_result = cur.fetchone()
-    if quest_result and not quest_result[0]:
-        cur.execute("UPDATE daily_quests SET completed = TRUE, completed_at = CURRENT_TIMESTAMP WHERE user_id = %s AND quest_date = %s AND quest_type = 'open_lootbox'", (user_id, today))
-        add_coins(user_id, username, 20, "✅ Задание: Открыть лутбокс")
-        conn.commit()
-    
-    cur.close()
-    conn.close()
     await update.message.reply_text(f"🎁 Лутбокс открыт!\n\n💰 +{reward} монет\n📦 Осталось: {available - 1}")
 
-async def referral(update: Update, context: ContextTypes.DEFAULT_TYPE):
+def get_referral_info(user_id: int):
     from datetime import datetime
+    with db_cursor() as cur:
+        cur.execute("SELECT code FROM referral_codes WHERE user_id = %s", (user_id,))
+        result = cur.fetchone()
+        if not result:
+            code = hashlib.sha256(f"{user_id}{datetime.now()}".encode()).hexdigest()[:8]
+            cur.execute("INSERT INTO referral_codes (user_id, code) VALUES (%s, %s)", (user_id, code))
+        else:
+            code = result[0]
+        cur.execute("SELECT total_referrals FROM referral_codes WHERE user_id = %s", (user_id,))
+        total = cur.fetchone()[0]
+        cur.execute("SELECT COUNT(*) FROM referrals WHERE referrer_id = %s AND reward_claimed = TRUE", (user_id,))
+        rewarded = cur.fetchone()[0]
+    return code, total, rewarded
+
+async def referral(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT code FROM referral_codes WHERE user_id = %s", (user_id,))
-    result = cur.fetchone()
-    if not result:
-        code = hashlib.sha256(f"{user_id}{datetime.now()}".encode()).hexdigest()[:8]
-        cur.execute("INSERT INTO referral_codes (user_id, code) VALUES (%s, %s)", (user_id, code))
-        conn.commit()
-    else:
-        code = result[0]
-    cur.execute("SELECT total_referrals FROM referral_codes WHERE user_id = %s", (user_id,))
-    total = cur.fetchone()[0]
-    cur.execute("SELECT COUNT(*) FROM referrals WHERE referrer_id = %s AND reward_claimed = TRUE", (user_id,))
-    rewarded = cur.fetchone()[0]
-    cur.close()
-    conn.close()
+    code, total, rewarded = await run_db(get_referral_info, user_id)
     bot_username = (await context.bot.get_me()).username
     link = f"https://t.me/{bot_username}?start=ref_{code}"
     await update.message.reply_text(f"🎁 Реферальная программа\n\n👥 Приглашено: {total}\n💰 Награды: {rewarded}\n\n🔗 Ваша ссылка:\n{link}\n\n💵 +100 монет за друга\n💵 +50 когда друг опубликует 5 мемов")
@@ -2187,7 +3890,7 @@ async def referral(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
-    if not is_channel_admin(user_id):
+    if not await run_db(is_channel_admin, user_id):
         await update.message.reply_text("❌ Эта команда доступна только администраторам каналов.")
         return
     
@@ -2209,24 +3912,55 @@ async def admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=reply_markup
     )
 
-async def post_init(application: Application):
+def init_db():
     # Создаем таблицу для очереди постов
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
+    with db_cursor() as cur:
         cur.execute("""
-            CREATE TABLE IF NOT EXISTS pending_posts (
+            CREATE TABLE IF NOT EXISTS submissions (
                 id SERIAL PRIMARY KEY,
-                channel_id VARCHAR(255),
                 user_id BIGINT,
                 username VARCHAR(255),
                 photo_file_id VARCHAR(255),
+                photo_unique_id VARCHAR(255),
                 caption TEXT,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         """)
         
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS pending_posts (
+                id SERIAL PRIMARY KEY,
+                channel_id VARCHAR(255),
+                user_id BIGINT,
+                submission_id INTEGER REFERENCES submissions(id),
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        cur.execute("ALTER TABLE pending_posts ADD COLUMN IF NOT EXISTS submission_id INTEGER REFERENCES submissions(id)")
+        cur.execute("ALTER TABLE pending_posts ADD COLUMN IF NOT EXISTS claimed_by BIGINT")
+        cur.execute("ALTER TABLE pending_posts ADD COLUMN IF NOT EXISTS claimed_until TIMESTAMP")
+        cur.execute("ALTER TABLE pending_posts ADD COLUMN IF NOT EXISTS processing BOOLEAN DEFAULT FALSE")
+        cur.execute("ALTER TABLE pending_posts ADD COLUMN IF NOT EXISTS priority INTEGER NOT NULL DEFAULT 0")
+        
+        # Переносим медиа старых записей очереди в submissions (одна запись на одинаковый пост автора)
+        cur.execute("SELECT 1 FROM information_schema.columns WHERE table_name = 'pending_posts' AND column_name = 'photo_file_id'")
+        if cur.fetchone():
+            cur.execute("""
+                WITH created AS (
+                    INSERT INTO submissions (user_id, username, photo_file_id, caption, created_at)
+                    SELECT user_id, MAX(username), photo_file_id, caption, MIN(created_at)
+                    FROM pending_posts WHERE submission_id IS NULL
+                    GROUP BY user_id, photo_file_id, caption
+                    RETURNING id, user_id, photo_file_id, caption
+                )
+                UPDATE pending_posts p SET submission_id = c.id FROM created c
+                WHERE p.submission_id IS NULL
+                  AND p.user_id IS NOT DISTINCT FROM c.user_id
+                  AND p.photo_file_id IS NOT DISTINCT FROM c.photo_file_id
+                  AND p.caption IS NOT DISTINCT FROM c.caption
+            """)
+            cur.execute("ALTER TABLE pending_posts DROP COLUMN username, DROP COLUMN photo_file_id, DROP COLUMN caption")
+    
         cur.execute("""
             CREATE TABLE IF NOT EXISTS banned_users (
                 user_id BIGINT,
@@ -2237,7 +3971,7 @@ async def post_init(application: Application):
                 PRIMARY KEY (user_id, channel_id)
             )
         """)
-        
+    
         cur.execute("""
             CREATE TABLE IF NOT EXISTS channels (
                 channel_id VARCHAR(255) PRIMARY KEY,
@@ -2245,7 +3979,7 @@ async def post_init(application: Application):
                 added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         """)
-        
+    
         cur.execute("""
             CREATE TABLE IF NOT EXISTS channel_admins (
                 channel_id VARCHAR(255),
@@ -2255,7 +3989,7 @@ async def post_init(application: Application):
                 PRIMARY KEY (channel_id, user_id)
             )
         """)
-        
+    
         cur.execute("""
             CREATE TABLE IF NOT EXISTS channel_settings (
                 channel_id VARCHAR(255) PRIMARY KEY,
@@ -2269,7 +4003,7 @@ async def post_init(application: Application):
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         """)
-        
+    
         cur.execute("""
             CREATE TABLE IF NOT EXISTS scheduled_posts (
                 id SERIAL PRIMARY KEY,
@@ -2279,10 +4013,14 @@ async def post_init(application: Application):
                 photo_file_id VARCHAR(255),
                 caption TEXT,
                 scheduled_time TIMESTAMP,
+                claimed_until TIMESTAMP,
+                claimed_by VARCHAR(64),
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         """)
-        
+        cur.execute("ALTER TABLE scheduled_posts ADD COLUMN IF NOT EXISTS claimed_until TIMESTAMP")
+        cur.execute("ALTER TABLE scheduled_posts ADD COLUMN IF NOT EXISTS claimed_by VARCHAR(64)")
+    
         cur.execute("""
             CREATE TABLE IF NOT EXISTS audit_log (
                 id SERIAL PRIMARY KEY,
@@ -2295,7 +4033,7 @@ async def post_init(application: Application):
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         """)
-        
+    
         cur.execute("""
             CREATE TABLE IF NOT EXISTS published_posts (
                 id SERIAL PRIMARY KEY,
@@ -2307,7 +4045,7 @@ async def post_init(application: Application):
                 published_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         """)
-        
+    
         cur.execute("""
             CREATE TABLE IF NOT EXISTS user_coins (
                 user_id BIGINT PRIMARY KEY,
@@ -2317,7 +4055,7 @@ async def post_init(application: Application):
                 updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         """)
-        
+    
         cur.execute("""
             CREATE TABLE IF NOT EXISTS coin_transactions (
                 id SERIAL PRIMARY KEY,
@@ -2327,20 +4065,147 @@ async def post_init(application: Application):
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         """)
+    
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS user_stats (
+                user_id BIGINT PRIMARY KEY,
+                username VARCHAR(255),
+                published INTEGER DEFAULT 0,
+                rejected INTEGER DEFAULT 0,
+                pending INTEGER DEFAULT 0,
+                reactions BIGINT DEFAULT 0,
+                posts_today INTEGER DEFAULT 0,
+                last_post_date DATE,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        
+        # Первичное заполнение счетчиков из истории (только для пустой таблицы)
+        cur.execute("SELECT EXISTS (SELECT 1 FROM user_stats)")
+        if not cur.fetchone()[0]:
+            cur.execute("""
+                INSERT INTO user_stats (user_id, username, published, rejected, pending, reactions, posts_today, last_post_date)
+                SELECT user_id, MAX(username), SUM(published), SUM(rejected), SUM(pending), SUM(reactions), SUM(posts_today), MAX(last_post_date)
+                FROM (
+                    SELECT user_id, MAX(username) AS username, COUNT(*) AS published, 0 AS rejected, 0 AS pending,
+                           COALESCE(SUM(reactions), 0) AS reactions,
+                           COUNT(*) FILTER (WHERE published_at >= CURRENT_DATE) AS posts_today,
+                           MAX(published_at)::date AS last_post_date
+                    FROM published_posts GROUP BY user_id
+                    UNION ALL
+                    SELECT user_id, NULL, 0, COUNT(*), 0, 0, 0, NULL
+                    FROM audit_log WHERE action = 'rejected' AND user_id IS NOT NULL GROUP BY user_id
+                    UNION ALL
+                    SELECT user_id, NULL, 0, 0, COUNT(*), 0, 0, NULL
+                    FROM pending_posts GROUP BY user_id
+                ) history
+                WHERE user_id IS NOT NULL
+                GROUP BY user_id
+                ON CONFLICT (user_id) DO NOTHING
+            """)
+    
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS leaderboard_scores (
+                scope VARCHAR(255),
+                user_id BIGINT,
+                username VARCHAR(255),
+                posts INTEGER DEFAULT 0,
+                reactions BIGINT DEFAULT 0,
+                PRIMARY KEY (scope, user_id)
+            )
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_leaderboard_scores_rank ON leaderboard_scores(scope, reactions DESC, posts DESC, user_id)")
+        
+        cur.execute("SELECT EXISTS (SELECT 1 FROM leaderboard_scores)")
+        if not cur.fetchone()[0]:
+            cur.execute("""
+                INSERT INTO leaderboard_scores (scope, user_id, username, posts, reactions)
+                SELECT CASE WHEN GROUPING(channel_id) = 1 THEN '' ELSE channel_id END,
+                       user_id, MAX(username), COUNT(*), COALESCE(SUM(reactions), 0)
+                FROM published_posts WHERE user_id IS NOT NULL
+                GROUP BY GROUPING SETS ((channel_id, user_id), (user_id))
+                HAVING GROUPING(channel_id) = 1 OR channel_id IS NOT NULL
+                ON CONFLICT (scope, user_id) DO NOTHING
+            """)
+    
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS channel_engagement (
+                channel_id VARCHAR(255) PRIMARY KEY,
+                posts INTEGER[] NOT NULL,
+                reactions INTEGER[] NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        
+        # Однократно строим гистограмму по уже опубликованным постам, дальше она ведется приращениями
+        cur.execute("SELECT EXISTS (SELECT 1 FROM channel_engagement)")
+        if not cur.fetchone()[0]:
+            cur.execute("""
+                INSERT INTO channel_engagement (channel_id, posts, reactions)
+                SELECT c.channel_id,
+                       array_agg(COALESCE(h.posts, 0) ORDER BY b.bucket),
+                       array_agg(COALESCE(h.reactions, 0) ORDER BY b.bucket)
+                FROM (SELECT DISTINCT channel_id FROM published_posts WHERE channel_id IS NOT NULL) c
+                CROSS JOIN generate_series(0, 167) AS b(bucket)
+                LEFT JOIN (
+                    SELECT channel_id,
+                           (EXTRACT(ISODOW FROM published_at)::int - 1) * 24 + EXTRACT(HOUR FROM published_at)::int AS bucket,
+                           COUNT(*)::int AS posts, COALESCE(SUM(reactions), 0)::int AS reactions
+                    FROM published_posts WHERE published_at IS NOT NULL
+                    GROUP BY 1, 2
+                ) h ON h.channel_id = c.channel_id AND h.bucket = b.bucket
+                GROUP BY c.channel_id
+                ON CONFLICT (channel_id) DO NOTHING
+            """)
+    
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS notification_outbox (
+                id BIGSERIAL PRIMARY KEY,
+                user_id BIGINT NOT NULL,
+                text TEXT NOT NULL,
+                status VARCHAR(16) DEFAULT 'pending',
+                attempts INTEGER DEFAULT 0,
+                next_attempt_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                last_error TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_notification_outbox_due ON notification_outbox(next_attempt_at, id) WHERE status = 'pending'")
+        
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS user_state (
+                user_id BIGINT PRIMARY KEY,
+                data JSONB NOT NULL,
+                version BIGINT DEFAULT 1,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
         
         cur.execute("CREATE INDEX IF NOT EXISTS idx_transactions_user ON coin_transactions(user_id)")
         cur.execute("CREATE INDEX IF NOT EXISTS idx_published_posts_user ON published_posts(user_id)")
         cur.execute("CREATE INDEX IF NOT EXISTS idx_published_posts_channel ON published_posts(channel_id)")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_pending_posts_channel ON pending_posts(channel_id)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_pending_posts_channel_priority ON pending_posts(channel_id, priority DESC, created_at, id)")
+        cur.execute("DROP INDEX IF EXISTS idx_pending_posts_channel_created")
+        cur.execute("DROP INDEX IF EXISTS idx_pending_posts_channel")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_pending_posts_submission ON pending_posts(submission_id)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_submissions_photo_unique ON submissions(photo_unique_id)")
         cur.execute("CREATE INDEX IF NOT EXISTS idx_audit_log_channel ON audit_log(channel_id)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_scheduled_posts_time ON scheduled_posts(scheduled_time)")
         cur.execute("CREATE INDEX IF NOT EXISTS idx_banned_users_user ON banned_users(user_id)")
         
-        conn.commit()
-        cur.close()
-        conn.close()
-        
+        cur.execute("ALTER TABLE channels ADD COLUMN IF NOT EXISTS chat_id BIGINT")
+        cur.execute("ALTER TABLE channels ADD COLUMN IF NOT EXISTS title VARCHAR(255)")
+        cur.execute("ALTER TABLE channels ADD COLUMN IF NOT EXISTS username VARCHAR(255)")
+        cur.execute("ALTER TABLE channels ADD COLUMN IF NOT EXISTS chat_type VARCHAR(32)")
+        cur.execute("ALTER TABLE channel_settings ADD COLUMN IF NOT EXISTS smart_mode BOOLEAN DEFAULT FALSE")
+        cur.execute("ALTER TABLE channel_settings ADD COLUMN IF NOT EXISTS aggressiveness VARCHAR(32) DEFAULT 'medium'")
+        cur.execute("ALTER TABLE channel_settings ADD COLUMN IF NOT EXISTS auto_moderation BOOLEAN DEFAULT FALSE")
+
+async def post_init(application: Application):
+    try:
+        await warm_channel_info_cache()
     except Exception as e:
-        logger.error(f"Error creating tables: {e}")
+        logger.error(f"Error warming channel info cache: {e}")
     
     commands = [
         BotCommand("start", "Начать работу с ботом"),
@@ -2358,92 +4223,340 @@ async def post_init(application: Application):
     await application.bot.set_my_commands(commands)
     logger.info("Меню команд настроено!")
 
-async def update_reactions(context: ContextTypes.DEFAULT_TYPE):
-    """Обновляет количество реакций для последних 50 постов"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT id, channel_id, message_id FROM published_posts "
-        "WHERE published_at > NOW() - INTERVAL '7 days' "
-        "ORDER BY published_at DESC LIMIT 50"
-    )
-    posts = cur.fetchall()
-    cur.close()
-    conn.close()
-    
-    for post_id, channel_id, message_id in posts:
+class PostScheduler:
+    """Планировщик отложенных постов: держит min-heap дедлайнов и спит до ближайшего"""
+
+    def __init__(self):
+        self._heap = []
+        self._deadlines = {}
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._bot = None
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def add(self, post_id: int, scheduled_time):
+        self._deadlines[post_id] = scheduled_time
+        heapq.heappush(self._heap, (scheduled_time, post_id))
+        # Будим цикл, только если новый пост стал ближайшим дедлайном
+        if self._heap[0][1] == post_id:
+            self._wakeup.set()
+
+    def discard(self, post_id: int):
+        # Запись в куче остается и пропускается при извлечении
+        self._deadlines.pop(post_id, None)
+
+    async def load(self):
+        rows = await run_db(get_scheduled_post_times)
+        self._deadlines = {post_id: scheduled_time for post_id, scheduled_time in rows}
+        self._heap = [(scheduled_time, post_id) for post_id, scheduled_time in rows]
+        heapq.heapify(self._heap)
+        self._wakeup.set()
+        logger.info(f"[SCHEDULER] Loaded {len(rows)} scheduled posts")
+
+    async def start(self, bot):
+        self._bot = bot
         try:
-            msg = await context.bot.forward_message(
-                chat_id=channel_id,
-                from_chat_id=channel_id,
-                message_id=message_id
-            )
-            # Telegram API не дает прямого доступа к реакциям через Bot API
-            # Это заглушка для будущей реализации через MTProto
-        except:
-            pass
+            await self.load()
+        except Exception as e:
+            logger.error(f"[SCHEDULER] Error loading scheduled posts: {e}")
+        self._task = asyncio.create_task(self._run())
 
-async def publish_scheduled_posts(context: ContextTypes.DEFAULT_TYPE):
-    from datetime import datetime
-    now = datetime.now()
-    scheduled = get_scheduled_posts()
-    logger.info(f"[SCHEDULER] Current time: {now}, Checking scheduled posts: {len(scheduled)} found")
-    
-    for post in scheduled:
-        post_id, channel_id, user_id, username, photo_file_id, caption, scheduled_time = post
-        logger.info(f"[SCHEDULER] Post {post_id}: scheduled for {scheduled_time}, current time {now}")
-        
-        if scheduled_time > now:
-            logger.info(f"[SCHEDULER] Post {post_id} not ready yet (scheduled: {scheduled_time}, now: {now})")
-            break
-            
-        logger.info(f"[SCHEDULER] Publishing post {post_id} to channel {channel_id}")
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _pop_due(self, now) -> list:
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            scheduled_time, post_id = heapq.heappop(self._heap)
+            # Пропускаем удаленные и перенесенные записи
+            if self._deadlines.get(post_id) != scheduled_time:
+                continue
+            del self._deadlines[post_id]
+            due.append(post_id)
+        return due
+
+    async def _run(self):
+        from datetime import datetime
+        last_resync = time.monotonic()
+        while True:
+            try:
+                self._wakeup.clear()
+                now = datetime.now()
+                due = self._pop_due(now)
+                if due:
+                    await self._publish_due(due)
+                    continue
+                
+                if time.monotonic() - last_resync >= SCHEDULER_RESYNC_INTERVAL:
+                    # Подхватываем посты, добавленные в обход планировщика
+                    await self.load()
+                    last_resync = time.monotonic()
+                    continue
+                
+                timeout = SCHEDULER_RESYNC_INTERVAL - (time.monotonic() - last_resync)
+                if self._heap:
+                    timeout = min(timeout, (self._heap[0][0] - now).total_seconds())
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=max(timeout, 0))
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"[SCHEDULER] Error in scheduler loop: {e}")
+                await asyncio.sleep(SCHEDULER_RETRY_DELAY)
+
+    async def _publish_due(self, post_ids: list):
+        from datetime import datetime, timedelta
+        # Небольшими пачками, чтобы другие реплики могли параллельно забрать остаток
+        for start in range(0, len(post_ids), SCHEDULER_CLAIM_BATCH):
+            try:
+                posts, busy = await run_db(claim_scheduled_posts, post_ids[start:start + SCHEDULER_CLAIM_BATCH], datetime.now())
+            except Exception:
+                # Уже извлеченные из кучи посты не теряем до следующей пересинхронизации
+                retry_at = datetime.now() + timedelta(seconds=SCHEDULER_RETRY_DELAY)
+                for post_id in post_ids[start:]:
+                    self.add(post_id, retry_at)
+                raise
+            # Чужую аренду перепроверим после ее окончания: вдруг та реплика не смогла ни опубликовать, ни перенести
+            for post_id, retry_at in busy:
+                self.add(post_id, retry_at)
+            if posts:
+                logger.info(f"[SCHEDULER] {len(posts)} scheduled posts claimed")
+                await self._publish_claimed(posts)
+
+    async def _publish_claimed(self, posts: list):
+        from datetime import datetime, timedelta
+        for post in posts:
+            post_id, channel_id, user_id, username, photo_file_id, caption, scheduled_time = post
+            now = datetime.now()
+            # Ошибка по одному посту снимает аренду только с него, остальные посты пачки публикуются дальше
+            try:
+                # Соблюдаем интервал канала: если предыдущий пост вышел недавно, переносим
+                interval, last_post = await run_db(get_channel_pacing, channel_id)
+                if interval and last_post:
+                    next_post_time = last_post + timedelta(minutes=interval)
+                    if now < next_post_time:
+                        await run_db(reschedule_post, post_id, next_post_time)
+                        slot_allocator.invalidate(channel_id)
+                        self.add(post_id, next_post_time)
+                        logger.info(f"[SCHEDULER] Post {post_id} moved to {next_post_time} by channel interval")
+                        continue
+                
+                lag = (now - scheduled_time).total_seconds()
+                METRICS['scheduler_lag_seconds'] = lag
+                METRICS['scheduler_lag_seconds_max'] = max(METRICS['scheduler_lag_seconds_max'], lag)
+                
+                if await publish_scheduled_post(self._bot, post):
+                    METRICS['scheduler_published_total'] += 1
+            except Exception as e:
+                METRICS['scheduler_failed_total'] += 1
+                logger.error(f"[SCHEDULER] Error publishing post {post_id}: {e}")
+                retry_at = now + timedelta(seconds=SCHEDULER_RETRY_DELAY)
+                try:
+                    await run_db(reschedule_post, post_id, retry_at)
+                except Exception as db_error:
+                    # Аренда истечет сама, пост подхватит любая реплика
+                    logger.error(f"[SCHEDULER] Error rescheduling post {post_id}: {db_error}")
+                self.add(post_id, retry_at)
+
+post_scheduler = PostScheduler()
+
+class AdvisoryLeader:
+    """Выбор лидера через сессионную advisory-блокировку Postgres на выделенном соединении.
+    Блокировка живет, пока жива сессия: лидер периодически проверяет соединение (продление аренды),
+    остальные реплики периодически пытаются ее захватить"""
+
+    def __init__(self, name: str, renew_interval: int):
+        self.name = name
+        self.renew_interval = renew_interval
+        self.key = int.from_bytes(hashlib.sha1(name.encode()).digest()[:8], 'big', signed=True)
+        self.is_leader = False
+        self._conn = None
+        self._task = None
+
+    def _close(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+
+    def _renew(self) -> bool:
         try:
-            msg = await context.bot.send_photo(
-                chat_id=channel_id,
-                photo=photo_file_id,
-                caption=caption if caption else None
-            )
-            add_published_post(channel_id, user_id, username, msg.message_id)
-            add_coins(user_id, username, 10, "Мем опубликован")
-            update_streak(user_id, username)
-            check_daily_quests(user_id, username)
-            
-            conn = get_db_connection()
-            cur = conn.cursor()
-            cur.execute("SELECT COUNT(*) FROM published_posts WHERE user_id = %s", (user_id,))
-            posts_count = cur.fetchone()[0]
-            cur.close()
-            conn.close()
-            
-            achievements = check_and_award_achievements(user_id, username, posts_count)
-            rank = get_user_rank(posts_count)
-            
-            update_channel_setting(channel_id, 'last_post_time', datetime.now())
-            remove_scheduled_post(post_id)
-            log_action(channel_id, 'auto_published', user_id, 0, post_id, 'Published by scheduler')
-            logger.info(f"[SCHEDULER] Successfully published post {post_id}")
-            
+            if self._conn is None or self._conn.closed:
+                self.is_leader = False
+                self._conn = psycopg2.connect(DATABASE_URL, keepalives=1, keepalives_idle=self.renew_interval)
+                self._conn.autocommit = True
+            with self._conn.cursor() as cur:
+                if self.is_leader:
+                    cur.execute("SELECT 1")
+                    return True
+                cur.execute("SELECT pg_try_advisory_lock(%s)", (self.key,))
+                return cur.fetchone()[0]
+        except psycopg2.Error as e:
+            logger.warning(f"[LEADER] {self.name}: lost database session: {e}")
+            self._close()
+            return False
+
+    def _release(self):
+        if self.is_leader and self._conn is not None and not self._conn.closed:
             try:
-                notif = f"🎉 Ваш контент опубликован!\n💰 +10 мемкоинов\n{rank} | Мемов: {posts_count}"
-                if achievements:
-                    notif += "\n\n🏆 " + "\n🏆 ".join(achievements)
-                await context.bot.send_message(chat_id=user_id, text=notif)
-            except:
+                with self._conn.cursor() as cur:
+                    cur.execute("SELECT pg_advisory_unlock(%s)", (self.key,))
+            except psycopg2.Error:
                 pass
-            
-            break
+        self.is_leader = False
+        self._close()
+
+    async def _run(self):
+        while True:
+            try:
+                leader = await run_db(self._renew)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Без этого одна неожиданная ошибка навсегда остановила бы выборы на реплике
+                logger.error(f"[LEADER] {self.name}: error renewing leadership: {e}")
+                await run_db(self._close)
+                leader = False
+            if leader != self.is_leader:
+                logger.info(f"[LEADER] {self.name}: {'acquired' if leader else 'lost'} leadership")
+            self.is_leader = leader
+            METRICS['leader'] = int(leader)
+            await asyncio.sleep(self.renew_interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await run_db(self._release)
+
+job_leader = AdvisoryLeader('memebot:singleton-jobs', LEADER_RENEW_INTERVAL)
+
+# Сколько раз повторить запись уже отправленной публикации
+RECORD_PUBLICATION_ATTEMPTS = 3
+
+async def record_publication_safely(channel_id: str, user_id: int, username: str, message_id: int, admin_id: int,
+                                    pending_post_id: int = None, scheduled_post_id: int = None, **kwargs):
+    """record_publication после успешной отправки в канал. Ошибку не пробрасываем: иначе вызывающий
+    вернул бы пост в очередь и он вышел бы дважды. Если записать так и не вышло, просто убираем пост из очередей"""
+    for attempt in range(RECORD_PUBLICATION_ATTEMPTS):
+        try:
+            return await run_db(
+                record_publication, channel_id, user_id, username, message_id, admin_id,
+                pending_post_id=pending_post_id, scheduled_post_id=scheduled_post_id, **kwargs
+            )
+        except Exception as e:
+            logger.error(f"Error recording publication of message {message_id} in {channel_id} (attempt {attempt + 1}): {e}")
+            await asyncio.sleep(2 ** attempt)
+    try:
+        await run_db(forget_published_post, pending_post_id, scheduled_post_id)
+    except Exception as e:
+        logger.critical(f"Message {message_id} published in {channel_id} but could not be removed from the queue: {e}")
+    return None
+
+async def hold_scheduled_claim(post_id: int):
+    # Отправка может стоять в очереди за флуд-паузой дольше аренды: продлеваем ее, пока ждем
+    while True:
+        await asyncio.sleep(SCHEDULER_CLAIM_LEASE / 3)
+        try:
+            if not await run_db(renew_scheduled_claim, post_id):
+                logger.warning(f"[SCHEDULER] Lost claim on post {post_id} while sending")
+                return
         except Exception as e:
-            logger.error(f"[SCHEDULER] Error publishing post {post_id}: {e}")
+            logger.error(f"[SCHEDULER] Error renewing claim on post {post_id}: {e}")
+
+async def send_scheduled_photo(post_id: int, channel_id: str, photo_file_id: str, caption: str):
+    """Отправляет арендованный пост, удерживая аренду до ответа Bot API. None, если аренду забрала другая реплика"""
+    if not await run_db(renew_scheduled_claim, post_id):
+        logger.warning(f"[SCHEDULER] Post {post_id} is claimed by another replica, skipping")
+        return None
+    keeper = asyncio.create_task(hold_scheduled_claim(post_id))
+    try:
+        return await outbound.send(
+            LANE_PUBLISH, 'send_photo', channel_id,
+            photo=photo_file_id,
+            caption=caption if caption else None
+        )
+    finally:
+        keeper.cancel()
+
+async def publish_scheduled_post(bot, post) -> bool:
+    post_id, channel_id, user_id, username, photo_file_id, caption, scheduled_time = post
+    logger.info(f"[SCHEDULER] Publishing post {post_id} to channel {channel_id}")
+    
+    msg = await send_scheduled_photo(post_id, channel_id, photo_file_id, caption)
+    if msg is None:
+        return False
+    await record_publication_safely(
+        channel_id, user_id, username, msg.message_id, 0,
+        scheduled_post_id=post_id, action='auto_published', details='Published by scheduler'
+    )
+    notification_outbox.wake()
+    logger.info(f"[SCHEDULER] Successfully published post {post_id}")
+    return True
 
 async def health(request):
     return web.Response(text="OK")
 
+async def metrics(request):
+    METRICS['scheduler_queue_size'] = len(post_scheduler)
+    METRICS['outbound_queue_size'] = len(outbound)
+    METRICS['outbox_pending'], METRICS['outbox_dead'] = await run_db(count_notifications)
+    lines = [f"{name} {value}" for name, value in METRICS.items()]
+    return web.Response(text="\n".join(lines) + "\n")
+
+async def telegram_webhook(request):
+    # Telegram передает секрет в заголовке; без совпадения апдейт не принимаем
+    secret = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not hmac.compare_digest(secret, WEBHOOK_SECRET or ''):
+        return web.Response(status=403)
+    application = request.app.get('bot')
+    if application is None:
+        return web.Response(status=503)
+    try:
+        update = Update.de_json(await request.json(), application.bot)
+    except ValueError:
+        return web.Response(status=400)
+    try:
+        application.update_queue.put_nowait(update)
+    except asyncio.QueueFull:
+        # Очередь переполнена: не-2xx заставит Telegram повторить доставку позже
+        METRICS['webhook_rejected_total'] += 1
+        return web.Response(status=503)
+    METRICS['webhook_updates_total'] += 1
+    return web.Response()
+
 async def start_bot():
-    application = Application.builder().token(BOT_TOKEN).post_init(post_init).build()
+    # Обработчики не блокируют event loop на запросах к БД, поэтому апдейты можно обрабатывать параллельно.
+    # Очередь апдейтов ограничена и для вебхука, и для polling
+    application = (
+        Application.builder().token(BOT_TOKEN)
+        .persistence(PostgresPersistence(PERSISTENCE_INTERVAL, PERSISTENCE_FLUSH_DELAY, PERSISTENCE_REFRESH))
+        .update_queue(asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE))
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .build()
+    )
     
     if application.job_queue:
-        application.job_queue.run_repeating(publish_scheduled_posts, interval=60, first=10)
+        application.job_queue.run_repeating(refresh_channel_info_cache, interval=CHAT_CACHE_REFRESH_INTERVAL, first=5)
     else:
         logger.warning("JobQueue не доступен. Установите: pip install python-telegram-bot[job-queue]")
     
@@ -2473,10 +4586,33 @@ async def start_bot():
     application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
     application.add_handler(CallbackQueryHandler(button_callback))
+    application.add_handler(ChatMemberHandler(handle_chat_update, ChatMemberHandler.MY_CHAT_MEMBER))
+    application.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_TITLE, handle_chat_update))
+    application.add_handler(MessageReactionHandler(handle_reaction_count, message_reaction_types=MessageReactionHandler.MESSAGE_REACTION_COUNT_UPDATED))
     
+    # Схема нужна до initialize(): там персистентность читает user_state
+    try:
+        await run_db(init_db)
+    except Exception as e:
+        logger.error(f"Error creating tables: {e}")
     await application.initialize()
+    # post_init сам вызывается только из run_polling/run_webhook, поэтому прогрев кэша запускаем явно
+    await post_init(application)
+    outbound.start(application.bot)
     await application.start()
-    await application.updater.start_polling(drop_pending_updates=True)
+    # message_reaction_count не приходит без явной подписки
+    if WEBHOOK_URL:
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES
+        )
+        logger.info(f"Вебхук установлен: {WEBHOOK_PATH}")
+    else:
+        await application.updater.start_polling(drop_pending_updates=True, allowed_updates=Update.ALL_TYPES)
+    job_leader.start()
+    await post_scheduler.start(application.bot)
+    notification_outbox.start()
     logger.info("Бот запущен!")
     return application
 
@@ -2484,19 +4620,36 @@ def main():
     if not BOT_TOKEN:
         logger.error("BOT_TOKEN не установлен!")
         return
+    # Без секрета вебхук принял бы апдейты от кого угодно; сгенерировать свой нельзя - у реплик он должен совпадать
+    if WEBHOOK_URL and not WEBHOOK_SECRET:
+        logger.error("WEBHOOK_SECRET обязателен в режиме вебхука!")
+        return
     
     app = web.Application()
     app.router.add_get('/', health)
     app.router.add_get('/health', health)
+    app.router.add_get('/metrics', metrics)
+    if WEBHOOK_URL:
+        app.router.add_post(WEBHOOK_PATH, telegram_webhook)
     
     async def start_services(app):
         app['bot'] = await start_bot()
     
     async def cleanup(app):
+        await post_scheduler.stop()
+        await notification_outbox.stop()
+        await job_leader.stop()
         if 'bot' in app:
-            await app['bot'].updater.stop()
+            # В режиме вебхука вебхук не снимаем: его могут обслуживать другие реплики
+            if app['bot'].updater.running:
+                await app['bot'].updater.stop()
             await app['bot'].stop()
+        await outbound.stop()
+        if 'bot' in app:
             await app['bot'].shutdown()
+        await reaction_buffer.stop()
+        db_executor.shutdown(wait=True)
+        db_pool.closeall()
     
     app.on_startup.append(start_services)
     app.on_cleanup.append(cleanup)